@@ -3,15 +3,18 @@ import os
 import random
 import logging
 import signal
+import time
 
 from ..exceptions import ExecutorError, SolverException
 from ..utils.nointerrupt import WithKeyboardInterruptAs
 from ..utils.event import Eventful
 from ..utils import config
 from .smtlib import Z3Solver, Expression
+from .smtlib.cache import cache_stats
 from .state import Concretize, TerminateState
 
 from .workspace import Workspace
+from multiprocessing import Condition, Event, RawArray, RawValue
 from multiprocessing.managers import SyncManager
 from contextlib import contextmanager
 
@@ -19,6 +22,23 @@ from contextlib import contextmanager
 
 consts = config.get_group('executor')
 consts.add('seed', default=1337, description='The seed to use when randomly selecting states')
+consts.add('queue_size', default=1 << 18, description='Maximum number of states waiting to be run')
+consts.add('context_flush_interval', default=1.0,
+           description='Seconds between flushes of the buffered shared context updates of a worker. They are also '
+                       'flushed every time a worker selects a new state')
+
+
+# Functions returning counters of this process, like cache_stats(). Their
+# increase over each worker run is added up in the 'run_stats' context
+stats_sources = [cache_stats]
+
+
+def run_stats():
+    ''' Returns the counters of all the stats sources of this process '''
+    stats = {}
+    for source in stats_sources:
+        stats.update(source())
+    return stats
 
 
 def mgr_init():
@@ -74,6 +94,13 @@ class Policy(object):
         '''
         return None
 
+    def priority(self, state_id):
+        ''' Priority of state_id, computed once when it is enqueued. States
+            are then dequeued lowest priority first.
+            Policies that select states on information only known when
+            dequeuing return None and implement choice instead '''
+        return None
+
     def choice(self, state_ids):
         ''' Select a state id from state_ids.
             self.context has a dict mapping state_ids -> summarize(state)'''
@@ -85,6 +112,11 @@ class Random(Policy):
         super().__init__(executor, *args, **kwargs)
         random.seed(consts.seed)  # For repeatable results
 
+    def priority(self, state_id):
+        # The state with the lowest of independent random priorities is a
+        # uniformly random choice among the queued states
+        return random.random()
+
     def choice(self, state_ids):
         return random.choice(state_ids)
 
@@ -104,8 +136,7 @@ class Uncovered(Policy):
     def _visited_callback(self, state, pc, instr):
         ''' Maintain our own copy of the visited set
         '''
-        with self.locked_context('visited', set) as ctx:
-            ctx.add(pc)
+        self._executor.buffered_context.add('policy.visited', pc)
 
     def summarize(self, state):
         ''' Save the last pc before storing the state '''
@@ -137,8 +168,7 @@ class BranchLimited(Policy):
         ''' Maintain our own copy of the visited set
         '''
         pc = state.platform.current.PC
-        with self.locked_context('visited', dict) as ctx:
-            ctx[pc] = ctx.get(pc, 0) + 1
+        self._executor.buffered_context.increment('policy.visited', pc)
 
     def summarize(self, state):
         return state.cpu.PC
@@ -163,6 +193,176 @@ class BranchLimited(Policy):
             return None
 
 
+class ContextBuffer(object):
+    '''
+    Worker local updates of the executor shared context.
+
+    Updates are accumulated here and applied to the shared context in bulk,
+    taking the executor lock once: when the worker selects a new state, when
+    it finishes and at least every executor.context_flush_interval seconds.
+    Only commutative updates are supported (adding to a set, incrementing a
+    counter, setting a bit of a bitmap and merging a dict), so the order of
+    the flushes from different workers does not matter. Use Executor.locked_context to read, or to
+    update the context otherwise.
+    '''
+
+    def __init__(self, executor):
+        self._executor = executor
+        self._sets = {}
+        self._counters = {}
+        self._bitmaps = {}
+        self._dicts = {}
+        self._interval = consts.context_flush_interval
+        self._last_flush = time.monotonic()
+
+    def __bool__(self):
+        return bool(self._sets or self._counters or self._bitmaps or self._dicts)
+
+    def add(self, key, value):
+        ''' Add value to the set context[key] '''
+        self._sets.setdefault(key, set()).add(value)
+        self._flush_if_due()
+
+    def increment(self, key, item=None, amount=1):
+        ''' Increment the count of item in the dict context[key], or the
+            number context[key] itself if item is None '''
+        counter = self._counters.setdefault(key, {})
+        counter[item] = counter.get(item, 0) + amount
+        self._flush_if_due()
+
+    def mark(self, key, item, index):
+        ''' Set the bit index of the bitmap of item in the dict context[key].
+            The bitmaps are kept in the context as ints '''
+        bitmaps = self._bitmaps.setdefault(key, {})
+        bits = bitmaps.get(item)
+        if bits is None:
+            bits = bitmaps[item] = bytearray()
+        byte = index >> 3
+        if byte >= len(bits):
+            bits.extend(bytes(byte + 1 - len(bits)))
+        bits[byte] |= 1 << (index & 7)
+        self._flush_if_due()
+
+    def update(self, key, mapping):
+        ''' Merge mapping into the dict context[key] '''
+        self._dicts.setdefault(key, {}).update(mapping)
+        self._flush_if_due()
+
+    def _flush_if_due(self):
+        if time.monotonic() - self._last_flush >= self._interval:
+            self.flush()
+
+    def flush(self):
+        ''' Apply the buffered updates to the shared context '''
+        self._last_flush = time.monotonic()
+        if not self:
+            return
+        with self._executor.locked_context() as context:
+            self.apply(context)
+
+    def apply(self, context):
+        ''' Apply the buffered updates to context and forget them '''
+        for key, values in self._sets.items():
+            context[key] = set(context.get(key, ())) | values
+
+        for key, counter in self._counters.items():
+            if None in counter:
+                context[key] = context.get(key, 0) + counter.pop(None)
+            if counter:
+                counts = context.get(key, {})
+                for item, amount in counter.items():
+                    counts[item] = counts.get(item, 0) + amount
+                context[key] = counts
+
+        for key, bitmaps in self._bitmaps.items():
+            merged = context.get(key, {})
+            for item, bits in bitmaps.items():
+                merged[item] = merged.get(item, 0) | int.from_bytes(bits, 'little')
+            context[key] = merged
+
+        for key, mapping in self._dicts.items():
+            merged = context.get(key, {})
+            merged.update(mapping)
+            context[key] = merged
+
+        self._sets, self._counters, self._bitmaps, self._dicts = {}, {}, {}, {}
+
+
+class StateQueue(object):
+    '''
+    Priority queue of state ids in shared memory.
+
+    It is created before the workers are forked so all of them use the same
+    memory, without a round trip to the manager process. It is a binary heap
+    on the state priorities; states with the same priority are dequeued in
+    no particular order.
+    The callers must synchronize the accesses (see Executor._lock).
+    '''
+
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._ids = RawArray('q', capacity)
+        self._priorities = RawArray('d', capacity)
+        self._size = RawValue('q', 0)
+
+    def __len__(self):
+        return self._size.value
+
+    def ids(self):
+        ''' Returns the list of queued state ids '''
+        return self._ids[:self._size.value]
+
+    def push(self, state_id, priority=0.0):
+        size = self._size.value
+        if size == self._capacity:
+            raise ExecutorError("Too many states waiting to be run (see executor.queue_size)")
+        self._size.value = size + 1
+        self._sift_up(size, state_id, priority)
+
+    def pop(self, index=0):
+        ''' Removes and returns the state id at heap position index '''
+        ids, priorities = self._ids, self._priorities
+        state_id = ids[index]
+        size = self._size.value - 1
+        self._size.value = size
+        if index < size:
+            # Move the last state to the hole, then restore the heap
+            last_id, last_priority = ids[size], priorities[size]
+            if index > 0 and priorities[(index - 1) >> 1] > last_priority:
+                self._sift_up(index, last_id, last_priority)
+            else:
+                self._sift_down(index, last_id, last_priority)
+        return state_id
+
+    def remove(self, state_id):
+        ''' Removes state_id from the queue '''
+        self.pop(self.ids().index(state_id))
+
+    def _sift_up(self, pos, state_id, priority):
+        ids, priorities = self._ids, self._priorities
+        while pos > 0:
+            parent = (pos - 1) >> 1
+            if priorities[parent] <= priority:
+                break
+            ids[pos], priorities[pos] = ids[parent], priorities[parent]
+            pos = parent
+        ids[pos], priorities[pos] = state_id, priority
+
+    def _sift_down(self, pos, state_id, priority):
+        ids, priorities = self._ids, self._priorities
+        size = self._size.value
+        child = 2 * pos + 1
+        while child < size:
+            if child + 1 < size and priorities[child + 1] < priorities[child]:
+                child += 1
+            if priority <= priorities[child]:
+                break
+            ids[pos], priorities[pos] = ids[child], priorities[child]
+            pos = child
+            child = 2 * pos + 1
+        ids[pos], priorities[pos] = state_id, priority
+
+
 class Executor(Eventful):
     '''
     The executor guides the execution of a single state, handles state forking
@@ -184,17 +384,19 @@ class Executor(Eventful):
         self.manager = SyncManager()
         self.manager.start(lambda: signal.signal(signal.SIGINT, signal.SIG_IGN))
 
-        # The main executor lock. Acquire this for accessing shared objects
-        self._lock = self.manager.Condition()
+        # The main executor lock. Acquire this for accessing shared objects.
+        # It, the shutdown event, the state queue and the running count are
+        # not managed objects but shared memory inherited by the forked workers
+        self._lock = Condition()
 
         # Shutdown Event
-        self._shutdown = self.manager.Event()
+        self._shutdown = Event()
 
-        # States on storage. Shared dict state name ->  state stats
-        self._states = self.manager.list()
+        # States on storage, waiting to be run
+        self._states = StateQueue(consts.queue_size)
 
         # Number of currently running workers. Initially no running workers
-        self._running = self.manager.Value('i', 0)
+        self._running = RawValue('i', 0)
 
         self._workspace = Workspace(self._lock, store)
 
@@ -203,6 +405,9 @@ class Executor(Eventful):
             context = {}
         self._shared_context = self.manager.dict(context)
 
+        # Updates to the shared context made by this worker, not applied yet
+        self.buffered_context = ContextBuffer(self)
+
         # scheduling priority policy (wip)
         # Set policy
         policies = {'random': Random,
@@ -211,6 +416,8 @@ class Executor(Eventful):
                     }
         self._policy = policies[policy](self)
         assert isinstance(self._policy, Policy)
+        # Whether the policy precomputes priorities or selects states with choice
+        self._prioritized = type(self._policy).priority is not Policy.priority
 
         if self.load_workspace():
             if initial is not None:
@@ -271,7 +478,7 @@ class Executor(Eventful):
             return False
 
         for id in loaded_state_ids:
-            self._states.append(id)
+            self.put(id)
 
         return True
 
@@ -310,7 +517,8 @@ class Executor(Eventful):
     @sync
     def put(self, state_id):
         ''' Enqueue it for processing '''
-        self._states.append(state_id)
+        priority = self._policy.priority(state_id) if self._prioritized else 0.0
+        self._states.push(state_id, priority)
         self._lock.notify_all()
         return state_id
 
@@ -334,15 +542,18 @@ class Executor(Eventful):
             logger.debug("Waiting for available states")
             self._lock.wait()
 
-        state_id = self._policy.choice(list(self._states))
+        if self._prioritized:
+            return self._states.pop()
+
+        state_id = self._policy.choice(self._states.ids())
         if state_id is None:
             return None
-        del self._states[self._states.index(state_id)]
+        self._states.remove(state_id)
         return state_id
 
     def list(self):
         ''' Returns the list of states ids currently queued '''
-        return list(self._states)
+        return self._states.ids()
 
     def generate_testcase(self, state, message='Testcase generated'):
         '''
@@ -432,12 +643,15 @@ class Executor(Eventful):
 
             logger.debug("Starting Manticore Symbolic Emulator Worker (pid %d).", os.getpid())
             solver = Z3Solver()
+            initial_stats = run_stats()
             while not self.is_shutdown():
                 try:  # handle fatal errors: exceptions in Manticore
                     try:  # handle external (e.g. solver) errors, and executor control exceptions
                         # select a suitable state to analyze
                         if current_state is None:
                             with self._lock:
+                                # publish the context updates of the last state
+                                self.buffered_context.flush()
                                 # notify siblings we are about to stop this run
                                 self._notify_stop_run()
                                 try:
@@ -513,5 +727,13 @@ class Executor(Eventful):
 
             assert current_state is None or self.is_shutdown()
 
+            self.buffered_context.flush()
+
+            with self.locked_context('run_stats', dict) as stats:
+                for name, value in run_stats().items():
+                    value -= initial_stats.get(name, 0)
+                    if value:
+                        stats[name] = stats.get(name, 0) + value
+
             # notify siblings we are about to stop this run
             self._notify_stop_run()
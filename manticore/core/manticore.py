@@ -9,13 +9,15 @@ from multiprocessing import Process
 from threading import Timer
 
 import functools
+import os
 import types
 
 from ..core.executor import Executor
 from ..core.plugin import Plugin
 from ..core.smtlib import solver
+from ..core.smtlib.cache import consts as cache_consts, query_cache
 from ..core.state import TerminateState, StateBase
-from ..core.workspace import ManticoreOutput
+from ..core.workspace import ManticoreOutput, FilesystemStore
 from ..utils import config
 from ..utils import log
 from ..utils.event import Eventful
@@ -64,6 +66,9 @@ class ManticoreBase(Eventful):
 
         # sugar for 'will_execute_instruction"
         self._hooks = {}
+        # Addresses of the hooks, model hooks and assertions, shared with the
+        # cpus so they only publish 'will_execute_hooked_instruction' there
+        self._hooked_pcs = set()
         self._executor = Executor(store=self._output.store, policy=policy)
         self._workers = []
 
@@ -81,6 +86,7 @@ class ManticoreBase(Eventful):
         # Move the following into a linux plugin
 
         self._assertions = {}
+        self._model_hooks = {}
         self._coverage_file = None
         self.trace = None
 
@@ -166,6 +172,20 @@ class ManticoreBase(Eventful):
             logger.warning("Using shared context without a lock")
             return self._executor._shared_context
 
+    @property
+    def buffered_context(self):
+        """
+        Buffered updates of the global Manticore context, see
+        :class:`~manticore.core.executor.ContextBuffer`. Unlike
+        :meth:`locked_context`, it does not take the global lock on each
+        update, which makes it suitable for per instruction callbacks.
+
+        Example use::
+
+            m.buffered_context.add('visited', state.cpu.PC)
+        """
+        return self._executor.buffered_context
+
     @contextmanager
     def locked_context(self, key=None, value_type=list):
         """
@@ -319,11 +339,19 @@ class ManticoreBase(Eventful):
             raise TypeError(f"pc must be either an int or None, not {pc.__class__.__name__}")
         else:
             self._hooks.setdefault(pc, set()).add(callback)
-            if self._hooks:
-                self._executor.subscribe('will_execute_instruction', self._hook_callback)
+            if pc is None:
+                self._executor.subscribe('will_execute_instruction', self._global_hook_callback)
+            else:
+                self._hooked_pcs.add(pc)
+                self._executor.subscribe('will_execute_hooked_instruction', self._hook_callback)
 
     def _hook_callback(self, state, pc, instruction):
-        'Invoke all registered generic hooks'
+        'Invoke all pc-specific hooks'
+        for cb in self._hooks.get(pc, []):
+            cb(state)
+
+    def _global_hook_callback(self, state, pc, instruction):
+        'Invoke all pc-agnostic hooks'
 
         # Ignore symbolic pc.
         # TODO(yan): Should we ask the solver if any of the hooks are possible,
@@ -332,11 +360,6 @@ class ManticoreBase(Eventful):
         if issymbolic(pc):
             return
 
-        # Invoke all pc-specific hooks
-        for cb in self._hooks.get(pc, []):
-            cb(state)
-
-        # Invoke all pc-agnostic hooks
         for cb in self._hooks.get(None, []):
             cb(state)
 
@@ -345,6 +368,13 @@ class ManticoreBase(Eventful):
     ############################################################################
 
     def apply_model_hooks(self, path):
+        '''
+        Hooks models to the addresses of the functions they replace. Each line
+        of the file at `path` is `<address> <calling convention> <model>`.
+        Models named `native.models.<name>` are the function models of
+        :mod:`manticore.native.models`, invoked with the state. Other names are
+        looked up in :mod:`manticore.platforms` and invoked with the platform.
+        '''
         # TODO(yan): Simplify the partial function application
 
         # Imported straight from __main__.py; this will be re-written once the new
@@ -355,21 +385,28 @@ class ManticoreBase(Eventful):
         with open(path, 'r') as fnames:
             for line in fnames.readlines():
                 address, cc_name, name = line.strip().split(' ')
-                fmodel = platforms
                 name_parts = name.split('.')
-                importlib.import_module(f".platforms.{name_parts[0]}", 'manticore')
-                for n in name_parts:
-                    fmodel = getattr(fmodel, n)
-                assert fmodel != platforms
+                if name_parts[0] == 'native':
+                    module = importlib.import_module(f".{'.'.join(name_parts[:-1])}", 'manticore')
+                    fmodel = getattr(module, name_parts[-1])
 
-                def cb_function(state):
-                    state.platform.invoke_model(fmodel, prefix_args=(state.platform,))
+                    def cb_function(state, fmodel=fmodel):
+                        state.invoke_model(fmodel)
+                else:
+                    fmodel = platforms
+                    importlib.import_module(f".platforms.{name_parts[0]}", 'manticore')
+                    for n in name_parts:
+                        fmodel = getattr(fmodel, n)
+                    assert fmodel != platforms
+
+                    def cb_function(state, fmodel=fmodel):
+                        state.platform.invoke_model(fmodel, prefix_args=(state.platform,))
                 self._model_hooks.setdefault(int(address, 0), set()).add(cb_function)
-                self._executor.subscribe('will_execute_instruction', self._model_hook_callback)
+                self._hooked_pcs.add(int(address, 0))
+                self._executor.subscribe('will_execute_hooked_instruction', self._model_hook_callback)
 
-    def _model_hook_callback(self, state, instruction):
-        pc = state.cpu.PC
-        if pc not in self._model_hooks:
+    def _model_hook_callback(self, state, pc, instruction):
+        if issymbolic(pc) or pc not in self._model_hooks:
             return
 
         for cb in self._model_hooks[pc]:
@@ -380,30 +417,38 @@ class ManticoreBase(Eventful):
     ############################################################################
 
     def load_assertions(self, path):
+        '''
+        Loads the assertions to add to the constraints before executing some
+        instructions. Each line of the file at `path` is `<address in hex>
+        <expression>`, see :mod:`manticore.core.parser.parser`. The expressions
+        are parsed once, here.
+        '''
+        from .parser.parser import compile_expression
+
         with open(path, 'r') as f:
             for line in f.readlines():
                 pc = int(line.split(' ')[0], 16)
                 if pc in self._assertions:
                     logger.debug("Repeated PC in assertions file %s", path)
-                self._assertions[pc] = ' '.join(line.split(' ')[1:])
-                self.subscribe('will_execute_instruction', self._assertions_callback)
+                program = ' '.join(line.split(' ')[1:])
+                self._assertions[pc] = (program, compile_expression(program))
+                self._hooked_pcs.add(pc)
+                self.subscribe('will_execute_hooked_instruction', self._assertions_callback)
 
     def _assertions_callback(self, state, pc, instruction):
         if pc not in self._assertions:
             return
 
-        from .parser.parser import parse
-
-        program = self._assertions[pc]
+        program, compiled = self._assertions[pc]
 
         # This will interpret the buffer specification written in INTEL ASM.
         # (It may dereference pointers)
-        assertion = parse(program, state.cpu.read_int, state.cpu.read_register)
+        assertion = compiled(state.cpu.read_bytes, state.cpu.read_register)
         if not solver.can_be_true(state.constraints, assertion):
             logger.info(str(state.cpu))
             logger.info("Assertion %x -> {%s} does not hold. Aborting state.",
-                        state.cpu.pc, program)
-            raise TerminateState()
+                        pc, program)
+            raise TerminateState("Assertion does not hold")
 
         # Everything is good add it.
         state.constraints.add(assertion)
@@ -462,12 +507,29 @@ class ManticoreBase(Eventful):
         self._executor._shared_context.update(self._context)
         self._context = None
 
+        self._open_query_cache()
+
+    def _open_query_cache(self):
+        ''' Opens the solver query cache before the workers are started so
+            all of them use the same database (see smt.query_cache)
+        '''
+        if not cache_consts.query_cache:
+            return
+        path = cache_consts.query_cache_path
+        if not path:
+            if not isinstance(self._output.store, FilesystemStore):
+                logger.info('Solver query cache disabled: smt.query_cache_path is needed for a non filesystem workspace')
+                return
+            path = os.path.join(self._output.store.uri, 'solver_cache.db')
+        query_cache.open(path)
+
     def _finish_run(self, profiling=False):
         assert not self.running
         if profiling:
             self._produce_profiling_data()
 
         # Copy back the shared context
+        self._executor.buffered_context.flush()
         self._context = dict(self._executor._shared_context)
 
         self._publish('did_finish_run')
@@ -531,3 +593,9 @@ class ManticoreBase(Eventful):
         elapsed = time.time() - self._time_started
         logger.info('Results in %s', self._output.store.uri)
         logger.info('Total time: %s', elapsed)
+
+        stats = self.context.get('run_stats', {})
+        for name in ('query', 'model'):
+            hits, misses = stats.get(f'{name}_hits', 0), stats.get(f'{name}_misses', 0)
+            if hits + misses:
+                logger.info('Solver %s cache: %d hits, %d misses (%.1f%% hit rate)', name, hits, misses, 100.0 * hits / (hits + misses))
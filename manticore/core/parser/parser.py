@@ -2,7 +2,7 @@
 # Minimal INTEL assembler expression calculator
 import ply.yacc as yacc
 import copy
-from ..smtlib import Operators
+from ..smtlib import Operators, Bool
 # Lexer
 # ------------------------------------------------------------
 # calclex.py
@@ -129,11 +129,16 @@ lexer = lex.lex()
 
 
 precedence = (
+    ('left', 'LOR'),
+    ('left', 'LAND'),
+    ('left', 'EQ'),
+    ('left', 'LT', 'LE', 'GT', 'GE'),
+    ('left', 'LSHIFT', 'RSHIFT'),
     ('left', 'PLUS', 'MINUS'),
     ('left', 'DIVIDE'),
     ('left', 'TIMES'),
     ('left', 'AND', 'OR'),
-    ('right', 'NEG'),
+    ('right', 'NEG', 'LNOT'),
 )
 
 
@@ -158,76 +163,93 @@ default_sizes_64 = {'QWORD': 8,
                     'DWORD': 4,
                     'WORD': 2,
                     'BYTE': 1}
-functions = {'read_memory': default_read_memory,
-             'read_register': default_read_register,
-             'get_descriptor': default_get_descriptor,
-             }
 sizes = copy.copy(default_sizes_32)
 
 
+# The rules build a function of the `functions` dict for each expression, so
+# an expression is parsed once and evaluated any number of times (see compile_expression)
+
+
+def _binary(p, operation):
+    left, right = p[1], p[3]
+    p[0] = lambda functions: operation(left(functions), right(functions))
+
+
+def _bool(value):
+    ''' The truth value of an int or BitVec operand of a logical operator '''
+    if isinstance(value, (bool, Bool)):
+        return value
+    return value != 0
+
+
+def _read_value(functions, address, size):
+    char_list = functions['read_memory'](address, size)
+    return Operators.CONCAT(8 * len(char_list), *reversed(list(map(Operators.ORD, char_list))))
+
+
 def p_expression_div(p):
     'expression : expression DIVIDE expression'
-    p[0] = p[1] // p[3]
+    _binary(p, lambda a, b: a // b)
 
 
 def p_expression_mul(p):
     'expression : expression TIMES expression'
-    p[0] = p[1] * p[3]
+    _binary(p, lambda a, b: a * b)
 
 
 def p_expression_plus(p):
     'expression : expression PLUS expression'
-    p[0] = p[1] + p[3]
+    _binary(p, lambda a, b: a + b)
 
 
 def p_expression_minus(p):
     'expression : expression MINUS expression'
-    p[0] = p[1] - p[3]
+    _binary(p, lambda a, b: a - b)
 
 
 def p_expression_and(p):
     'expression : expression AND expression'
-    p[0] = p[1] & p[3]
+    _binary(p, lambda a, b: a & b)
 
 
 def p_expression_or(p):
     'expression : expression OR expression'
-    p[0] = p[1] | p[3]
+    _binary(p, lambda a, b: a | b)
 
 
 def p_expression_neg(p):
     'expression : NEG expression '
-    p[0] = ~p[1]
+    value = p[2]
+    p[0] = lambda functions: ~value(functions)
 
 
 def p_expression_lshift(p):
     'expression : expression LSHIFT expression'
-    p[0] = p[1] << p[3]
+    _binary(p, lambda a, b: a << b)
 
 
 def p_expression_rshift(p):
     'expression : expression RSHIFT expression'
-    p[0] = p[1] >> p[3]
+    _binary(p, lambda a, b: a >> b)
 
 
 def p_expression_deref(p):
     'expression : TYPE PTR LBRAKET expression RBRAKET'
     size = sizes[p[1]]
     address = p[4]
-    char_list = functions['read_memory'](address, size)
-    value = Operators.CONCAT(8 * len(char_list), *reversed(map(Operators.ORD, char_list)))
-    p[0] = value
+    p[0] = lambda functions: _read_value(functions, address(functions), size)
 
 
 def p_expression_derefseg(p):
     'expression : TYPE PTR SEGMENT COLOM LBRAKET expression RBRAKET'
     size = sizes[p[1]]
+    segment = p[3]
     address = p[6]
-    seg = functions['read_register'](p[3])
-    base, limit, _ = functions['get_descriptor'](seg)
-    address = base + address
-    char_list = functions['read_memory'](address, size)
-    value = Operators.CONCAT(8 * len(char_list), *reversed(map(Operators.ORD, char_list)))
+
+    def value(functions):
+        seg = functions['read_register'](segment)
+        base, limit, _ = functions['get_descriptor'](seg)
+        return _read_value(functions, base + address(functions), size)
     p[0] = value
 
 
@@ -243,56 +265,55 @@ def p_factor_expr(p):
 
 def p_term_num(p):
     'term : NUMBER'
-    p[0] = p[1]
+    number = p[1]
+    p[0] = lambda functions: number
 
 
 def p_term_reg(p):
     'term : REGISTER'
-    p[0] = functions['read_register'](p[1])
+    register = p[1]
+    p[0] = lambda functions: functions['read_register'](register)
 
 
 def p_expression_eq(p):
     'expression : expression EQ expression'
-    p[0] = p[1] == p[3]
+    _binary(p, lambda a, b: a == b)
 
 
 def p_expression_land(p):
     'expression : expression LAND expression'
-    p[0] = p[1] and p[3]
+    _binary(p, lambda a, b: Operators.AND(_bool(a), _bool(b)))
 
 
 def p_expression_lor(p):
     'expression : expression LOR expression'
-    p[0] = p[1] or p[3]
+    _binary(p, lambda a, b: Operators.OR(_bool(a), _bool(b)))
 
 
 def p_expression_lnot(p):
     'expression : LNOT expression'
-    p[0] = not p[1]
+    value = p[2]
+    p[0] = lambda functions: Operators.NOT(_bool(value(functions)))
 
 
 def p_expression_lt(p):
     'expression : expression LT expression'
-    #p[0] = p[1] < p[3]
-    p[0] = Operators.ULT(p[1], p[3])
+    _binary(p, Operators.ULT)
 
 
 def p_expression_le(p):
     'expression : expression LE expression'
-    #p[0] = p[1] <= p[3]
-    p[0] = Operators.ULE(p[1], p[3])
+    _binary(p, Operators.ULE)
 
 
 def p_expression_gt(p):
     'expression : expression GT expression'
-    #p[0] = p[1] > p[3]
-    p[0] = Operators.UGT(p[1], p[3])
+    _binary(p, Operators.UGT)
 
 
 def p_expression_ge(p):
     'expression : expression GE expression'
-    #p[0] = p[1] >= p[3]
-    p[0] = Operators.UGE(p[1], p[3])
+    _binary(p, Operators.UGE)
 
 
 # Error rule for syntax errors
@@ -305,23 +326,17 @@ def p_error(p):
 parser = yacc.yacc(debug=0, write_tables=0)
 
 
-def parse(expression, read_memory=None, read_register=None, get_descriptor=None, word_size=32):
-    global functions, sizes
-
-    if read_memory is not None:
-        functions['read_memory'] = read_memory
-    else:
-        functions['read_memory'] = default_read_memory
+def compile_expression(expression, word_size=32):
+    '''
+    Parses `expression` once into a function evaluating it. The function takes
+    the `read_memory`, `read_register` and `get_descriptor` callbacks, as
+    `parse` does.
 
-    if read_register is not None:
-        functions['read_register'] = read_register
-    else:
-        functions['read_register'] = default_read_register
-
-    if get_descriptor is not None:
-        functions['get_descriptor'] = get_descriptor
-    else:
-        functions['get_descriptor'] = default_get_descriptor
+    :param str expression: expression to compile
+    :param int word_size: 32 or 64
+    :rtype: callable
+    '''
+    global sizes
 
     if word_size == 32:
         sizes = copy.copy(default_sizes_32)
@@ -329,12 +344,17 @@ def parse(expression, read_memory=None, read_register=None, get_descriptor=None,
         sizes = copy.copy(default_sizes_64)
     else:
         raise Exception("Not Supported")
-    result = parser.parse(expression, tracking=True)
-    del functions['read_memory']
-    del functions['read_register']
-    del functions['get_descriptor']
+    evaluate = parser.parse(expression, tracking=True)
+
+    def compiled(read_memory=None, read_register=None, get_descriptor=None):
+        return evaluate({'read_memory': read_memory or default_read_memory,
+                         'read_register': read_register or default_read_register,
+                         'get_descriptor': get_descriptor or default_get_descriptor})
+    return compiled
 
-    return result
+
+def parse(expression, read_memory=None, read_register=None, get_descriptor=None, word_size=32):
+    return compile_expression(expression, word_size)(read_memory, read_register, get_descriptor)
 
 
 if __name__ == '__main__':
@@ -186,20 +186,10 @@ class RecordSymbolicBranches(Plugin):
 
 class InstructionCounter(Plugin):
 
-    def will_terminate_state_callback(self, state, state_id, ex):
-        if state is None:  # FIXME Can it be None?
-            return
-        state_instructions_count = state.context.get('instructions_count', 0)
-
-        with self.manticore.locked_context() as manticore_context:
-            manticore_instructions_count = manticore_context.get('instructions_count', 0)
-            manticore_context['instructions_count'] = manticore_instructions_count + state_instructions_count
-
     def did_execute_instruction_callback(self, state, prev_pc, target_pc, instruction):
         address = prev_pc
         if not issymbolic(address):
-            count = state.context.get('instructions_count', 0)
-            state.context['instructions_count'] = count + 1
+            self.manticore.buffered_context.increment('instructions_count')
 
     def did_finish_run_callback(self):
         _shared_context = self.manticore.context
@@ -212,24 +202,9 @@ class Visited(Plugin):
         super().__init__()
         self.coverage_file = coverage_file
 
-    def will_terminate_state_callback(self, state, state_id, ex):
-        if state is None:
-            return
-        state_visited = state.context.get('visited_since_last_fork', set())
-        with self.manticore.locked_context() as manticore_context:
-            manticore_visited = manticore_context.get('visited', set())
-            manticore_context['visited'] = manticore_visited.union(state_visited)
-
-    def will_fork_state_callback(self, state, expression, values, policy):
-        state_visited = state.context.get('visited_since_last_fork', set())
-        with self.manticore.locked_context() as manticore_context:
-            manticore_visited = manticore_context.get('visited', set())
-            manticore_context['visited'] = manticore_visited.union(state_visited)
-        state.context['visited_since_last_fork'] = set()
-
     def did_execute_instruction_callback(self, state, prev_pc, target_pc, instruction):
-        state.context.setdefault('visited_since_last_fork', set()).add(prev_pc)
         state.context.setdefault('visited', set()).add(prev_pc)
+        self.manticore.buffered_context.add('visited', prev_pc)
 
     def did_finish_run_callback(self):
         _shared_context = self.manticore.context
@@ -0,0 +1,219 @@
+'''
+Caches of solver results.
+
+QueryCache: queries are keyed by a canonical hash of the constraints related
+to the queried expression, the expression itself, the solver method and its
+parameters. The results live in a sqlite database, usually in the workspace,
+so they are shared by all the worker processes and survive across runs.
+
+ModelCache: models already found for a constraint set are kept in the set
+and evaluated against new queries before asking the solver.
+'''
+import hashlib
+import logging
+import os
+import pickle
+import re
+import sqlite3
+import time
+from functools import lru_cache
+
+from .expression import Expression
+from .visitors import Evaluator, TranslatorSmtlib, get_variables
+from ...utils import config
+
+logger = logging.getLogger(__name__)
+
+consts = config.get_group('smt')
+consts.add('query_cache', default=False, description='Cache solver query results on disk. The cache is shared by all workers and reused across runs')
+consts.add('query_cache_path', default='', description='Query cache database file (default: solver_cache.db in the workspace)')
+consts.add('query_cache_size', default=100000, description='Maximum number of queries kept in the query cache')
+consts.add('model_cache', default=0, description='Number of recent models kept per constraint set to answer queries without the solver (0 disables it)')
+
+_binding_name = re.compile(r'\ba_\d+\b')
+
+
+@lru_cache(maxsize=4096)
+def canonical_smtlib(expression):
+    ''' Translates `expression` to smtlib, numbering the let bindings locally
+        so the same expression always yields the same string.
+    '''
+    translator = TranslatorSmtlib(use_bindings=True)
+    translator.visit(expression)
+    bindings = {name: f'${i}' for i, (name, _, _) in enumerate(translator.bindings)}
+    return _binding_name.sub(lambda m: bindings.get(m.group(0), m.group(0)), translator.result)
+
+
+def query_key(method, constraints, expression, *params):
+    ''' Returns the cache key of solver query `method` over `expression`.
+
+        Only the constraints related to the expression take part in the key,
+        the same ones that are sent to the solver.
+    '''
+    related_to = expression if isinstance(expression, Expression) else None
+    variables, related = constraints._get_related(related_to)
+    if related_to is not None:
+        variables = variables | get_variables(related_to)
+
+    h = hashlib.sha256()
+    h.update(f'{method}{params!r}\n'.encode())
+    for declaration in sorted(set(var.declaration for var in variables)):
+        h.update(declaration.encode())
+    for smtlib in sorted(canonical_smtlib(constraint) for constraint in related):
+        h.update(f'(assert {smtlib})'.encode())
+    if related_to is not None:
+        h.update(canonical_smtlib(related_to).encode())
+    return h.hexdigest()
+
+
+class QueryCache(object):
+    ''' On-disk store of solver query results.
+
+        Every process opens its own connection to the database; a connection
+        inherited through a fork is replaced on first use.
+    '''
+
+    def __init__(self, path=None, max_size=None, flush_perc=10):
+        self._path = None
+        self._conn = None
+        self._pid = None
+        self._max_size = max_size
+        self._purge_percent = flush_perc * 0.01
+        self._puts = 0
+        self.hits = 0
+        self.misses = 0
+        if path is not None:
+            self.open(path)
+
+    def __getstate__(self):
+        raise Exception()
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def enabled(self):
+        return self._path is not None
+
+    def open(self, path):
+        ''' Use the database at `path` (it is created if needed) '''
+        if path != self._path:
+            self.close()
+            self._path = path
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+        self._path = None
+
+    def _connection(self):
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self._path, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS queries (key TEXT PRIMARY KEY, value BLOB, last_used REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS queries_last_used ON queries (last_used)')
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, key):
+        ''' Returns (True, value) if `key` is in the cache, (False, None) otherwise '''
+        try:
+            conn = self._connection()
+            row = conn.execute('SELECT value FROM queries WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                conn.execute('UPDATE queries SET last_used = ? WHERE key = ?', (time.time(), key))
+        except sqlite3.Error as e:
+            logger.warning('Query cache error: %s', e)
+            row = None
+
+        if row is None:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        return True, pickle.loads(row[0])
+
+    def put(self, key, value):
+        try:
+            conn = self._connection()
+            conn.execute('INSERT OR REPLACE INTO queries VALUES (?, ?, ?)',
+                         (key, pickle.dumps(value), time.time()))
+            self._puts += 1
+            if self._puts % 256 == 0:
+                self.flush()
+        except sqlite3.Error as e:
+            logger.warning('Query cache error: %s', e)
+
+    def flush(self):
+        ''' Evicts the least recently used queries if the cache is over its size '''
+        max_size = consts.query_cache_size if self._max_size is None else self._max_size
+        conn = self._connection()
+        size = conn.execute('SELECT COUNT(*) FROM queries').fetchone()[0]
+        if size <= max_size:
+            return
+        purge_count = size - max_size + int(max_size * self._purge_percent)
+        conn.execute('DELETE FROM queries WHERE key IN (SELECT key FROM queries ORDER BY last_used LIMIT ?)', (purge_count,))
+        logger.debug('Query cache: evicted %d queries', purge_count)
+
+    def __len__(self):
+        if not self.enabled:
+            return 0
+        return self._connection().execute('SELECT COUNT(*) FROM queries').fetchone()[0]
+
+
+class ModelCache(object):
+    ''' Answers satisfiability queries by evaluating the models previously
+        found for the same constraint set (or its parents and forks).
+
+        The models live in ConstraintSet._models, most recent first. A model
+        maps variable names to values and array names to a dict index -> value.
+    '''
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return consts.model_cache > 0
+
+    def lookup(self, constraints, related, expression=None):
+        ''' Returns (True, value) if a model of `constraints` satisfies all the
+            `related` constraints. The value is the one of `expression` under
+            that model (None if no expression). Returns (False, None) otherwise.
+        '''
+        for model in constraints._models:
+            evaluator = Evaluator(model)
+            try:
+                for constraint in related:
+                    evaluator.visit(constraint)
+                    if not evaluator.pop():
+                        break
+                else:
+                    value = None
+                    if expression is not None:
+                        evaluator.visit(expression)
+                        value = evaluator.pop()
+                    self.hits += 1
+                    return True, value
+            except Evaluator.NotEvaluable:
+                pass
+        self.misses += 1
+        return False, None
+
+    def add(self, constraints, model):
+        models = constraints._models
+        models.insert(0, model)
+        del models[consts.model_cache:]
+
+
+query_cache = QueryCache()
+model_cache = ModelCache()
+
+
+def cache_stats():
+    ''' Returns the counters of the solver caches of this process '''
+    return {'query_hits': query_cache.hits, 'query_misses': query_cache.misses,
+            'model_hits': model_cache.hits, 'model_misses': model_cache.misses}
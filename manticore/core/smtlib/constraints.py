@@ -1,20 +1,179 @@
 import itertools
 import sys
+from collections import ChainMap
 
 from ...utils.helpers import PickleSerializer
-from .expression import BitVecVariable, BoolVariable, ArrayVariable, Array, Bool, BitVec, BoolConstant, ArrayProxy, BoolEq, Variable, Constant
+from .expression import BitVecVariable, BoolVariable, ArrayVariable, Array, Bool, BitVec, BoolConstant, ArrayProxy, Variable
 from .visitors import GetDeclarations, TranslatorSmtlib, get_variables, simplify, replace
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+class Partition(object):
+    ''' A group of constraints sharing variables (transitively), along with
+        the smtlib generated so far for them.
+    '''
+    __slots__ = ('owner', 'variables', 'constraints', '_declarations', '_declared', '_smtlib', '_translated')
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.variables = {}
+        self.constraints = []
+        self._declarations = ''
+        self._declared = 0
+        self._smtlib = ''
+        self._translated = 0
+
+    def copy(self, owner):
+        partition = Partition(owner)
+        partition.variables = dict(self.variables)
+        partition.constraints = list(self.constraints)
+        partition._declarations = self._declarations
+        partition._declared = self._declared
+        partition._smtlib = self._smtlib
+        partition._translated = self._translated
+        return partition
+
+    def update(self, other):
+        for name, var in other.variables.items():
+            self.variables.setdefault(name, var)
+        self.constraints.extend(other.constraints)
+
+    @property
+    def declarations(self):
+        ''' The declarations of the variables of the partition.
+            Variables are only ever appended, so only the new ones are declared.
+        '''
+        if self._declared < len(self.variables):
+            result = [self._declarations]
+            for var in itertools.islice(self.variables.values(), self._declared, None):
+                result.append(var.declaration + '\n')
+            self._declarations = ''.join(result)
+            self._declared = len(self.variables)
+        return self._declarations
+
+    @property
+    def smtlib(self):
+        ''' The assertions of the constraints of the partition.
+            Constraints are only ever appended, so only the new ones are translated.
+        '''
+        if self._translated < len(self.constraints):
+            translator = TranslatorSmtlib(use_bindings=True)
+            for constraint in self.constraints[self._translated:]:
+                translator.visit(constraint)
+            result = [self._smtlib]
+            for name, exp, smtlib in translator.bindings:
+                if isinstance(exp, BitVec):
+                    result.append(f'(declare-fun {name} () (_ BitVec {exp.size}))')
+                elif isinstance(exp, Bool):
+                    result.append(f'(declare-fun {name} () Bool)')
+                elif isinstance(exp, Array):
+                    result.append(f'(declare-fun {name} () (Array (_ BitVec {exp.index_bits}) (_ BitVec {exp.value_bits})))')
+                else:
+                    raise Exception(f"Type not supported {exp!r}")
+                result.append(f'(assert (= {name} {smtlib}))\n')
+
+            asserts = []
+            constraint_str = translator.pop()
+            while constraint_str is not None:
+                if constraint_str != 'true':
+                    asserts.append(f'(assert {constraint_str})\n')
+                constraint_str = translator.pop()
+            result.extend(reversed(asserts))
+            self._smtlib = ''.join(result)
+            self._translated = len(self.constraints)
+        return self._smtlib
+
+
+class ConstraintIndex(object):
+    ''' Union-find over the variable names of a constraint set.
+
+        Constraints are grouped in partitions of constraints sharing
+        variables, so the constraints related to an expression are found
+        without rescanning the whole set. A copy layers its changes over the
+        original, which must not change while the copy is in use, and only
+        copies a partition when it changes it.
+    '''
+
+    def __init__(self):
+        self._parents = ChainMap()
+        # The constraints without variables are kept under the None key.
+        # Merged partitions are set to None, as they may be in a base map.
+        self._partitions = ChainMap()
+        self.unsat = None
+
+    def copy(self):
+        index = ConstraintIndex()
+        index._parents = self._parents.new_child()
+        index._partitions = self._partitions.new_child()
+        index.unsat = self.unsat
+        return index
+
+    def _find(self, name):
+        parents = self._parents
+        root = name
+        while parents[root] != root:
+            root = parents[root]
+        while parents[name] != root:
+            parents[name], name = root, parents[name]
+        return root
+
+    def _own(self, root):
+        partition = self._partitions[root]
+        if partition.owner is not self:
+            partition = partition.copy(self)
+            self._partitions[root] = partition
+        return partition
+
+    def add(self, constraint):
+        if isinstance(constraint, BoolConstant):
+            if not constraint.value:
+                self.unsat = constraint
+            return
+
+        variables = get_variables(constraint)
+        if not variables:
+            if self._partitions.get(None) is None:
+                self._partitions[None] = Partition(self)
+            self._own(None).constraints.append(constraint)
+            return
+
+        roots = set()
+        for var in variables:
+            if var.name not in self._parents:
+                self._parents[var.name] = var.name
+                self._partitions[var.name] = Partition(self)
+            roots.add(self._find(var.name))
+
+        # Merge everything into the biggest partition
+        root = max(roots, key=lambda r: len(self._partitions[r].constraints))
+        partition = self._own(root)
+        for other in roots - {root}:
+            partition.update(self._partitions[other])
+            self._partitions[other] = None
+            self._parents[other] = root
+        for var in variables:
+            partition.variables.setdefault(var.name, var)
+        partition.constraints.append(constraint)
+
+    def partitions(self, variables=None):
+        ''' Returns the partitions holding any of `variables` (all of them if None) '''
+        if variables is None:
+            return [partition for partition in self._partitions.values() if partition is not None]
+
+        roots = {self._find(var.name) for var in variables if var.name in self._parents}
+        return [self._partitions[root] for root in roots]
+
+
 class ConstraintSet(object):
     ''' Constraint Sets
 
         An object containing a set of constraints. Serves also as a factory for
         new variables.
     '''
+    # Saved as a separate blob in the workspace, so the children share it
+    _snapshot_blob = True
 
     def __init__(self):
         self._constraints = list()
@@ -22,9 +181,13 @@ class ConstraintSet(object):
         self._sid = 0
         self._declarations = {}
         self._child = None
+        # Recently found models, shared with the children (see smt.model_cache)
+        self._models = []
+        # Slicing index, built on the first related query and not pickled
+        self._index = None
 
     def __reduce__(self):
-        return (self.__class__, (), {'_parent': self._parent, '_constraints': self._constraints, '_sid': self._sid, '_declarations': self._declarations})
+        return (self.__class__, (), {'_parent': self._parent, '_constraints': self._constraints, '_sid': self._sid, '_declarations': self._declarations, '_models': self._models})
 
     def __enter__(self):
         assert self._child is None
@@ -32,9 +195,12 @@ class ConstraintSet(object):
         self._child._parent = self
         self._child._sid = self._sid
         self._child._declarations = dict(self._declarations)
+        self._child._models = self._models
         return self._child
 
     def __exit__(self, ty, value, traceback):
+        # The index of the child is layered over ours, which may change now
+        self._child._index = None
         self._child._parent = None
         self._child = None
 
@@ -70,6 +236,8 @@ class ConstraintSet(object):
                 return
 
         self._constraints.append(constraint)
+        if self._index is not None:
+            self._index.add(constraint)
 
         if check:
             from ...core.smtlib import solver
@@ -82,91 +250,64 @@ class ConstraintSet(object):
         self._sid += 1
         return self._sid
 
-    def __get_related(self, related_to=None):
-        if related_to is not None:
-            number_of_constraints = len(self.constraints)
-            remaining_constraints = set(self.constraints)
-            related_variables = get_variables(related_to)
-            related_constraints = set()
-
-            added = True
-            while added:
-                added = False
-                logger.debug('Related variables %r', [x.name for x in related_variables])
-                for constraint in list(remaining_constraints):
-                    if isinstance(constraint, BoolConstant):
-                        if constraint.value:
-                            continue
-                        else:
-                            related_constraints = {constraint}
-                            break
-
-                    variables = get_variables(constraint)
-                    if related_variables & variables:
-                        remaining_constraints.remove(constraint)
-                        related_constraints.add(constraint)
-                        related_variables |= variables
-                        added = True
-
-            logger.debug('Reduced %d constraints!!', number_of_constraints - len(related_constraints))
-        else:
-            related_variables = set()
-            for constraint in self.constraints:
-                related_variables |= get_variables(constraint)
-            related_constraints = set(self.constraints)
+    def _get_index(self, inherit=True):
+        ''' Returns the slicing index of this set, building it if needed.
+
+            The index of a child is layered over its parent's, which is built
+            first so the queries run on temporary children (see the solver)
+            share it. Farther ancestors are only reused if already indexed.
+        '''
+        if self._index is None:
+            parent = self._parent
+            if parent is not None and (inherit or parent._index is not None):
+                self._index = parent._get_index(inherit=False).copy()
+                constraints = self._constraints
+            else:
+                self._index = ConstraintIndex()
+                constraints = self.constraints
+            for constraint in constraints:
+                self._index.add(constraint)
+        return self._index
+
+    def _get_related(self, related_to=None):
+        ''' Returns the variables and the constraints related to `related_to`
+            (all of them if None). A constraint is related if it shares a
+            variable with `related_to` or with another related constraint.
+        '''
+        index = self._get_index()
+        related_variables = set() if related_to is None else get_variables(related_to)
+        if index.unsat is not None:
+            return related_variables, {index.unsat}
+
+        related_constraints = set()
+        for partition in index.partitions(None if related_to is None else related_variables):
+            related_variables.update(partition.variables.values())
+            related_constraints.update(partition.constraints)
+        logger.debug('Reduced %d constraints!!', len(self) - len(related_constraints))
         return related_variables, related_constraints
 
     def to_string(self, related_to=None, replace_constants=True):
-        related_variables, related_constraints = self.__get_related(related_to)
-
-        if replace_constants:
-            constant_bindings = {}
-            for expression in self.constraints:
-                if isinstance(expression, BoolEq) and \
-                   isinstance(expression.operands[0], Variable) and \
-                   isinstance(expression.operands[1], Constant):
-                    constant_bindings[expression.operands[0]] = expression.operands[1]
-
-        tmp = set()
-        result = ''
-        for var in related_variables:
-            # FIXME
-            # band aid hack around the fact that we are double declaring stuff :( :(
-            if var.declaration in tmp:
-                logger.warning("Variable '%s' was copied twice somewhere", var.name)
-                continue
-            tmp.add(var.declaration)
-            result += var.declaration + '\n'
-
-        translator = TranslatorSmtlib(use_bindings=True)
-        for constraint in related_constraints:
-            if replace_constants:
-                if isinstance(constraint, BoolEq) and \
-                   isinstance(constraint.operands[0], Variable) and \
-                   isinstance(constraint.operands[1], Constant):
-                    var = constraint.operands[0]
-                    expression = constraint.operands[1]
-                    expression = simplify(replace(expression, constant_bindings))
-                    constraint = var == expression
-
-            translator.visit(constraint)
-        for name, exp, smtlib in translator.bindings:
-            if isinstance(exp, BitVec):
-                result += f'(declare-fun {name} () (_ BitVec {exp.size}))'
-            elif isinstance(exp, Bool):
-                result += f'(declare-fun {name} () Bool)'
-            elif isinstance(exp, Array):
-                result += f'(declare-fun {name} () (Array (_ BitVec {exp.index_bits}) (_ BitVec {exp.value_bits})))'
-            else:
-                raise Exception(f"Type not supported {exp!r}")
-            result += f'(assert (= {name} {smtlib}))\n'
+        ''' Returns the smtlib representation of the constraints related to
+            `related_to` (all of them if None).
 
-        constraint_str = translator.pop()
-        while constraint_str is not None:
-            if constraint_str != 'true':
-                result += f'(assert {constraint_str})\n'
-            constraint_str = translator.pop()
-        return result
+            :param replace_constants: Currently unused.
+        '''
+        index = self._get_index()
+        if index.unsat is not None:
+            return '(assert false)\n'
+
+        variables = set() if related_to is None else get_variables(related_to)
+        partitions = index.partitions(None if related_to is None else variables)
+        result = [partition.declarations for partition in partitions]
+        declared = set()
+        for partition in partitions:
+            declared.update(partition.variables)
+        for var in variables:
+            if var.name not in declared:
+                declared.add(var.name)
+                result.append(var.declaration + '\n')
+        result.extend(partition.smtlib for partition in partitions)
+        return ''.join(result)
 
     def _declare(self, var):
         ''' Declare the variable `var` '''
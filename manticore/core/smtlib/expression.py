@@ -1,10 +1,78 @@
 from functools import reduce
+from weakref import WeakValueDictionary
 import uuid
 
-
-class Expression(object):
+from ...utils import config
+
+consts = config.get_group('smt')
+consts.add('intern_expressions', default=False, description='Share structurally equal expression nodes (hash-consing) to reduce memory and let identity keyed caches hit')
+
+
+class XSlotted(type):
+    ''' Metaclass that lets __slots__ classes use multiple inheritance.
+
+        Classes declare their attributes in __xslots__ (instead of __slots__).
+        Abstract classes (declared with `abstract=True`) get no slots of their
+        own so any number of them can be mixed together; concrete classes get
+        the __xslots__ of all their bases as __slots__.
+
+        If smt.intern_expressions is set, newly built nodes are looked up in
+        the interning table (see intern_expression).
+    '''
+
+    def __new__(cls, clsname, bases, attrs, abstract=False):
+        xslots = set(attrs.get('__xslots__', ()))
+        inherited = set()
+        for base in bases:
+            xslots.update(getattr(base, '__xslots__', ()))
+            for klass in base.__mro__:
+                inherited.update(klass.__dict__.get('__slots__', ()))
+        attrs['__xslots__'] = tuple(sorted(xslots))
+        attrs['__slots__'] = () if abstract else tuple(sorted(xslots - inherited))
+        return super().__new__(cls, clsname, bases, attrs)
+
+    def __init__(cls, clsname, bases, attrs, abstract=False):
+        super().__init__(clsname, bases, attrs)
+        # Attributes other than the operands that tell apart two nodes of this class
+        cls._intern_fields = tuple(name for name in cls.__xslots__ if name not in ('_operands', '__weakref__'))
+
+    def __call__(cls, *args, **kwargs):
+        expression = super().__call__(*args, **kwargs)
+        if consts.intern_expressions:
+            return intern_expression(expression)
+        return expression
+
+
+# Interned expressions by (class, operand ids, other attributes). Operands are
+# interned first, so comparing them by identity is enough. An entry goes away
+# with its node, and a node keeps its operands (and their ids) alive.
+_intern_table = WeakValueDictionary()
+
+
+def intern_expression(expression):
+    ''' Returns the interned node structurally equal to `expression`, which
+        becomes the interned one if there was none.
+        Variables are never interned (two variables with the same name in
+        different constraint sets are different symbols), nor are the mutable
+        ArrayProxy and ArraySlice.
+    '''
+    cls = type(expression)
+    if cls is ArrayProxy or cls is ArraySlice or isinstance(expression, Variable):
+        return expression
+    operands = expression._operands if isinstance(expression, Operation) else ()
+    key = (cls, tuple(map(id, operands)), tuple(getattr(expression, name) for name in cls._intern_fields))
+    interned = _intern_table.get(key)
+    if interned is None:
+        _intern_table[key] = expression
+        return expression
+    return interned
+
+
+class Expression(object, metaclass=XSlotted, abstract=True):
     ''' Abstract taintable Expression. '''
 
+    __xslots__ = ('_taint', '__weakref__')
+
     def __init__(self, taint=()):
         if self.__class__ is Expression:
             raise TypeError
@@ -24,7 +92,9 @@ class Expression(object):
         return self._taint
 
 
-class Variable(Expression):
+class Variable(Expression, abstract=True):
+    __xslots__ = ('_name',)
+
     def __init__(self, name, *args, **kwargs):
         if self.__class__ is Variable:
             raise TypeError
@@ -49,7 +119,9 @@ class Variable(Expression):
         return '<{:s}({:s}) at {:x}>'.format(type(self).__name__, self.name, id(self))
 
 
-class Constant(Expression):
+class Constant(Expression, abstract=True):
+    __xslots__ = ('_value',)
+
     def __init__(self, value, *args, **kwargs):
         if self.__class__ is Constant:
             raise TypeError
@@ -62,7 +134,9 @@ class Constant(Expression):
         return self._value
 
 
-class Operation(Expression):
+class Operation(Expression, abstract=True):
+    __xslots__ = ('_operands',)
+
     def __init__(self, *operands, **kwargs):
         if self.__class__ is Operation:
             raise TypeError
@@ -148,7 +222,7 @@ class BoolConstant(Bool, Constant):
         return self.value
 
 
-class BoolOperation(Operation, Bool):
+class BoolOperation(Operation, Bool, abstract=True):
     def __init__(self, *operands, **kwargs):
         super().__init__(*operands, **kwargs)
 
@@ -191,6 +265,8 @@ class BoolITE(BoolOperation):
 class BitVec(Expression):
     ''' This adds a bitsize to the Expression class '''
 
+    __xslots__ = ('size',)
+
     def __init__(self, size, *operands, **kwargs):
         super().__init__(*operands, **kwargs)
         self.size = size
@@ -409,7 +485,7 @@ class BitVecConstant(BitVec, Constant):
         return super().__hash__()
 
 
-class BitVecOperation(BitVec, Operation):
+class BitVecOperation(BitVec, Operation, abstract=True):
     def __init__(self, size, *operands, **kwargs):
         super().__init__(size, *operands, **kwargs)
 
@@ -559,6 +635,8 @@ class UnsignedGreaterOrEqual(BoolOperation):
 ###############################################################################
 # Array  BV32 -> BV8  or BV64 -> BV8
 class Array(Expression):
+    __xslots__ = ('_index_bits', '_index_max', '_value_bits')
+
     def __init__(self, index_bits, index_max, value_bits, *operands, **kwargs):
         assert index_bits in (32, 64, 256)
         assert value_bits in (8, 16, 32, 64, 256)
@@ -704,7 +782,9 @@ class Array(Expression):
 
     def write_BE(self, address, value, size):
         address = self.cast_index(address)
-        value = BitVec(size * self.value_bits).cast(value)
+        if not isinstance(value, BitVec):
+            value = BitVecConstant(size * self.value_bits, value)
+        assert value.size == size * self.value_bits
         array = self
         for offset in range(size):
             array = array.store(address + offset, BitVecExtract(value, (size - 1 - offset) * self.value_bits, self.value_bits))
@@ -712,7 +792,9 @@ class Array(Expression):
 
     def write_LE(self, address, value, size):
         address = self.cast_index(address)
-        value = BitVec(size * self.value_bits).cast(value)
+        if not isinstance(value, BitVec):
+            value = BitVecConstant(size * self.value_bits, value)
+        assert value.size == size * self.value_bits
         array = self
         for offset in reversed(range(size)):
             array = array.store(address + offset, BitVecExtract(value, (size - 1 - offset) * self.value_bits, self.value_bits))
@@ -760,7 +842,7 @@ class ArrayVariable(Array, Variable):
         return f'(declare-fun {self.name} () (Array (_ BitVec {self.index_bits}) (_ BitVec {self.value_bits})))'
 
 
-class ArrayOperation(Array, Operation):
+class ArrayOperation(Array, Operation, abstract=True):
     def __init__(self, array, *operands, **kwargs):
         assert isinstance(array, Array)
         super().__init__(array.index_bits, array.index_max, array.value_bits, array, *operands, **kwargs)
@@ -791,6 +873,8 @@ class ArrayStore(ArrayOperation):
 
 
 class ArraySlice(Array):
+    __xslots__ = ('_array', '_slice_offset', '_slice_size')
+
     def __init__(self, array, offset, size, *args, **kwargs):
         if not isinstance(array, Array):
             raise ValueError("Array expected")
@@ -834,6 +918,8 @@ class ArraySlice(Array):
 
 
 class ArrayProxy(Array):
+    __xslots__ = ('_array', '_name', '_concrete_cache', '_written')
+
     def __init__(self, array):
         assert isinstance(array, Array)
         self._concrete_cache = {}
@@ -1005,6 +1091,8 @@ class ArraySelect(BitVec, Operation):
 
 
 class BitVecSignExtend(BitVecOperation):
+    __xslots__ = ('extend',)
+
     def __init__(self, operand, size_dest, *args, **kwargs):
         assert isinstance(operand, BitVec)
         assert isinstance(size_dest, int)
@@ -1014,6 +1102,8 @@ class BitVecSignExtend(BitVecOperation):
 
 
 class BitVecZeroExtend(BitVecOperation):
+    __xslots__ = ('extend',)
+
     def __init__(self, size_dest, operand, *args, **kwargs):
         assert isinstance(operand, BitVec)
         assert isinstance(size_dest, int)
@@ -1023,6 +1113,8 @@ class BitVecZeroExtend(BitVecOperation):
 
 
 class BitVecExtract(BitVecOperation):
+    __xslots__ = ('_begining', '_end')
+
     def __init__(self, operand, offset, size, *args, **kwargs):
         assert isinstance(offset, int)
         assert isinstance(size, int)
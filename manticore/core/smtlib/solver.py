@@ -15,13 +15,18 @@
 # You can create new symbols operate on them. The declarations will be sent to the smtlib process when needed.
 # You can add new constraints. A new constraint may change the state from {None, sat} to {sat, unsat, unknown}
 from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
+from functools import wraps
 from subprocess import PIPE, Popen, check_output
 
 from ...exceptions import Z3NotFoundError, SolverException, SolverUnknown, TooManySolutions
 from . import operators as Operators
 from .expression import *
 from .constraints import *
+from .cache import query_cache, query_key, model_cache
+import inspect
 import logging
+import os
 import re
 import shlex
 import time
@@ -38,6 +43,33 @@ consts.add('timeout', default=240, description='Timeout, in seconds, for each Z3
 consts.add('memory', default=16384, description='Max memory for Z3 to use (in Megabytes)')
 consts.add('maxsolutions', default=10000, description='Maximum solutions to provide when solving for all values')
 consts.add('z3_bin', default='z3', description='Z3 binary to use')
+consts.add('incremental', default=False, description='Keep one live Z3 process per worker and only send it the constraints not asserted yet (push/pop per query)')
+
+
+def cached(*params):
+    ''' Looks up the results of a solver query in the query cache (see
+        smt.query_cache) before running it, and stores them after.
+        :param params: names of the arguments, other than the constraints and
+                       the queried expression, that change the result
+    '''
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        def wrapper(self, constraints, expression, *args, **kwargs):
+            if not query_cache.enabled or not (expression is True or isinstance(expression, Expression)):
+                return func(self, constraints, expression, *args, **kwargs)
+            arguments = signature.bind(self, constraints, expression, *args, **kwargs)
+            arguments.apply_defaults()
+            key = query_key(func.__name__, constraints, expression, *(arguments.arguments[name] for name in params))
+            found, value = query_cache.get(key)
+            if not found:
+                value = func(self, constraints, expression, *args, **kwargs)
+                query_cache.put(key, value)
+            return value
+        return wrapper
+    return decorator
+
 
 class Solver(object, metaclass=ABCMeta):
     @abstractmethod
@@ -119,10 +151,20 @@ class Z3Solver(Solver):
         '''
         super().__init__()
         self._proc = None
+        # pid of the process that spawned self._proc (it is not ours after a fork)
+        self._proc_pid = None
+
+        # Incremental session (see smt.incremental). One pushed frame per
+        # ConstraintSet in the parent chain of the last synced set:
+        # [constraint set, its constraint list, number asserted, declared names].
+        # None when there is no session.
+        self._frames = None
+        self._declared = None
 
         self._command = f'{consts.z3_bin} -t:{consts.timeout*1000} -memory:{consts.memory} -smt2 -in'
         self._init = ['(set-logic QF_AUFBV)', '(set-option :global-decls false)']
         self._get_value_fmt = (re.compile('\(\((?P<expr>(.*))\ #x(?P<value>([0-9a-fA-F]*))\)\)'), 16)
+        self._model_fmt = re.compile(r'\(([^\s()]+|\(select\s+[^\s()]+\s+#x[0-9a-fA-F]+\))\s+(#x[0-9a-fA-F]+|#b[01]+|true|false)\)')
 
         self.debug = False
         # To cache what get-info returned; can be directly set when writing tests
@@ -169,6 +211,7 @@ class Z3Solver(Solver):
         assert '_proc' not in dir(self) or self._proc is None
         try:
             self._proc = Popen(shlex.split(self._command), stdin=PIPE, stdout=PIPE, bufsize=0, universal_newlines=True)
+            self._proc_pid = os.getpid()
         except OSError as e:
             print(e, "Probably too many cached expressions? visitors._cache...")
             # Z3 was removed from the system in the middle of operation
@@ -180,8 +223,20 @@ class Z3Solver(Solver):
 
     def _stop_proc(self):
         ''' Auxiliary method to stop the external solver process'''
+        self._frames = None
+        self._declared = None
         if self._proc is None:
             return
+        if self._proc_pid != os.getpid():
+            # Inherited through a fork. The process belongs to our parent, just
+            # drop our copy of the pipes.
+            for pipe in (self._proc.stdin, self._proc.stdout):
+                try:
+                    pipe.close()
+                except IOError as e:
+                    logger.debug(str(e))
+            self._proc = None
+            return
         if self._proc.returncode is None:
             try:
                 self._send("(exit)")
@@ -221,8 +276,13 @@ class Z3Solver(Solver):
 
     def _reset(self, constraints=None):
         ''' Auxiliary method to reset the smtlib external solver to initial defaults'''
+        self._frames = None
+        self._declared = None
         if self._proc is None:
             self._start_proc()
+        elif self._proc_pid != os.getpid():
+            self._stop_proc()
+            self._start_proc()
         else:
             if self.support_reset:
                 self._send("(reset)")
@@ -305,13 +365,9 @@ class Z3Solver(Solver):
         assert isinstance(expression, Variable)
 
         if isinstance(expression, Array):
-            result = bytearray()
-            for c in expression:
-                expression_str = translate_to_smtlib(c)
-                self._send('(get-value (%s))' % expression_str)
-                response = self._recv()
-                result.append(int('0x{:s}'.format(response.split(expression_str)[1][3:-2]), 16))
-            return bytes(result)
+            terms = [self._select_term(expression, i) for i in range(expression.index_max)]
+            values = self._getvalues(terms)
+            return bytes(values[term] for term in terms)
         else:
             self._send('(get-value (%s))' % expression.name)
             ret = self._recv()
@@ -327,6 +383,53 @@ class Z3Solver(Solver):
 
         raise NotImplementedError("_getvalue only implemented for Bool and BitVec")
 
+    @staticmethod
+    def _select_term(array, index):
+        ''' Returns the smtlib term reading the array variable `array` at the
+            concrete `index`, as the solver prints it back in a get-value '''
+        return f'(select {array.name} #x{index:0{array.index_bits // 4}x})'
+
+    def _getvalues(self, terms):
+        ''' Ask the solver for the values of all the smtlib `terms` (variable
+            names and selects of array variables) in a single get-value.
+            The current set of assertions must be sat.
+            :return: a dict from each term to its value
+        '''
+        values = {}
+        if not terms:
+            return values
+        self._send(f"(get-value ({' '.join(terms)}))")
+        for term, value in self._model_fmt.findall(self._recv()):
+            if value in ('true', 'false'):
+                value = value == 'true'
+            else:
+                value = int(value[2:], 16 if value[1] == 'x' else 2)
+            values[re.sub(r'\s+', ' ', term)] = value
+        return values
+
+    def _getmodel(self, variables, constraints):
+        ''' Ask the solver for the values of `variables` and of the arrays read
+            at a concrete index in `constraints`, all in one get-value.
+            The current set of assertions must be sat.
+            :return: a model for the model cache (name -> value, array name -> {index: value})
+        '''
+        terms = {}
+        for var in variables:
+            if not isinstance(var, Array):
+                terms[var.name] = (var, None)
+        for constraint in constraints:
+            for array, index in get_concrete_selects(constraint):
+                terms[self._select_term(array, index)] = (array, index)
+
+        model = {}
+        for term, value in self._getvalues(terms).items():
+            var, index = terms[term]
+            if index is None:
+                model[var.name] = value
+            else:
+                model.setdefault(var.name, {})[index] = value
+        return model
+
     # push pop
     def _push(self):
         ''' Pushes and save the current constraint store and state.'''
@@ -336,7 +439,102 @@ class Z3Solver(Solver):
         ''' Recall the last pushed constraint store and state. '''
         self._send('(pop 1)')
 
-    #@memoized
+    # incremental session
+    def _assert_frame(self, frame, constraints):
+        ''' Declares the new variables and asserts `constraints` in the
+            current (top) frame.
+        '''
+        declared = self._declared
+        result = []
+        for constraint in constraints:
+            for var in get_variables(constraint):
+                if var.name not in declared:
+                    declared.add(var.name)
+                    frame[3].append(var.name)
+                    result.append(var.declaration)
+            result.append(f'(assert {translate_to_smtlib(constraint, use_bindings=True)})')
+        frame[2] += len(constraints)
+        if result:
+            self._send('\n'.join(result))
+
+    def _pop_frames(self, n):
+        ''' Pops the last `n` frames of the session '''
+        if n == 0:
+            return
+        self._send(f'(pop {n})')
+        for frame in self._frames[-n:]:
+            self._declared.difference_update(frame[3])
+        del self._frames[-n:]
+
+    def _sync_session(self, constraints):
+        ''' Brings the live solver up to date with `constraints`.
+
+            Each set in the parent chain of `constraints` gets its own frame
+            (push). Frames of sets that are still part of the chain are
+            reused and only the constraints not asserted yet are sent. Frames
+            of sets no longer in the chain (a sibling or a different state)
+            are popped. Nothing is restarted unless the process is gone or
+            was inherited through a fork.
+        '''
+        chain = []
+        cs = constraints
+        while cs is not None:
+            chain.append(cs)
+            cs = cs._parent
+        chain.reverse()
+
+        if self._frames is None or self._proc is None or self._proc_pid != os.getpid():
+            self._reset()
+            self._frames = []
+            self._declared = set()
+        frames = self._frames
+
+        # Keep the frames still matching the chain. A frame that needs new
+        # constraints must become the top one.
+        keep = 0
+        for frame, cs in zip(frames, chain):
+            if frame[0] is not cs or frame[1] is not cs._constraints or frame[2] > len(cs._constraints):
+                break
+            keep += 1
+            if frame[2] < len(cs._constraints):
+                break
+        self._pop_frames(len(frames) - keep)
+
+        if frames:
+            top = frames[-1]
+            self._assert_frame(top, top[1][top[2]:])
+        for cs in chain[len(frames):]:
+            self._push()
+            frame = [cs, cs._constraints, 0, []]
+            frames.append(frame)
+            self._assert_frame(frame, cs._constraints)
+
+    @contextmanager
+    def _query(self, constraints, temp_cs, related_to=None):
+        ''' Loads `temp_cs`, a child of `constraints` extended with the query,
+            into the solver for the duration of the block.
+
+            Without smt.incremental the process is reset and fed the
+            constraints related to `related_to`. Otherwise the session is
+            synced with `temp_cs` and the frame holding the query is popped
+            on exit.
+        '''
+        if not consts.incremental:
+            self._reset(temp_cs.to_string(related_to=related_to))
+            yield
+            return
+
+        self._sync_session(temp_cs)
+        try:
+            yield
+        except Exception:
+            # We do not know in which state the process was left
+            self._frames = None
+            raise
+        if self._frames and self._frames[-1][0] is temp_cs:
+            self._pop_frames(1)
+
+    @cached()
     def can_be_true(self, constraints, expression):
         ''' Check if two potentially symbolic values can be equal '''
         if isinstance(expression, bool):
@@ -344,17 +542,36 @@ class Z3Solver(Solver):
                 return expression
             else:
                 #if True check if constraints are feasible
-                self._reset(constraints)
-                return self._check() == 'sat'
+                if model_cache.enabled:
+                    variables, related = constraints._get_related()
+                    if model_cache.lookup(constraints, related)[0]:
+                        return True
+                if consts.incremental:
+                    self._sync_session(constraints)
+                else:
+                    self._reset(constraints)
+                if self._check() != 'sat':
+                    return False
+                if model_cache.enabled:
+                    model_cache.add(constraints, self._getmodel(variables, related))
+                return True
         assert isinstance(expression, Bool)
 
         with constraints as temp_cs:
             temp_cs.add(expression)
-            self._reset(temp_cs.to_string(related_to=expression))
-            return self._check() == 'sat'
+            if model_cache.enabled:
+                variables, related = temp_cs._get_related(expression)
+                if model_cache.lookup(constraints, related)[0]:
+                    return True
+            with self._query(constraints, temp_cs, related_to=expression):
+                if self._check() != 'sat':
+                    return False
+                if model_cache.enabled:
+                    model_cache.add(constraints, self._getmodel(variables, related))
+                return True
 
     # get-all-values min max minmax
-    #@memoized
+    @cached('maxcnt', 'silent')
     def get_all_values(self, constraints, expression, maxcnt=None, silent=False):
         ''' Returns a list with all the possible values for the symbol x'''
         if not isinstance(expression, Expression):
@@ -376,28 +593,27 @@ class Z3Solver(Solver):
                 raise NotImplementedError("get_all_values only implemented for Bool and BitVec")
 
             temp_cs.add(var == expression)
-            self._reset(temp_cs.to_string(related_to=var))
-
-            result = []
-            val = None
-            while self._check() == 'sat':
-                value = self._getvalue(var)
-                result.append(value)
-                self._assert(var != value)
-
-                if len(result) >= maxcnt:
-                    if silent:
-                        # do not throw an exception if set to silent
-                        # Default is not silent, assume user knows
-                        # what they are doing and will check the size
-                        # of returned vals list (previous smtlib behavior)
-                        break
-                    else:
-                        raise TooManySolutions(result)
+
+            with self._query(constraints, temp_cs, related_to=var):
+                result = []
+                while self._check() == 'sat':
+                    value = self._getvalue(var)
+                    result.append(value)
+                    self._assert(var != value)
+
+                    if len(result) >= maxcnt:
+                        if silent:
+                            # do not throw an exception if set to silent
+                            # Default is not silent, assume user knows
+                            # what they are doing and will check the size
+                            # of returned vals list (previous smtlib behavior)
+                            break
+                        else:
+                            raise TooManySolutions(result)
 
             return result
 
-    #@memoized
+    @cached('goal', 'M')
     def optimize(self, constraints, x, goal, M=10000):
         ''' Iteratively finds the maximum or minimal value for the operation
             (Normally Operators.UGT or Operators.ULT)
@@ -412,56 +628,57 @@ class Z3Solver(Solver):
             X = temp_cs.new_bitvec(x.size)
             temp_cs.add(X == x)
             aux = temp_cs.new_bitvec(X.size, name='optimized_')
-            self._reset(temp_cs.to_string(related_to=X))
-            self._send(aux.declaration)
-
-            if getattr(self, f'support_{goal}'):
-                self._push()
-                try:
-                    self._assert(operation(X, aux))
-                    self._send('(%s %s)' % (goal, aux.name))
-                    self._send('(check-sat)')
-                    _status = self._recv()
-                    if _status not in ('sat', 'unsat', 'unknown'):
-                        # Minimize (or Maximize) sometimes prints the objective before the status
-                        # This will be a line like NAME |-> VALUE
-                        maybe_sat = self._recv()
-                        if maybe_sat == 'sat':
-                            pattern = re.compile('(?P<expr>.*?)\s+\|->\s+(?P<value>.*)', re.DOTALL)
-                            m = pattern.match(_status)
+            with self._query(constraints, temp_cs, related_to=X):
+                self._send(aux.declaration)
+
+                if getattr(self, f'support_{goal}'):
+                    self._push()
+                    try:
+                        self._assert(operation(X, aux))
+                        self._send('(%s %s)' % (goal, aux.name))
+                        self._send('(check-sat)')
+                        _status = self._recv()
+                        if _status not in ('sat', 'unsat', 'unknown'):
+                            # Minimize (or Maximize) sometimes prints the objective before the status
+                            # This will be a line like NAME |-> VALUE
+                            maybe_sat = self._recv()
+                            if maybe_sat == 'sat':
+                                pattern = re.compile('(?P<expr>.*?)\s+\|->\s+(?P<value>.*)', re.DOTALL)
+                                m = pattern.match(_status)
+                                expr, value = m.group('expr'), m.group('value')
+                                assert expr == aux.name
+                                return int(value)
+                        elif _status == 'sat':
+                            ret = self._recv()
+                            if not (ret.startswith('(') and ret.endswith(')')):
+                                raise SolverException('bad output on max, z3 may have been killed')
+
+                            pattern = re.compile('\(objectives.*\((?P<expr>.*) (?P<value>\d*)\).*\).*', re.MULTILINE | re.DOTALL)
+                            m = pattern.match(ret)
                             expr, value = m.group('expr'), m.group('value')
                             assert expr == aux.name
                             return int(value)
-                    elif _status == 'sat':
-                        ret = self._recv()
-                        if not (ret.startswith('(') and ret.endswith(')')):
-                            raise SolverException('bad output on max, z3 may have been killed')
-
-                        pattern = re.compile('\(objectives.*\((?P<expr>.*) (?P<value>\d*)\).*\).*', re.MULTILINE | re.DOTALL)
-                        m = pattern.match(ret)
-                        expr, value = m.group('expr'), m.group('value')
-                        assert expr == aux.name
-                        return int(value)
-                finally:
-                    self._pop()
-                    self._reset(temp_cs)
-                    self._send(aux.declaration)
-
-            operation = {'maximize': Operators.UGT, 'minimize': Operators.ULT}[goal]
-            self._assert(aux == X)
-            last_value = None
-            i = 0
-            while self._check() == 'sat':
-                last_value = self._getvalue(aux)
-                self._assert(operation(aux, last_value))
-                i = i + 1
-                if (i > M):
-                    raise SolverException("Optimizing error, maximum number of iterations was reached")
-            if last_value is not None:
-                return last_value
-            raise SolverException("Optimizing error, unsat or unknown core")
-
-    #@memoized
+                    finally:
+                        self._pop()
+                        if not consts.incremental:
+                            self._reset(temp_cs)
+                            self._send(aux.declaration)
+
+                operation = {'maximize': Operators.UGT, 'minimize': Operators.ULT}[goal]
+                self._assert(aux == X)
+                last_value = None
+                i = 0
+                while self._check() == 'sat':
+                    last_value = self._getvalue(aux)
+                    self._assert(operation(aux, last_value))
+                    i = i + 1
+                    if (i > M):
+                        raise SolverException("Optimizing error, maximum number of iterations was reached")
+                if last_value is not None:
+                    return last_value
+                raise SolverException("Optimizing error, unsat or unknown core")
+
+    @cached()
     def get_value(self, constraints, expression):
         ''' Ask the solver for one possible assignment for val using current set
             of constraints.
@@ -470,42 +687,26 @@ class Z3Solver(Solver):
         if not issymbolic(expression):
             return expression
         assert isinstance(expression, (Bool, BitVec, Array))
+        if isinstance(expression, Array):
+            return self.get_values(constraints, [expression])[0]
+        if model_cache.enabled:
+            found, value = model_cache.lookup(constraints, constraints._get_related(expression)[1], expression)
+            if found:
+                return value
         with constraints as temp_cs:
             if isinstance(expression, Bool):
                 var = temp_cs.new_bool()
-            elif isinstance(expression, BitVec):
+            else:
                 var = temp_cs.new_bitvec(expression.size)
-            elif isinstance(expression, Array):
-                var = []
-                result = []
-                for i in range(expression.index_max):
-                    subvar = temp_cs.new_bitvec(expression.value_bits)
-                    var.append(subvar)
-                    temp_cs.add(subvar == expression[i])
-
-                self._reset(temp_cs)
-                if self._check() != 'sat':
-                    raise SolverException('Model is not available')
-
-                for i in range(expression.index_max):
-                    self._send('(get-value (%s))' % var[i].name)
-                    ret = self._recv()
-                    assert ret.startswith('((') and ret.endswith('))')
-                    pattern, base = self._get_value_fmt
-                    m = pattern.match(ret)
-                    expr, value = m.group('expr'), m.group('value')
-                    result.append(int(value, base))
-                return bytes(result)
 
             temp_cs.add(var == expression)
 
-            self._reset(temp_cs)
-
-        if self._check() != 'sat':
-            raise SolverException('Model is not available')
+            with self._query(constraints, temp_cs):
+                if self._check() != 'sat':
+                    raise SolverException('Model is not available')
 
-        self._send('(get-value (%s))' % var.name)
-        ret = self._recv()
+                self._send('(get-value (%s))' % var.name)
+                ret = self._recv()
         if not (ret.startswith('((') and ret.endswith('))')):
             raise SolverException('SMTLIB error parsing response: %s' % ret)
 
@@ -518,5 +719,79 @@ class Z3Solver(Solver):
             return int(value, base)
         raise NotImplementedError("get_value only implemented for Bool and BitVec")
 
+    def _value_term(self, temp_cs, expression):
+        ''' Returns the variable holding the value of the Bool or BitVec
+            `expression` and the term to ask for it. Variables and selects of
+            array variables at a concrete index are asked for directly, any
+            other expression is bound to a fresh variable in `temp_cs`.
+        '''
+        if isinstance(expression, Variable):
+            return expression, expression.name
+        if isinstance(expression, ArraySelect) and isinstance(expression.array, ArrayVariable) and \
+                isinstance(expression.index, BitVecConstant):
+            return expression.array, self._select_term(expression.array, expression.index.value)
+        var = temp_cs.new_bool() if isinstance(expression, Bool) else temp_cs.new_bitvec(expression.size)
+        temp_cs.add(var == expression)
+        return var, var.name
+
+    def get_values(self, constraints, expressions):
+        ''' Ask the solver for one possible assignment of all the `expressions`
+            at once. The values come from the same model, in a single check and
+            a single get-value.
+            :param expressions: Bool, BitVec and Array expressions or concrete values
+            :return: the list of values, in the order of `expressions`
+        '''
+        values = list(expressions)
+        if not any(map(issymbolic, values)):
+            return values
+        with constraints as temp_cs:
+            # (variable, term) pairs per expression, a list of them per array
+            terms = []
+            for expression in values:
+                if not issymbolic(expression):
+                    terms.append(None)
+                    continue
+                assert isinstance(expression, (Bool, BitVec, Array))
+                if not isinstance(expression, Array):
+                    terms.append(self._value_term(temp_cs, expression))
+                    continue
+                array = expression.array if isinstance(expression, ArrayProxy) else expression
+                if isinstance(array, ArrayVariable):
+                    terms.append([(array, self._select_term(array, i)) for i in range(expression.index_max)])
+                else:
+                    elements = []
+                    for i in range(expression.index_max):
+                        var = temp_cs.new_bitvec(expression.value_bits)
+                        temp_cs.add(var == expression[i])
+                        elements.append((var, var.name))
+                    terms.append(elements)
+
+            # Variables in no constraint are not declared to the solver, any
+            # value will do for them
+            declared = {var.name for var in temp_cs._get_related()[0]}
+            query = set()
+            for item in terms:
+                for var, term in (item if isinstance(item, list) else (item,) if item else ()):
+                    if var.name in declared:
+                        query.add(term)
+            with self._query(constraints, temp_cs):
+                if self._check() != 'sat':
+                    raise SolverException('Model is not available')
+                model = self._getvalues(query)
+
+        def value(var, term):
+            if var.name not in declared:
+                return False if isinstance(var, Bool) else 0
+            if term not in model:
+                raise SolverException(f'No value for {term} in the model')
+            return model[term]
+
+        for i, item in enumerate(terms):
+            if isinstance(item, list):
+                values[i] = bytes(value(var, term) for var, term in item)
+            elif item is not None:
+                values[i] = value(*item)
+        return values
+
 
 solver = Z3Solver()
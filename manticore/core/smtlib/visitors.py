@@ -1,5 +1,6 @@
 from ...utils.helpers import CacheDict
 from .expression import *
+from .expression import consts, intern_expression
 from functools import lru_cache
 import logging
 import operator
@@ -119,6 +120,8 @@ class Visitor(object):
                 import copy
                 aux = copy.copy(expression)
                 aux._operands = operands
+                if consts.intern_expressions:
+                    return intern_expression(aux)
                 return aux
         return expression
 
@@ -779,3 +782,263 @@ def get_variables(expression):
     visitor = GetDeclarations()
     visitor.visit(expression)
     return visitor.result
+
+
+class GetConcreteSelects(Visitor):
+    ''' Simple visitor to collect the array variables read at a concrete index
+        (through any number of stores), as (variable, index) pairs
+    '''
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.selects = set()
+
+    def visit_ArraySelect(self, expression, *operands):
+        if not isinstance(expression.index, Constant):
+            return
+        array = expression.array
+        while isinstance(array, (ArrayProxy, ArrayStore)):
+            array = array.array
+        if isinstance(array, ArrayVariable):
+            self.selects.add((array, expression.index.value & ((1 << array.index_bits) - 1)))
+
+    @property
+    def result(self):
+        return self.selects
+
+
+def get_concrete_selects(expression):
+    visitor = GetConcreteSelects()
+    visitor.visit(expression)
+    return visitor.result
+
+
+class Evaluator(Translator):
+    ''' Evaluates an expression under a concrete assignment of its variables.
+
+        The model maps variable names to ints (bitvectors) or bools, and array
+        names to a dict index -> value. Raises NotEvaluable if the expression
+        reads a variable (or array position) missing from the model.
+    '''
+    class NotEvaluable(RuntimeError):
+        pass
+
+    class _StoredArray(object):
+        ''' An array value: `array` with `value` stored at `index` '''
+        __slots__ = ('array', 'index', 'value')
+
+        def __init__(self, array, index, value):
+            self.array = array
+            self.index = index
+            self.value = value
+
+    def __init__(self, model, **kwargs):
+        super().__init__(**kwargs)
+        self._model = model
+
+    def _method(self, expression, *args):
+        if isinstance(expression, ArrayProxy):
+            # A proxy is a leaf for the visitor, evaluate the array it wraps
+            evaluator = Evaluator(self._model, cache=self._cache)
+            evaluator.visit(expression.array)
+            return evaluator.result
+        return super()._method(expression, *args)
+
+    def _get(self, name):
+        try:
+            return self._model[name]
+        except KeyError:
+            raise self.NotEvaluable(name)
+
+    @staticmethod
+    def _signed(value, size):
+        if value & (1 << (size - 1)):
+            return value - (1 << size)
+        return value
+
+    @staticmethod
+    def _udiv(a, b, mask):
+        return mask if b == 0 else a // b
+
+    @staticmethod
+    def _urem(a, b):
+        return a if b == 0 else a % b
+
+    def visit_BitVecConstant(self, expression):
+        return expression.value & expression.mask
+
+    def visit_BoolConstant(self, expression):
+        return bool(expression.value)
+
+    def visit_BitVecVariable(self, expression):
+        return self._get(expression.name) & expression.mask
+
+    def visit_BoolVariable(self, expression):
+        return bool(self._get(expression.name))
+
+    def visit_ArrayVariable(self, expression):
+        return self._get(expression.name)
+
+    def visit_ArrayStore(self, expression, array, index, value):
+        return self._StoredArray(array, index, value)
+
+    def visit_ArraySelect(self, expression, array, index):
+        while isinstance(array, self._StoredArray):
+            if array.index == index:
+                return array.value
+            array = array.array
+        try:
+            return array[index]
+        except KeyError:
+            raise self.NotEvaluable(f'{expression.array.name}[{index}]')
+
+    def visit_BoolNot(self, expression, a):
+        return not a
+
+    def visit_BoolEq(self, expression, a, b):
+        return a == b
+
+    def visit_BoolAnd(self, expression, a, b):
+        return a and b
+
+    def visit_BoolOr(self, expression, a, b):
+        return a or b
+
+    def visit_BoolXor(self, expression, a, b):
+        return a != b
+
+    def visit_BoolITE(self, expression, cond, true, false):
+        return true if cond else false
+
+    def visit_BitVecITE(self, expression, cond, true, false):
+        return true if cond else false
+
+    def visit_BitVecAdd(self, expression, a, b):
+        return (a + b) & expression.mask
+
+    def visit_BitVecSub(self, expression, a, b):
+        return (a - b) & expression.mask
+
+    def visit_BitVecMul(self, expression, a, b):
+        return (a * b) & expression.mask
+
+    def visit_BitVecUnsignedDiv(self, expression, a, b):
+        return self._udiv(a, b, expression.mask)
+
+    def visit_BitVecDiv(self, expression, a, b):
+        # bvsdiv, in terms of bvudiv as in the smtlib definition
+        mask, signmask = expression.mask, expression.signmask
+        neg_a, neg_b = a & signmask, b & signmask
+        if neg_a:
+            a = -a & mask
+        if neg_b:
+            b = -b & mask
+        result = self._udiv(a, b, mask)
+        return -result & mask if neg_a != neg_b else result
+
+    def visit_BitVecUnsignedRem(self, expression, a, b):
+        return self._urem(a, b)
+
+    def visit_BitVecRem(self, expression, a, b):
+        # bvsrem, the sign follows the dividend
+        mask, signmask = expression.mask, expression.signmask
+        neg_a = a & signmask
+        if neg_a:
+            a = -a & mask
+        if b & signmask:
+            b = -b & mask
+        result = self._urem(a, b)
+        return -result & mask if neg_a else result
+
+    def visit_BitVecMod(self, expression, a, b):
+        # bvsmod, the sign follows the divisor
+        mask, signmask = expression.mask, expression.signmask
+        neg_a, neg_b = a & signmask, b & signmask
+        result = self._urem(-a & mask if neg_a else a, -b & mask if neg_b else b)
+        if result == 0 or neg_a == neg_b:
+            return -result & mask if neg_a else result
+        if neg_a:
+            return (b - result) & mask
+        return (result + b) & mask
+
+    def visit_BitVecShiftLeft(self, expression, a, b):
+        return (a << b) & expression.mask if b < expression.size else 0
+
+    def visit_BitVecShiftRight(self, expression, a, b):
+        return a >> b if b < expression.size else 0
+
+    def visit_BitVecArithmeticShiftRight(self, expression, a, b):
+        return (self._signed(a, expression.size) >> min(b, expression.size)) & expression.mask
+
+    def visit_BitVecAnd(self, expression, a, b):
+        return a & b
+
+    def visit_BitVecOr(self, expression, a, b):
+        return a | b
+
+    def visit_BitVecXor(self, expression, a, b):
+        return a ^ b
+
+    def visit_BitVecNot(self, expression, a):
+        return ~a & expression.mask
+
+    def visit_BitVecNeg(self, expression, a):
+        return -a & expression.mask
+
+    def visit_BitVecSignExtend(self, expression, a):
+        return self._signed(a, expression.operands[0].size) & expression.mask
+
+    def visit_BitVecZeroExtend(self, expression, a):
+        return a
+
+    def visit_BitVecExtract(self, expression, a):
+        return (a >> expression.begining) & expression.mask
+
+    def visit_BitVecConcat(self, expression, *operands):
+        result = 0
+        for operand, value in zip(expression.operands, operands):
+            result = (result << operand.size) | value
+        return result
+
+    def visit_Equal(self, expression, a, b):
+        if isinstance(expression.operands[0], Array):
+            raise self.NotEvaluable('array equality')
+        return a == b
+
+    def visit_LessThan(self, expression, a, b):
+        size = expression.operands[0].size
+        return self._signed(a, size) < self._signed(b, size)
+
+    def visit_LessOrEqual(self, expression, a, b):
+        size = expression.operands[0].size
+        return self._signed(a, size) <= self._signed(b, size)
+
+    def visit_GreaterThan(self, expression, a, b):
+        size = expression.operands[0].size
+        return self._signed(a, size) > self._signed(b, size)
+
+    def visit_GreaterOrEqual(self, expression, a, b):
+        size = expression.operands[0].size
+        return self._signed(a, size) >= self._signed(b, size)
+
+    def visit_UnsignedLessThan(self, expression, a, b):
+        return a < b
+
+    def visit_UnsignedLessOrEqual(self, expression, a, b):
+        return a <= b
+
+    def visit_UnsignedGreaterThan(self, expression, a, b):
+        return a > b
+
+    def visit_UnsignedGreaterOrEqual(self, expression, a, b):
+        return a >= b
+
+    def visit_Expression(self, expression, *operands):
+        raise self.NotEvaluable(type(expression).__name__)
+
+
+def evaluate(expression, model):
+    ''' Returns the concrete value of `expression` under `model` (see Evaluator) '''
+    evaluator = Evaluator(model)
+    evaluator.visit(expression)
+    return evaluator.result
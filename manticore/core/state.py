@@ -302,6 +302,25 @@ class StateBase(Eventful):
             value = bytes(value)
         return value
 
+    def solve_one_n(self, *exprs, constrain=False):
+        '''
+        Concretize several symbolic :class:`~manticore.core.smtlib.expression.Expression`
+        into one solution each, all taken from the same model.
+
+        :param exprs: Symbolic values to concretize
+        :param bool constrain: If True, constrain each expr to its concretized value
+        :return: Concrete values, in the order of exprs
+        :rtype: list
+        '''
+        exprs = [self.migrate_expression(expr) for expr in exprs]
+        values = self._solver.get_values(self._constraints, exprs)
+        for i, (expr, value) in enumerate(zip(exprs, values)):
+            if constrain and issymbolic(expr):
+                self.constrain(expr == value)
+            if isinstance(value, bytearray):
+                values[i] = bytes(value)
+        return values
+
     def solve_n(self, expr, nsolves):
         '''
         Concretize a symbolic :class:`~manticore.core.smtlib.expression.Expression` into
@@ -371,12 +390,11 @@ class StateBase(Eventful):
         :rtype: list[int]
         '''
         buffer = self.cpu.read_bytes(addr, nbytes)
-        result = []
-        with self._constraints as temp_cs:
-            cs_to_use = self.constraints if constrain else temp_cs
-            for c in buffer:
-                result.append(self._solver.get_value(cs_to_use, c))
-                cs_to_use.add(c == result[-1])
+        result = self._solver.get_values(self._constraints, buffer)
+        if constrain:
+            for c, value in zip(buffer, result):
+                if issymbolic(c):
+                    self.constrain(c == value)
         return result
 
     def symbolicate_buffer(self, data, label='INPUT', wildcard='+', string=False, taint=frozenset()):
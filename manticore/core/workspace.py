@@ -5,13 +5,20 @@ import signal
 import logging
 import tempfile
 import io
+import pickle
+import fnmatch
+import hashlib
+import weakref
+import copyreg
+import operator
 
 from contextlib import contextmanager
 from multiprocessing.managers import SyncManager
 
 from ..utils import config
 from ..utils.helpers import PickleSerializer
-from .smtlib import solver
+from .smtlib import solver, ConstraintSet
+from .smtlib.expression import Variable
 from .state import StateBase
 
 logger = logging.getLogger(__name__)
@@ -19,6 +26,84 @@ logger = logging.getLogger(__name__)
 consts = config.get_group('workspace')
 consts.add('prefix', default='mcore_', description="The prefix to use for output and workspace directories")
 consts.add('dir', default='.', description="Location of where to create workspace directories")
+consts.add('delta_snapshots', default=True,
+           description="Save the memory maps, memory pages and constraint sets of the states as blobs shared "
+                       "between the states, so a forked state only writes what changed since its parent")
+
+
+class _RefCounts(object):
+    """
+    Reference counts of the blobs of the saved states, kept in the manager
+    process. A blob references its children blobs while it is alive.
+    """
+
+    def __init__(self):
+        self._counts = {}
+        self._children = {}
+        # Blobs referenced whose saving is not known to be complete
+        self._pending = set()
+
+    def add(self, references):
+        """
+        Add references to blobs.
+
+        :param list references: (owner, keys) pairs, owner being the key of the
+                                referencing blob or None for a state
+        :return: the keys referenced for the first time, and the keys already
+                 referenced but not saved yet
+        :rtype: tuple
+        """
+        new, pending = [], []
+        for owner, keys in references:
+            if owner is not None:
+                self._children[owner] = keys
+            for key in keys:
+                count = self._counts.get(key, 0)
+                if not count:
+                    new.append(key)
+                    self._pending.add(key)
+                elif key in self._pending:
+                    pending.append(key)
+                self._counts[key] = count + 1
+        return new, pending
+
+    def saved(self, keys):
+        """ Mark the blobs `keys` as saved """
+        self._pending.difference_update(keys)
+
+    def release(self, keys):
+        """
+        Remove references to blobs, releasing the children of the blobs no
+        longer referenced.
+
+        :return: the keys no longer referenced
+        :rtype: list
+        """
+        dead = []
+        keys = list(keys)
+        while keys:
+            key = keys.pop()
+            count = self._counts[key] - 1
+            if count:
+                self._counts[key] = count
+            else:
+                del self._counts[key]
+                self._pending.discard(key)
+                dead.append(key)
+                keys.extend(self._children.pop(key, ()))
+        return dead
+
+    def reset(self):
+        self._counts.clear()
+        self._children.clear()
+        self._pending.clear()
+
+
+class _WorkspaceManager(SyncManager):
+    pass
+
+
+_WorkspaceManager.register('RefCounts', _RefCounts)
 
 _manager = None
 
@@ -26,7 +111,7 @@ _manager = None
 def manager():
     global _manager
     if _manager is None:
-        _manager = SyncManager()
+        _manager = _WorkspaceManager()
         _manager.start(lambda: signal.signal(signal.SIGINT, signal.SIG_IGN))
     return _manager
 
@@ -251,7 +336,7 @@ class MemoryStore(Store):
         del self._data[key]
 
     def ls(self, glob_str):
-        return list(self._data)
+        return fnmatch.filter(self._data, glob_str)
 
 
 class RedisStore(Store):
@@ -312,11 +397,158 @@ def sync(f):
     return new_function
 
 
+def _blob_object(key):
+    """ Reference to the blob of an object, resolved by :class:`_BlobUnpickler` """
+    raise pickle.UnpicklingError('Blob reference loaded outside of a workspace')
+
+
+def _blob_pages(keys):
+    """ Reference to the page blobs of a byte array, resolved by :class:`_BlobUnpickler` """
+    raise pickle.UnpicklingError('Blob reference loaded outside of a workspace')
+
+
+def _blob_variable(name, reduced):
+    """ Variable interned by name, resolved by :class:`_BlobUnpickler` """
+    raise pickle.UnpicklingError('Blob reference loaded outside of a workspace')
+
+
+def _reduce_variable(var):
+    # Constraint sets check their variables by identity, so a variable
+    # pickled in several blobs must load as a single object
+    return _blob_variable, (var.name, var.__reduce_ex__(2)[:3])
+
+
+class _BlobDispatch(dict):
+    """
+    Pickler dispatch table (see :mod:`copyreg`) reducing the objects flagged
+    with `_snapshot_blob` (memory maps, constraint sets) to references to
+    separate blobs. The pickler only looks it up for class instances, so the
+    other objects are still pickled at native speed.
+    """
+    _reduce = operator.methodcaller('__reduce_ex__', 2)
+
+    def __init__(self, pickler):
+        super().__init__(copyreg.dispatch_table)
+        self._pickler = pickler
+
+    def __missing__(self, cls):
+        if issubclass(cls, type):
+            raise KeyError(cls)
+        if getattr(cls, '_snapshot_blob', False):
+            reduce = self._pickler.reduce_blob
+        elif issubclass(cls, Variable):
+            reduce = _reduce_variable
+        else:
+            reduce = self._reduce
+        self[cls] = reduce
+        return reduce
+
+
+class _BlobPickler(pickle.Pickler):
+    """
+    Pickler saving the objects flagged with `_snapshot_blob` as separate
+    content addressed blobs, and the large byte arrays they hold (memory map
+    contents) as page blobs.
+    """
+
+    def __init__(self, f, workspace, blobs, keys, root=None):
+        self.dispatch_table = _BlobDispatch(self)
+        super().__init__(f, 2)
+        self._workspace = workspace
+        self._blobs = blobs
+        # Blob key by object id, for the objects referenced from several blobs
+        self._keys = keys
+        self._root = root
+        # The blob keys referenced by this pickle
+        self.children = []
+
+    def reduce_blob(self, obj):
+        if obj is not self._root:
+            key = self._keys.get(id(obj))
+            if key is None:
+                key = self._keys[id(obj)] = self._workspace._object_blob(self._blobs, self._keys, obj)
+            self.children.append(key)
+            return _blob_object, (key,)
+
+        reduced = obj.__reduce_ex__(2)
+        args = []
+        for arg in reduced[1]:
+            if isinstance(arg, bytearray) and len(arg) >= Workspace.page_size:
+                keys = self._workspace._page_blobs(self._blobs, arg)
+                self.children.extend(keys)
+                arg = _PageReference(keys)
+            args.append(arg)
+        return (reduced[0], tuple(args)) + tuple(reduced[2:])
+
+
+class _PageReference(object):
+    """ Pickled in place of a large byte array, as the keys of its page blobs """
+
+    def __init__(self, keys):
+        self.keys = keys
+
+    def __reduce__(self):
+        return _blob_pages, (self.keys,)
+
+
+class _BlobUnpickler(pickle.Unpickler):
+    """
+    Unpickler loading the blobs referenced from a pickle of :class:`_BlobPickler`.
+    Each blob and variable is loaded once, so the objects shared in the saved
+    state are shared in the loaded one.
+    """
+
+    def __init__(self, f, workspace, objects):
+        super().__init__(f)
+        self._workspace = workspace
+        # Loaded objects by blob key, and variables by name
+        self._objects = objects
+
+    def find_class(self, module, name):
+        if module == __name__:
+            if name == '_blob_object':
+                return self._load_object
+            if name == '_blob_pages':
+                return self._load_pages
+            if name == '_blob_variable':
+                return self._load_variable
+        return super().find_class(module, name)
+
+    def _load_variable(self, name, reduced):
+        var = self._objects.get(('variable', name))
+        if var is None:
+            func, args, state = reduced
+            var = self._objects[('variable', name)] = func(*args)
+            state, slots = state if isinstance(state, tuple) else (state, None)
+            for attr, value in dict(state or {}, **(slots or {})).items():
+                setattr(var, attr, value)
+        return var
+
+    def _load_object(self, key):
+        obj = self._objects.get(key)
+        if obj is None:
+            obj = self._objects[key] = self._workspace._load_object(key, self._objects)
+        return obj
+
+    def _load_pages(self, keys):
+        return bytearray(b''.join(self._workspace._load_blob(key)[1] for key in keys))
+
+
 class Workspace(object):
     """
     A workspace maintains a list of states to run and assigns them IDs.
+
+    With `workspace.delta_snapshots`, the memory maps, memory pages and
+    constraint sets of a state are saved as content addressed blobs, shared
+    with the other states referencing the same content. States forked from the
+    same parent share all but what changed since the fork, and a constraint set
+    references the blob of its parent. The blobs are reference counted and
+    removed with the last state referencing them.
     """
 
+    #: The size of the blobs large byte arrays (memory map contents) are split into
+    page_size = 0x1000
+
     def __init__(self, lock, store_or_desc=None):
         if isinstance(store_or_desc, Store):
             self._store = store_or_desc
@@ -324,9 +556,13 @@ class Workspace(object):
             self._store = Store.fromdescriptor(store_or_desc)
         self._serializer = PickleSerializer()
         self._last_id = manager().Value('i', 0)
+        self._refs = manager().RefCounts()
+        # Blob keys of the constraint sets saved or loaded by this process
+        self._memo = weakref.WeakKeyDictionary()
         self._lock = lock
         self._prefix = 'state_'
         self._suffix = '.pkl'
+        self._blob_prefix = 'blob_'
 
     def try_loading_workspace(self):
         state_names = self._store.ls(f'{self._prefix}*')
@@ -336,6 +572,8 @@ class Workspace(object):
 
         state_ids = list(map(get_state_id, state_names))
 
+        self.compact()
+
         if not state_ids:
             return []
 
@@ -354,6 +592,138 @@ class Workspace(object):
         self._last_id.value += 1
         return id_
 
+    def _state_key(self, state_id):
+        return f'{self._prefix}{state_id:08x}{self._suffix}'
+
+    @staticmethod
+    def _version(constraints):
+        """ What a constraint set blob is valid for, as long as the set is not modified """
+        return (id(constraints._parent), id(constraints._constraints), len(constraints._constraints),
+                constraints._sid, len(constraints._declarations))
+
+    def _page_blobs(self, blobs, data):
+        keys = []
+        for offset in range(0, len(data), self.page_size):
+            page = bytes(data[offset:offset + self.page_size])
+            key = hashlib.blake2b(page, digest_size=16).hexdigest()
+            blobs.setdefault(key, ((), page))
+            keys.append(key)
+        return keys
+
+    def _pickle_blob(self, blobs, keys, obj, key=None):
+        f = io.BytesIO()
+        pickler = _BlobPickler(f, self, blobs, keys, root=obj)
+        pickler.dump(obj)
+        payload = f.getvalue()
+        if key is None:
+            key = hashlib.blake2b(payload, digest_size=16).hexdigest()
+        blobs[key] = (pickler.children, payload)
+        if isinstance(obj, ConstraintSet):
+            self._memo[obj] = (self._version(obj), key)
+        return key
+
+    def _object_blob(self, blobs, keys, obj):
+        """
+        Return the blob key of `obj`. A constraint set unchanged since it was
+        last saved or loaded keeps its key, and is only pickled again if its
+        blob was removed since (see :meth:`_acquire`).
+        """
+        memo = self._memo.get(obj)
+        if memo is not None:
+            version, key = memo
+            if version == self._version(obj):
+                blobs.setdefault(key, obj)
+                return key
+        return self._pickle_blob(blobs, keys, obj)
+
+    def _acquire(self, blobs, keys, references):
+        """
+        Add the blob references of a state. Called with the lock held, the
+        blobs are saved after releasing it (see :meth:`_save_blobs`).
+
+        :return: the keys of the blobs to save: the ones referenced for the
+                 first time and the ones another process is still saving
+        :rtype: list
+        """
+        save = []
+        while references:
+            new, pending = self._refs.add(references)
+            save.extend(new)
+            save.extend(pending)
+            references = []
+            for key in new:
+                blob = blobs[key]
+                if not isinstance(blob, tuple):
+                    self._pickle_blob(blobs, keys, blob, key)
+                children = blobs[key][0]
+                if children:
+                    references.append((key, children))
+        return save
+
+    def _save_blobs(self, blobs, keys, save):
+        """
+        Save the blobs `save` returned by :meth:`_acquire`. Blobs are content
+        addressed, a blob saved by two processes at once gets the same data.
+        """
+        for key in save:
+            if not isinstance(blobs[key], tuple):
+                self._pickle_blob(blobs, keys, blobs[key], key)
+            children, payload = blobs[key]
+            with self._store.save_stream(f'{self._blob_prefix}{key}', binary=True) as f:
+                pickle.dump(children, f, 2)
+                f.write(payload)
+        if save:
+            self._refs.saved(save)
+
+    def _dump_state(self, state):
+        """
+        Pickle `state`, splitting out its blobs. Raises the recursion limit
+        and retries on deeply nested expressions, like
+        :meth:`PickleSerializer.serialize`.
+
+        :return: the blobs, the keys of the blobs the state references and the state pickle
+        """
+        while True:
+            blobs, keys = {}, {}
+            f = io.BytesIO()
+            pickler = _BlobPickler(f, self, blobs, keys)
+            try:
+                pickler.dump(state)
+                return blobs, keys, pickler.children, f.getvalue()
+            except RuntimeError:
+                new_limit = sys.getrecursionlimit() * 2
+                if new_limit > PickleSerializer.MAX_RECURSION:
+                    raise Exception(f'PickleSerializer recursion limit surpassed {PickleSerializer.MAX_RECURSION}, aborting')
+                logger.info(f'Recursion soft limit {sys.getrecursionlimit()} hit, increasing')
+                sys.setrecursionlimit(new_limit)
+
+    def _release(self, children):
+        for key in self._refs.release(children):
+            self._store.rm(f'{self._blob_prefix}{key}')
+
+    def _load_blob(self, key):
+        with self._store.load_stream(f'{self._blob_prefix}{key}', binary=True) as f:
+            children = pickle.load(f)
+            return children, f.read()
+
+    def _load_object(self, key, objects):
+        obj = _BlobUnpickler(io.BytesIO(self._load_blob(key)[1]), self, objects).load()
+        if isinstance(obj, ConstraintSet):
+            self._memo[obj] = (self._version(obj), key)
+        return obj
+
+    def _load_header(self, key):
+        """
+        Load the blob keys referenced by the state saved under `key`, and the
+        stream positioned at the state pickle. States saved in full have no
+        header, so the state is returned instead.
+        """
+        with self._store.load_stream(key, binary=True) as f:
+            header = pickle.load(f)
+            if isinstance(header, StateBase):
+                return [], header
+            return header, f.read()
+
     def load_state(self, state_id, delete=True):
         """
         Load a state from storage identified by `state_id`.
@@ -362,7 +732,17 @@ class Workspace(object):
         :return: The deserialized state
         :rtype: State
         """
-        return self._store.load_state(f'{self._prefix}{state_id:08x}{self._suffix}', delete=delete)
+        key = self._state_key(state_id)
+        children, payload = self._load_header(key)
+        if isinstance(payload, StateBase):
+            state = payload
+        else:
+            state = _BlobUnpickler(io.BytesIO(payload), self, {}).load()
+        if delete:
+            with self._lock:
+                self._store.rm(key)
+                self._release(children)
+        return state
 
     def save_state(self, state, state_id=None):
         """
@@ -379,7 +759,18 @@ class Workspace(object):
         else:
             self.rm_state(state_id)
 
-        self._store.save_state(state, f'{self._prefix}{state_id:08x}{self._suffix}')
+        key = self._state_key(state_id)
+        if not consts.delta_snapshots:
+            self._store.save_state(state, key)
+            return state_id
+
+        blobs, keys, children, payload = self._dump_state(state)
+        with self._lock:
+            save = self._acquire(blobs, keys, [(None, children)])
+        self._save_blobs(blobs, keys, save)
+        with self._store.save_stream(key, binary=True) as s:
+            pickle.dump(children, s, 2)
+            s.write(payload)
         return state_id
 
     def rm_state(self, state_id):
@@ -388,7 +779,33 @@ class Workspace(object):
 
         :param state_id: The state reference of what to load
         """
-        return self._store.rm(f'{self._prefix}{state_id:08x}{self._suffix}')
+        key = self._state_key(state_id)
+        children, _ = self._load_header(key)
+        with self._lock:
+            self._store.rm(key)
+            self._release(children)
+
+    def compact(self):
+        """
+        Rebuild the blob reference counts from the saved states, removing the
+        blobs no state references (left by an interrupted run).
+        """
+        with self._lock:
+            self._refs.reset()
+            references = [(None, self._load_header(key)[0]) for key in self._store.ls(f'{self._prefix}*')]
+            live = set()
+            while references:
+                new, _ = self._refs.add(references)
+                live.update(new)
+                references = []
+                for key in new:
+                    children = self._load_blob(key)[0]
+                    if children:
+                        references.append((key, children))
+            self._refs.saved(live)
+            for name in self._store.ls(f'{self._blob_prefix}*'):
+                if name[len(self._blob_prefix):] not in live:
+                    self._store.rm(name)
 
 
 class ManticoreOutput(object):
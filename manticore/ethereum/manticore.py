@@ -1,9 +1,10 @@
 import binascii
 import json
+from array import array
+from bisect import bisect_right
 import logging
 import string
-from multiprocessing import Queue, Process
-from queue import Empty as EmptyQueue
+from multiprocessing import Process, Value
 from subprocess import check_output, Popen, PIPE
 from typing import Dict, Optional
 
@@ -17,12 +18,13 @@ import tempfile
 
 from ..core.manticore import ManticoreBase
 from ..core.smtlib import ConstraintSet, Array, ArrayProxy, BitVec, Operators
+from ..core.smtlib.solver import consts as solver_consts
 from ..core.state import TerminateState, AbandonState
 from .account import EVMContract, EVMAccount, ABI
 from .detectors import Detector
 from .solidity import SolidityMetadata
 from .state import State
-from ..exceptions import EthereumError, DependencyError, NoAliveStates
+from ..exceptions import EthereumError, DependencyError, NoAliveStates, SolverException
 from ..platforms import evm
 from ..utils import config
 from ..utils.helpers import PickleSerializer, issymbolic
@@ -66,6 +68,44 @@ def calculate_coverage(runtime_bytecode, seen):
     return count * 100.0 / total
 
 
+class EVMTrace(object):
+    '''
+    The (contract address, pc, at_init) of every instruction executed by a
+    state, kept in its context as 'evm.trace'. The pcs are stored in an
+    array, and the contract and whether it was at its constructor once per
+    run of consecutive instructions in the same code.
+    '''
+
+    def __init__(self):
+        self._pcs = array('I')
+        self._starts = array('I')
+        self._contracts = []
+        self._last = None
+
+    def append(self, address, pc, at_init):
+        if self._last is None or self._last[0] != address or self._last[1] != at_init:
+            self._last = (address, at_init)
+            self._starts.append(len(self._pcs))
+            self._contracts.append(self._last)
+        self._pcs.append(pc)
+
+    def __len__(self):
+        return len(self._pcs)
+
+    def __getitem__(self, index):
+        pc = self._pcs[index]
+        if index < 0:
+            index += len(self._pcs)
+        address, at_init = self._contracts[bisect_right(self._starts, index) - 1]
+        return address, pc, at_init
+
+    def __iter__(self):
+        ends = self._starts[1:] + array('I', [len(self._pcs)])
+        for (address, at_init), start, end in zip(self._contracts, self._starts, ends):
+            for pc in self._pcs[start:end]:
+                yield address, pc, at_init
+
+
 class ManticoreEVM(ManticoreBase):
     """ Manticore EVM manager
 
@@ -1155,16 +1195,26 @@ class ManticoreEVM(ManticoreBase):
         else:
             coverage_context_name = 'runtime_coverage'
 
-        with self.locked_context(coverage_context_name, set) as coverage:
-            coverage.add((state.platform.current_vm.address, instruction.pc))
+        address = state.platform.current_vm.address
+        self.buffered_context.mark(coverage_context_name, address, instruction.pc)
 
-        state.context.setdefault('evm.trace', []).append((state.platform.current_vm.address, instruction.pc, at_init))
+        trace = state.context.get('evm.trace')
+        if trace is None:
+            trace = state.context['evm.trace'] = EVMTrace()
+        trace.append(address, instruction.pc, at_init)
 
     def _did_evm_read_code(self, state, offset, size):
         """ INTERNAL USE """
-        with self.locked_context('code_data', set) as code_data:
-            for i in range(offset, offset + size):
-                code_data.add((state.platform.current_vm.address, i))
+        address = state.platform.current_vm.address
+        for i in range(offset, offset + size):
+            self.buffered_context.mark('code_data', address, i)
+
+    def _visited(self, coverage_context_name, address):
+        """ Returns the set of pcs of address executed by any of the explored states.
+            Coverage is kept in the shared context as a bitmap of pcs per address """
+        with self.locked_context(coverage_context_name, dict) as coverage:
+            bitmap = coverage.get(address, 0)
+        return {pc for pc, bit in enumerate(reversed(bin(bitmap))) if bit == '1'}
 
     def get_metadata(self, address) -> Optional[SolidityMetadata]:
         """ Gets the solidity metadata for address.
@@ -1289,7 +1339,8 @@ class ManticoreEVM(ManticoreBase):
                         findings.write('\n')
 
         with testcase.open_stream('summary') as stream:
-            is_something_symbolic = state.platform.dump(stream, state, self, message)
+            # The human transactions are concretized from the model of the summary
+            is_something_symbolic, conc_txs = state.platform.dump(stream, state, self, message)
 
             with self.locked_context('ethereum') as context:
                 known_sha3 = context.get('_known_sha3', None)
@@ -1308,10 +1359,10 @@ class ManticoreEVM(ManticoreBase):
                 txlist = []
                 is_something_symbolic = False
 
-                for sym_tx in blockchain.human_transactions:  # external transactions
+                human_transactions = blockchain.human_transactions  # external transactions
+                for sym_tx, conc_tx in zip(human_transactions, conc_txs):
                     tx_summary.write("Transactions No. %d\n" % blockchain.transactions.index(sym_tx))
 
-                    conc_tx = sym_tx.concretize(state)
                     txlist.append(conc_tx.to_dict(self))
 
                     is_something_symbolic = sym_tx.dump(tx_summary, state, self, conc_tx=conc_tx)
@@ -1352,8 +1403,8 @@ class ManticoreEVM(ManticoreBase):
     def _emit_trace_file(filestream, trace):
         """
         :param filestream: file object for the workspace trace file
-        :param trace: list of (contract address, pc) tuples
-        :type trace: list[tuple(int, int)]
+        :param trace: (contract address, pc, at_init) of the executed instructions
+        :type trace: EVMTrace
         """
         for contract, pc, at_init in trace:
             if pc == 0:
@@ -1383,24 +1434,34 @@ class ManticoreEVM(ManticoreBase):
             logger.debug("Generating testcase for state_id %d", state_id)
             self._generate_testcase_callback(st, 'test', '')
 
-        def worker_finalize(q):
-            try:
-                while True:
-                    finalizer(q.get_nowait())
-            except EmptyQueue:
-                pass
+        def worker_finalize(state_ids, next_index):
+            # All the queries about a state go to the same live solver, which
+            # only needs to be sent the constraints of the state once
+            solver_consts.incremental = True
+            while True:
+                with next_index.get_lock():
+                    index = next_index.value
+                    next_index.value += 1
+                if index >= len(state_ids):
+                    break
+                try:
+                    finalizer(state_ids[index])
+                except SolverException:
+                    logger.exception("Could not generate the testcase of state %d", state_ids[index])
 
-        q = Queue()
+        state_ids = []
         for state_id in self._all_state_ids:
             #we need to remove -1 state before forking because it may be in memory
             if state_id == -1:
                 finalizer(-1)
             else:
-                q.put(state_id)
+                state_ids.append(state_id)
 
+        # The workers take the next state id from a shared index as they go
+        next_index = Value('i', 0)
         report_workers = []
-        for _ in range(self._config_procs):
-            proc = Process(target=worker_finalize, args=(q,))
+        for _ in range(min(self._config_procs, len(state_ids))):
+            proc = Process(target=worker_finalize, args=(state_ids, next_index))
             proc.start()
             report_workers.append(proc)
 
@@ -1444,47 +1505,39 @@ class ManticoreEVM(ManticoreBase):
 
             with self._output.save_stream('global_%s.runtime_asm' % md.name) as global_runtime_asm:
                 runtime_bytecode = md.runtime_bytecode
+                seen = self._visited('runtime_coverage', address)
 
-                with self.locked_context('runtime_coverage') as seen:
-
-                    count, total = 0, 0
-                    for i in EVMAsm.disassemble_all(runtime_bytecode):
-                        if (address, i.pc) in seen:
-                            count += 1
-                            global_runtime_asm.write('*')
-                        else:
-                            global_runtime_asm.write(' ')
+                count, total = 0, 0
+                for i in EVMAsm.disassemble_all(runtime_bytecode):
+                    if i.pc in seen:
+                        count += 1
+                        global_runtime_asm.write('*')
+                    else:
+                        global_runtime_asm.write(' ')
 
-                        global_runtime_asm.write('%4x: %s\n' % (i.pc, i))
-                        total += 1
+                    global_runtime_asm.write('%4x: %s\n' % (i.pc, i))
+                    total += 1
 
             with self._output.save_stream('global_%s.init_asm' % md.name) as global_init_asm:
-                with self.locked_context('init_coverage') as seen:
-                    count, total = 0, 0
-                    for i in EVMAsm.disassemble_all(md.init_bytecode):
-                        if (address, i.pc) in seen:
-                            count += 1
-                            global_init_asm.write('*')
-                        else:
-                            global_init_asm.write(' ')
-
-                        global_init_asm.write('%4x: %s\n' % (i.pc, i))
-                        total += 1
+                seen = self._visited('init_coverage', address)
+                count, total = 0, 0
+                for i in EVMAsm.disassemble_all(md.init_bytecode):
+                    if i.pc in seen:
+                        count += 1
+                        global_init_asm.write('*')
+                    else:
+                        global_init_asm.write(' ')
+
+                    global_init_asm.write('%4x: %s\n' % (i.pc, i))
+                    total += 1
 
             with self._output.save_stream('global_%s.init_visited' % md.name) as f:
-                with self.locked_context('init_coverage') as seen:
-                    visited = set((o for (a, o) in seen if a == address))
-                    for o in sorted(visited):
-                        f.write('0x%x\n' % o)
+                for o in sorted(self._visited('init_coverage', address)):
+                    f.write('0x%x\n' % o)
 
             with self._output.save_stream('global_%s.runtime_visited' % md.name) as f:
-                with self.locked_context('runtime_coverage') as seen:
-                    visited = set()
-                    for (a, o) in seen:
-                        if a == address:
-                            visited.add(o)
-                    for o in sorted(visited):
-                        f.write('0x%x\n' % o)
+                for o in sorted(self._visited('runtime_coverage', address)):
+                    f.write('0x%x\n' % o)
 
         # delete actual streams from storage
         for state_id in self._all_state_ids:
@@ -1515,9 +1568,7 @@ class ManticoreEVM(ManticoreBase):
                 break
         else:
             return 0.0
-        with self.locked_context('runtime_coverage') as coverage:
-            seen = {off for addr, off in coverage if addr == account_address}
-        return calculate_coverage(runtime_bytecode, seen)
+        return calculate_coverage(runtime_bytecode, self._visited('runtime_coverage', account_address))
 
     # TODO: Find a better way to suppress execution of Manticore._did_finish_run_callback
     # We suppress because otherwise we log it many times and it looks weird.
@@ -2,22 +2,40 @@ import inspect
 import logging
 from itertools import islice
 
+import capstone as cs
 import io
 import struct
 import unicorn
 from functools import wraps
 
 from .disasm import init_disassembler
-from ..memory import ConcretizeMemory, InvalidMemoryAccess, LazySMemory
+from ..memory import ConcretizeMemory, InvalidMemoryAccess, LazySMemory, MemoryException
 from ...core.smtlib import BitVec, Operators, Constant, visitors
 from ...core.smtlib.solver import solver
-from ...utils.emulate import UnicornEmulator
+from ...utils import config
+from ...utils.emulate import ConcreteUnicornEmulator, UnicornEmulator
 from ...utils.event import Eventful
 from ...utils.helpers import issymbolic
 
 logger = logging.getLogger(__name__)
 register_logger = logging.getLogger(f'{__name__}.registers')
 
+consts = config.get_group('cpu')
+consts.add('fast_path', default=False,
+           description='Run concrete code in Unicorn, a basic block at a time, until it reaches symbolic data or '
+                       'a system call. No instruction events are published for the code run in Unicorn')
+consts.add('instruction_cache_size', default=100000,
+           description='Most decoded instructions shared by the states run in a process')
+consts.add('basic_blocks', default=True,
+           description='Decode basic blocks once into their instruction implementations, and run a whole block '
+                       'per platform step instead of a single instruction')
+
+# Instructions that end a basic block
+_BLOCK_END_GROUPS = {cs.CS_GRP_JUMP, cs.CS_GRP_CALL, cs.CS_GRP_RET, cs.CS_GRP_INT, cs.CS_GRP_IRET}
+
+# Decoded instructions by (arch, mode, address, code), without wrapped operands
+_decoded_instructions = {}
+
 ###################################################################################
 # Exceptions
 
@@ -442,7 +460,10 @@ class Cpu(Eventful):
     '''
 
     _published_events = {'write_register', 'read_register', 'write_memory', 'read_memory', 'decode_instruction',
-                         'execute_instruction'}
+                         'execute_instruction', 'execute_hooked_instruction'}
+
+    # Most instructions decoded ahead into a basic block
+    max_block_size = 64
 
     def __init__(self, regfile, memory, **kwargs):
         assert isinstance(regfile, RegisterFile)
@@ -451,6 +472,14 @@ class Cpu(Eventful):
         self._regfile = regfile
         self._memory = memory
         self._instruction_cache = {}
+        # Translated basic blocks by start address, and the addresses of the
+        # instructions and blocks decoded from each page, to invalidate them
+        self._block_cache = {}
+        self._code_pages = {}
+        self._cache_version = 0
+        self._emulator = None
+        self._concrete_emulator = None
+        self._hooked_pcs = frozenset()
         self._icount = 0
         self._last_pc = None
         if not hasattr(self, "disasm"):
@@ -481,6 +510,21 @@ class Cpu(Eventful):
     def icount(self):
         return self._icount
 
+    @property
+    def hooked_pcs(self):
+        '''
+        Addresses before which 'will_execute_hooked_instruction' is published.
+        Unlike 'will_execute_instruction', the event costs nothing on the other
+        addresses and leaves basic blocks running whole. Not pickled; the set
+        is shared with the analysis that owns the hooks, so its later changes
+        are seen.
+        '''
+        return self._hooked_pcs
+
+    @hooked_pcs.setter
+    def hooked_pcs(self, pcs):
+        self._hooked_pcs = pcs
+
     ##############################
     # Register access
     @property
@@ -518,9 +562,11 @@ class Cpu(Eventful):
         :param value: register value
         :type value: int or long or Expression
         '''
-        self._publish('will_write_register', register, value)
+        if self._is_subscribed('will_write_register'):
+            self._publish('will_write_register', register, value)
         value = self._regfile.write(register, value)
-        self._publish('did_write_register', register, value)
+        if self._is_subscribed('did_write_register'):
+            self._publish('did_write_register', register, value)
         return value
 
     def read_register(self, register):
@@ -531,9 +577,11 @@ class Cpu(Eventful):
         :return: register value
         :rtype: int or long or Expression
         '''
-        self._publish('will_read_register', register)
+        if self._is_subscribed('will_read_register'):
+            self._publish('will_read_register', register)
         value = self._regfile.read(register)
-        self._publish('did_read_register', register, value)
+        if self._is_subscribed('did_read_register'):
+            self._publish('did_read_register', register, value)
         return value
 
     # Pythonic access to registers and aliases
@@ -582,12 +630,13 @@ class Cpu(Eventful):
         if size is None:
             size = self.address_bit_size
         assert size in SANE_SIZES
-        self._publish('will_write_memory', where, expression, size)
+        if self._is_subscribed('will_write_memory'):
+            self._publish('will_write_memory', where, expression, size)
 
-        data = [Operators.CHR(Operators.EXTRACT(expression, offset, 8)) for offset in range(0, size, 8)]
-        self._memory.write(where, data, force)
+        self._memory.write_int(where, expression, size, force)
 
-        self._publish('did_write_memory', where, expression, size)
+        if self._is_subscribed('did_write_memory'):
+            self._publish('did_write_memory', where, expression, size)
 
     def read_int(self, where, size=None, force=False):
         '''
@@ -602,13 +651,13 @@ class Cpu(Eventful):
         if size is None:
             size = self.address_bit_size
         assert size in SANE_SIZES
-        self._publish('will_read_memory', where, size)
+        if self._is_subscribed('will_read_memory'):
+            self._publish('will_read_memory', where, size)
 
-        data = self._memory.read(where, size // 8, force)
-        assert (8 * len(data)) == size
-        value = Operators.CONCAT(size, *map(Operators.ORD, reversed(data)))
+        value = self._memory.read_int(where, size, force)
 
-        self._publish('did_read_memory', where, value, size)
+        if self._is_subscribed('did_read_memory'):
+            self._publish('did_read_memory', where, value, size)
         return value
 
     def write_bytes(self, where, data, force=False):
@@ -620,8 +669,12 @@ class Cpu(Eventful):
         :type data: str or list
         :param force: whether to ignore memory permissions
         '''
-        for i in range(len(data)):
-            self.write_int(where + i, Operators.ORD(data[i]), 8, force)
+        if self._is_subscribed('will_write_memory') or self._is_subscribed('did_write_memory'):
+            for i in range(len(data)):
+                self.write_int(where + i, Operators.ORD(data[i]), 8, force)
+        elif len(data):
+            # Nobody watches the individual bytes, write them all at once
+            self._memory.write(where, [Operators.CHR(Operators.ORD(byte)) for byte in data], force)
 
     def read_bytes(self, where, size, force=False):
         '''
@@ -633,10 +686,15 @@ class Cpu(Eventful):
         :return: data
         :rtype: list[int or Expression]
         '''
-        result = []
-        for i in range(size):
-            result.append(Operators.CHR(self.read_int(where + i, 8, force)))
-        return result
+        if self._is_subscribed('will_read_memory') or self._is_subscribed('did_read_memory'):
+            result = []
+            for i in range(size):
+                result.append(Operators.CHR(self.read_int(where + i, 8, force)))
+            return result
+        if size == 0:
+            return []
+        # Nobody watches the individual bytes, read them all at once
+        return [Operators.CHR(byte) for byte in self._memory.read(where, size, force)]
 
     def write_string(self, where, string, max_length=None, force=False):
         '''
@@ -744,15 +802,21 @@ class Cpu(Eventful):
 
         :param int pc: address of the instruction
         '''
-        # No dynamic code!!! #TODO!
-        # Check if instruction was already decoded
+        # Check if instruction was already decoded. Writes to executable
+        # memory invalidate it, see invalidate_cache
         if pc in self._instruction_cache:
             return self._instruction_cache[pc]
 
         text = b''
 
+        # Read the concrete bytes of an executable map in one slice
+        m = self.memory._int_map(pc, self.max_instr_width, 'x')
+        if m is not None:
+            text = m.concrete(slice(pc, pc + self.max_instr_width))
+            text = b'' if text is None else bytes(text)
+
         # Read Instruction from memory
-        for address in range(pc, pc + self.max_instr_width):
+        for address in range(pc + len(text), pc + self.max_instr_width):
             # This reads a byte from memory ignoring permissions
             # and concretize it if symbolic
             if not self.memory.access_ok(address, 'x'):
@@ -781,21 +845,66 @@ class Cpu(Eventful):
         #Pad potentially incomplete instruction with zeroes
         code = text.ljust(self.max_instr_width, b'\x00')
 
-        try:
-            # decode the instruction from code
-            insn = self.disasm.disassemble_instruction(code, pc)
-        except StopIteration as e:
-            raise DecodeException(pc, code)
+        # The same code at the same address decodes to the same instruction
+        # in every state, so the process shares them
+        key = (self.arch, self.mode, pc, code)
+        insn = _decoded_instructions.get(key)
+        if insn is None:
+            try:
+                # decode the instruction from code
+                insn = self.disasm.disassemble_instruction(code, pc)
+            except StopIteration as e:
+                raise DecodeException(pc, code)
+            # Generate the details before sharing it
+            insn.operands
+            if len(_decoded_instructions) >= consts.instruction_cache_size:
+                _decoded_instructions.clear()
+            _decoded_instructions[key] = insn
 
         # Check that the decoded instruction is contained in executable memory
         if not self.memory.access_ok(slice(pc, pc + insn.size), 'x'):
             logger.info("Trying to execute instructions from non-executable memory")
             raise InvalidMemoryAccess(pc, 'x')
 
-        insn.operands = self._wrap_operands(insn.operands)
+        # Operands are wrapped for this cpu, on a copy of the shared instruction
+        shared, insn = insn, object.__new__(type(insn))
+        insn.__dict__.update(shared.__dict__)
+        insn.operands = self._wrap_operands(shared.operands)
         self._instruction_cache[pc] = insn
+        self._add_code(pc, pc, insn.size)
         return insn
 
+    def _add_code(self, key, address, size):
+        '''
+        Registers a cached instruction or block decoded from [address, address + size)
+        '''
+        if not self._code_pages:
+            self.memory.watch_code(self)
+        page_bit_size = self.memory.page_bit_size
+        for page in range(address >> page_bit_size, ((address + size - 1) >> page_bit_size) + 1):
+            self._code_pages.setdefault(page, set()).add(key)
+
+    def invalidate_cache(self, address, size):
+        '''
+        Removes the decoded instructions and basic blocks from the pages in
+        [address, address + size), after they were written to, unmapped, or had
+        their permissions changed.
+
+        :param int address: start of the range
+        :param int size: size of the range
+        '''
+        page_bit_size = self.memory.page_bit_size
+        first, last = address >> page_bit_size, (address + size - 1) >> page_bit_size
+        if last - first >= len(self._code_pages):
+            pages = [page for page in self._code_pages if first <= page <= last]
+        else:
+            pages = range(first, last + 1)
+        for page in pages:
+            for key in self._code_pages.pop(page, ()):
+                self._instruction_cache.pop(key, None)
+                self._block_cache.pop(key, None)
+                self._cache_version += 1
+
     @property
     def instruction(self):
         if self._last_pc is None:
@@ -821,6 +930,9 @@ class Cpu(Eventful):
         if not self.memory.access_ok(self.PC, 'x'):
             raise InvalidMemoryAccess(self.PC, 'x')
 
+        if consts.fast_path and self._run_concrete():
+            return
+
         self._publish('will_decode_instruction', self.PC)
 
         insn = self.decode_instruction(self.PC)
@@ -832,16 +944,100 @@ class Cpu(Eventful):
         if insn.address != self.PC:
             return
 
+        if self.PC in self._hooked_pcs:
+            self._publish('will_execute_hooked_instruction', self.PC, insn)
+            if insn.address != self.PC:
+                return
+
         name = self.canonicalize_instruction_name(insn)
+        self._execute_instruction(insn, getattr(self, name, None))
+
+    def execute_block(self):
+        '''
+        Execute the basic block pointed by register PC, decoding it into its
+        instruction implementations the first time. The block runs until an
+        instruction leaves it. While something is subscribed to the instruction
+        events, they are published and only one instruction runs per call.
+        '''
+        if not consts.basic_blocks:
+            return self.execute()
+
+        pc = self.PC
+        if issymbolic(pc):
+            raise ConcretizeRegister(self, 'PC', policy='ALL')
+
+        if not self.memory.access_ok(pc, 'x'):
+            raise InvalidMemoryAccess(pc, 'x')
+
+        if consts.fast_path and self._run_concrete():
+            return
 
+        block = self._block_cache.get(pc)
+        if block is None:
+            block = self._translate_block(pc)
+        version = self._cache_version
+        publish = any(map(self._is_subscribed, ('will_decode_instruction', 'will_execute_instruction',
+                                                'did_execute_instruction')))
+        hooked_pcs = self._hooked_pcs
+
+        for insn, implementation in block:
+            # Stop at a branch out of the block, or when its code was written
+            if not isinstance(pc, int) or pc != insn.address or version != self._cache_version:
+                break
+            self._last_pc = pc
+            if publish:
+                if self._is_subscribed('will_decode_instruction'):
+                    self._publish('will_decode_instruction', pc)
+                if self._is_subscribed('will_execute_instruction'):
+                    self._publish('will_execute_instruction', pc, insn)
+                if self.PC != pc:
+                    break
+            if pc in hooked_pcs:
+                self._publish('will_execute_hooked_instruction', pc, insn)
+                if self.PC != pc:
+                    break
+            self._execute_instruction(insn, implementation)
+            if publish:
+                break
+            pc = self.PC
+
+    def _translate_block(self, pc):
+        '''
+        Decodes the basic block at `pc` into a list of its instructions and
+        their implementations. The block ends after a branch, or before an
+        instruction that can not be decoded.
+
+        :param int pc: address of the block
+        :rtype: list[tuple]
+        '''
+        block = []
+        address = pc
+        while len(block) < self.max_block_size:
+            try:
+                insn = self.decode_instruction(address)
+            except (CpuException, MemoryException):
+                if not block:
+                    raise
+                break
+            block.append((insn, getattr(self, self.canonicalize_instruction_name(insn), None)))
+            address += insn.size
+            if not _BLOCK_END_GROUPS.isdisjoint(insn.groups):
+                break
+        self._block_cache[pc] = block
+        self._add_code(pc, pc, address - pc)
+        return block
+
+    def _execute_instruction(self, insn, implementation):
+        '''
+        Execute a decoded instruction with its implementation, or emulate it
+        if there is none.
+        '''
         if logger.level == logging.DEBUG:
             logger.debug(self.render_instruction(insn))
             for l in self.render_registers():
                 register_logger.debug(l)
 
         try:
-            implementation = getattr(self, name, None)
-
             if implementation is not None:
                 implementation(*insn.operands)
 
@@ -865,7 +1061,26 @@ class Cpu(Eventful):
         Notify listeners that an instruction has been executed.
         '''
         self._icount += 1
-        self._publish('did_execute_instruction', self._last_pc, self.PC, insn)
+        if self._is_subscribed('did_execute_instruction'):
+            self._publish('did_execute_instruction', self._last_pc, self.PC, insn)
+
+    def _run_concrete(self):
+        '''
+        Run concrete code in Unicorn from the current PC, until it reaches
+        symbolic data or an instruction better left to the models.
+
+        :return: whether any instruction was executed
+        '''
+        # Like the fallback emulator, it is kept for the following runs and
+        # not pickled with the cpu
+        if self._concrete_emulator is None or self._concrete_emulator.stale:
+            self._concrete_emulator = ConcreteUnicornEmulator(self)
+        emu = self._concrete_emulator
+        executed = emu.run()
+        if executed:
+            self._icount += executed
+            self._last_pc = emu.last_pc
+        return executed > 0
 
     def emulate(self, insn):
         '''
@@ -875,20 +1090,18 @@ class Cpu(Eventful):
         :param capstone.CsInsn instruction: The instruction object to emulate
         '''
 
-        emu = UnicornEmulator(self)
+        # The emulator is kept for the following instructions, it is not
+        # pickled with the cpu
+        if self._emulator is None or self._emulator.stale:
+            self._emulator = UnicornEmulator(self)
         try:
-            emu.emulate(insn)
+            self._emulator.emulate(insn)
         except unicorn.UcError as e:
             if e.errno == unicorn.UC_ERR_INSN_INVALID:
                 text_bytes = ' '.join('%02x' % x for x in insn.bytes)
                 logger.error("Unimplemented instruction: 0x%016x:\t%s\t%s\t%s",
                              insn.address, text_bytes, insn.mnemonic, insn.op_str)
             raise InstructionEmulationError(str(e))
-        finally:
-            # We have been seeing occasional Unicorn issues with it not clearing
-            # the backing unicorn instance. Saw fewer issues with the following
-            # line present.
-            del emu
 
     def render_instruction(self, insn=None):
         try:
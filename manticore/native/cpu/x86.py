@@ -752,17 +752,6 @@ class X86Cpu(Cpu):
         cpu.STACK = cpu.STACK + size // 8
         return value
 
-    ################################################
-    # This its unused but shouldn't be deleted!!!
-    # The instruction cache must be invalidated after an executable
-    # page was changed or removed or added
-    def invalidate_cache(cpu, address, size):
-        ''' remove decoded instruction from instruction cache '''
-        cache = cpu.instruction_cache
-        for offset in range(size):
-            if address + offset in cache:
-                del cache[address + offset]
-
     def canonicalize_instruction_name(self, instruction):
         # MOVSD
         if instruction.opcode[0] in (0xa4, 0xa5):
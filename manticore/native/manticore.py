@@ -5,7 +5,9 @@ import os
 from elftools.elf.elffile import ELFFile
 from elftools.elf.sections import SymbolTableSection
 
+from .memory import symbolic_read_stats
 from .state import State
+from ..core.executor import stats_sources
 from ..core.manticore import ManticoreBase
 from ..core.smtlib import ConstraintSet
 from ..utils import log, config
@@ -16,6 +18,8 @@ log.init_logging()
 
 consts = config.get_group('main')
 
+stats_sources.append(symbolic_read_stats)
+
 
 class Manticore(ManticoreBase):
     def __init__(self, path_or_state, argv=None, workspace_url=None, policy='random', **kwargs):
@@ -33,6 +37,21 @@ class Manticore(ManticoreBase):
 
         super().__init__(initial_state, workspace_url=workspace_url, policy=policy, **kwargs)
 
+        self._executor.subscribe('did_load_state', self._install_hooks_callback)
+
+    def _install_hooks_callback(self, state, state_id):
+        ''' Points the cpus of a loaded state to the addresses of the hooks '''
+        for cpu in state.platform.procs:
+            cpu.hooked_pcs = self._hooked_pcs
+
+    def _did_finish_run_callback(self):
+        super()._did_finish_run_callback()
+        stats = self.context.get('run_stats', {})
+        reads = {strategy: stats.get(f'symbolic_reads_{strategy}', 0) for strategy in ('ite', 'array', 'fork')}
+        if any(reads.values()):
+            logger.info('Reads from symbolic addresses: %d if-then-else, %d array, %d forked',
+                        reads['ite'], reads['array'], reads['fork'])
+
     @classmethod
     def linux(cls, path, argv=None, envp=None, entry_symbol=None, symbolic_files=None, concrete_start='', pure_symbolic=False, stdin_size=consts.stdin_size, **kwargs):
         """
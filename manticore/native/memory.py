@@ -1,14 +1,32 @@
 from abc import ABCMeta, abstractmethod
-from weakref import WeakValueDictionary
-from ..core.smtlib import Operators, ConstraintSet, arithmetic_simplify, solver, TooManySolutions, BitVec, BitVecConstant, expression
+from bisect import bisect_left, bisect_right
+from ..core.smtlib import Operators, ConstraintSet, arithmetic_simplify, solver, TooManySolutions, BitVec, BitVecConstant, Expression, expression
 from ..native.mappings import mmap, munmap
-from ..utils.helpers import issymbolic, interval_intersection
+from ..utils.helpers import issymbolic, interval_intersection, IntervalSet
+from ..utils import config
 
 import functools
 import logging
+from weakref import WeakSet
 
 logger = logging.getLogger(__name__)
 
+consts = config.get_group('memory')
+consts.add('symbolic_ite_max', default=16,
+           description='Reads from symbolic addresses with up to this many solutions are if-then-else expressions '
+                       'over the solutions')
+consts.add('symbolic_array_max', default=0x1000,
+           description='Reads from symbolic addresses with more solutions, spanning up to this many bytes, are selects '
+                       'over an array of the bytes in the span. Wider reads fork the state')
+
+# Number of reads from symbolic addresses done with each strategy in this process
+symbolic_reads = {'ite': 0, 'array': 0, 'fork': 0}
+
+
+def symbolic_read_stats():
+    ''' Returns the counters of the symbolic address read strategies of this process '''
+    return {f'symbolic_reads_{strategy}': count for strategy, count in symbolic_reads.items()}
+
 
 class MemoryException(Exception):
     '''
@@ -83,6 +101,10 @@ def _normalize(c):
         return c
 
 
+# The canonical byte of each value, to convert concrete data without a call per byte
+_BYTES = tuple(bytes([c]) for c in range(256))
+
+
 class Map(object, metaclass=ABCMeta):
     '''
     A memory map.
@@ -95,6 +117,9 @@ class Map(object, metaclass=ABCMeta):
                 start                                 end
 
     '''
+    # Saved as a separate blob in the workspace, so the states forked from the
+    # same parent share the maps left unchanged
+    _snapshot_blob = True
 
     def __init__(self, start, size, perms, name=None):
         '''
@@ -240,11 +265,31 @@ class Map(object, metaclass=ABCMeta):
         :param address: The address at which to split the Map.
         '''
 
+    def concrete(self, index):
+        '''
+        Reads a range of addresses as a bytes-like object, if none of its
+        bytes is symbolic
+
+        :param slice index: the range of addresses to read.
+        :return: the bytes in the range, or None if any of them is symbolic.
+        '''
+        values = self[index]
+        if any(issymbolic(value) for value in values):
+            return None
+        return b''.join(values)
+
 
 class AnonMap(Map):
-    ''' A concrete anonymous memory map '''
+    '''
+    A concrete anonymous memory map.
+
+    The contents are kept in a bytearray. The symbolic bytes written to the map
+    are kept apart, in a sparse overlay by page, so they do not change how the
+    concrete bytes are stored and read.
+    '''
+    page_bit_size = 12
 
-    def __init__(self, start, size, perms, data_init=None, name=None, **kwargs):
+    def __init__(self, start, size, perms, data_init=None, name=None, symbols=None, **kwargs):
         '''
         Builds a concrete anonymous memory map.
 
@@ -252,19 +297,20 @@ class AnonMap(Map):
         :param size: the size of the map.
         :param perms: the access permissions of the map.
         :param data_init: the data to initialize the map.
+        :param symbols: the symbolic bytes of the map, by page and offset.
         '''
         super().__init__(start, size, perms, name, **kwargs)
         self._data = bytearray(size)
-        if data_init is not None:
+        # {page: {offset: symbolic byte}}, offsets from the start of the map
+        self._symbols = {}
+        if data_init is not None and len(data_init):
             assert len(data_init) <= size, 'More initial data than reserved memory'
-            # check that the values this slice points to are ints
-            if isinstance(data_init[0], int):
-                self._data[0:len(data_init)] = data_init
-            else:
-                self._data[0:len(data_init)] = [ord(s) for s in data_init]
+            self._write(0, data_init)
+        if symbols:
+            self._symbols = {page: dict(overlay) for page, overlay in symbols.items()}
 
     def __reduce__(self):
-        return (self.__class__, (self.start, len(self), self.perms, self._data, self.name))
+        return (self.__class__, (self.start, len(self), self.perms, self._data, self.name, self._symbols))
 
     def split(self, address):
         if address <= self.start:
@@ -273,33 +319,107 @@ class AnonMap(Map):
             return self, None
 
         assert address > self.start and address < self.end
-        head = AnonMap(self.start, address - self.start, self.perms, self[self.start:address])
-        tail = AnonMap(address, self.end - address, self.perms, self[address:self.end])
+        offset = address - self.start
+        head = AnonMap(self.start, offset, self.perms, self._data[:offset])
+        tail = AnonMap(address, self.end - address, self.perms, self._data[offset:])
+        for overlay in self._symbols.values():
+            for index, value in overlay.items():
+                if index < offset:
+                    head._write_symbol(index, value)
+                else:
+                    tail._write_symbol(index - offset, value)
         return head, tail
 
+    def _write_symbol(self, offset, value):
+        self._symbols.setdefault(offset >> self.page_bit_size, {})[offset] = Operators.ORD(value)
+
+    def _clear_symbols(self, start, stop):
+        ''' Removes the symbolic bytes in the offsets [start, stop) '''
+        first, last = start >> self.page_bit_size, (stop - 1) >> self.page_bit_size
+        for page in [page for page in self._symbols if first <= page <= last]:
+            overlay = self._symbols[page]
+            if start <= page << self.page_bit_size and (page + 1) << self.page_bit_size <= stop:
+                del self._symbols[page]
+                continue
+            for index in [index for index in overlay if start <= index < stop]:
+                del overlay[index]
+            if not overlay:
+                del self._symbols[page]
+
+    def _write(self, offset, value):
+        '''
+        Writes a sequence of bytes at an offset of the map. The concrete bytes
+        are written in bulk, only the symbolic ones go one by one.
+        '''
+        stop = offset + len(value)
+        if self._symbols:
+            self._clear_symbols(offset, stop)
+        if isinstance(value, str):
+            data = value.encode('latin-1')
+        elif isinstance(value, (bytes, bytearray)):
+            data = value
+        else:
+            try:
+                data = b''.join(value)
+            except TypeError:
+                # Symbolic bytes, or ints
+                data = None
+        if data is not None and len(data) == stop - offset:
+            self._data[offset:stop] = data
+            return
+
+        for index, byte in enumerate(value, offset):
+            if issymbolic(byte):
+                self._write_symbol(index, byte)
+            else:
+                self._data[index] = Operators.ORD(byte)
+
     def __setitem__(self, index, value):
         assert not isinstance(index, slice) or \
             len(value) == index.stop - index.start
         index = self._get_offset(index)
 
-        if issymbolic(value[0]) and isinstance(self._data, bytearray):
-            self._data = [Operators.ORD(b) for b in self._data]  # completely convert everything to a list if we need to store some symbolic data, just copying fpse
-
         if isinstance(index, slice):
-            if not isinstance(value[0], int):
-                value = [Operators.ORD(n) for n in value]
-            self._data[index] = value
+            self._write(index.start, value)
+        elif issymbolic(value):
+            self._write_symbol(index, value)
         else:
+            if self._symbols:
+                self._clear_symbols(index, index + 1)
             self._data[index] = Operators.ORD(value)
 
     def __getitem__(self, index):
         index = self._get_offset(index)
         if isinstance(index, slice):
-            return [Operators.CHR(i) for i in self._data[index]]
-        return Operators.CHR(self._data[index])
+            start, stop = index.start, index.stop
+            result = list(map(_BYTES.__getitem__, memoryview(self._data)[start:stop]))
+            first, last = start >> self.page_bit_size, (stop - 1) >> self.page_bit_size
+            for page, overlay in self._symbols.items():
+                if first <= page <= last:
+                    for offset, value in overlay.items():
+                        if start <= offset < stop:
+                            result[offset - start] = value
+            return result
+
+        overlay = self._symbols.get(index >> self.page_bit_size)
+        if overlay is not None and index in overlay:
+            return overlay[index]
+        return _BYTES[self._data[index]]
+
+    def concrete(self, index):
+        index = self._get_offset(index)
+        start, stop = index.start, index.stop
+        first, last = start >> self.page_bit_size, (stop - 1) >> self.page_bit_size
+        for page, overlay in self._symbols.items():
+            if first <= page <= last and any(start <= offset < stop for offset in overlay):
+                return None
+        return memoryview(self._data)[start:stop]
 
 
 class ArrayMap(Map):
+    # The array is shared with the memory (see LazySMemory.backing_array)
+    _snapshot_blob = False
+
     def __init__(self, address, size, perms, index_bits, backing_array=None, name=None, **kwargs):
         super(ArrayMap, self).__init__(address, size, perms)
         if name is None:
@@ -318,6 +438,9 @@ class ArrayMap(Map):
     def __getitem__(self, key):
         return self._array[key]
 
+    def concrete(self, index):
+        return None
+
     def split(self, address):
         if address <= self.start:
             return None, self
@@ -406,13 +529,38 @@ class FileMap(Map):
 
         index = self._get_offset(index)
         if isinstance(index, slice):
-            result = []
-            for i in range(index.start, index.stop):
-                result.append(get_byte_at_offset(i))
+            start, stop = index.start, index.stop
+            result = [bytes([c]) for c in self._data[start:min(stop, self._mapped_size)]]
+            result.extend([b'\x00'] * (stop - start - len(result)))
+            if len(self._overlay) < stop - start:
+                overlay = ((offset, value) for offset, value in self._overlay.items() if start <= offset < stop)
+            else:
+                overlay = ((offset, self._overlay[offset]) for offset in range(start, stop) if offset in self._overlay)
+            for offset, value in overlay:
+                result[offset - start] = _normalize(value)
             return result
         else:
             return get_byte_at_offset(index)
 
+    def concrete(self, index):
+        offsets = self._get_offset(index)
+        start, stop = offsets.start, offsets.stop
+        # Past the end of the file the map is zeroed
+        mapped = max(start, min(stop, self._mapped_size))
+        data = self._data[start:mapped] + bytes(stop - mapped)
+        if len(self._overlay) < stop - start:
+            overlay = [(offset, value) for offset, value in self._overlay.items() if start <= offset < stop]
+        else:
+            overlay = [(offset, self._overlay[offset]) for offset in range(start, stop) if offset in self._overlay]
+        if not overlay:
+            return data
+        data = bytearray(data)
+        for offset, value in overlay:
+            if issymbolic(value):
+                return None
+            data[offset - start] = _normalize(value)[0]
+        return data
+
     def split(self, address):
         if address <= self.start:
             return None, self
@@ -465,11 +613,11 @@ class COWMap(Map):
         assert self._in_range(index)
 
         if isinstance(index, slice):
-            result = []
+            result = self._parent[index]
             for i in range(index.start, index.stop):
-                c = self._cow.get(i, self._parent[i])
-                result.append(_normalize(c))
-            return result
+                if i in self._cow:
+                    result[i - index.start] = self._cow[i]
+            return [_normalize(c) for c in result]
         else:
             return _normalize(self._cow.get(index, self._parent[index]))
 
@@ -500,12 +648,20 @@ class Memory(object, metaclass=ABCMeta):
             self._maps = set()
         else:
             self._maps = set(maps)
-        self._page2map = WeakValueDictionary()  # {page -> ref{MAP}}
+        # The maps sorted by address, and their start addresses, to look them up by bisection
+        self._sorted_maps = sorted(self._maps, key=lambda m: m.start)
+        self._starts = [m.start for m in self._sorted_maps]
+        # The last map looked up, as most accesses are to the same map as the previous one
+        self._last_map = None
+        # Bumped on every mapping change (mmap, munmap, mprotect)
+        self._maps_version = 0
+        # Objects caching the code decoded from this memory, see watch_code
+        self._code_watchers = WeakSet()
+        # Objects keeping a copy of the contents of the maps, see watch_writes
+        self._write_watchers = WeakSet()
         self._recording_stack = []
-        for m in self._maps:
-            for i in range(self._page(m.start), self._page(m.end)):
-                assert i not in self._page2map
-                self._page2map[i] = m
+        for prev, m in zip(self._sorted_maps, self._sorted_maps[1:]):
+            assert prev.end <= m.start
 
     def __reduce__(self):
         return (self.__class__, (self._maps, ))
@@ -569,13 +725,12 @@ class Memory(object, metaclass=ABCMeta):
         '''
         return address >> self.page_bit_size
 
-    def _search(self, size, start=None, counter=0):
+    def _search(self, size, start=None):
         '''
-        Recursively searches the address space for enough free space to allocate C{size} bytes.
+        Searches the address space for enough free space to allocate C{size} bytes.
 
         :param size: the size in bytes to allocate.
         :param start: an address from where to start the search.
-        :param counter: internal parameter to know if all the memory was already scanned.
         :return: the address of an available space to map C{size} bytes.
         :raises MemoryException: if there is no space available to allocate the desired memory.
         :rtype: int
@@ -586,25 +741,21 @@ class Memory(object, metaclass=ABCMeta):
         assert size & self.page_mask == 0
         if start is None:
             end = {32: 0xf8000000, 64: 0x0000800000000000}[self.memory_bit_size]
-            start = end - size
         else:
             if start > self.memory_size - size:
                 start = self.memory_size - size
             end = start + size
 
-        consecutive_free = 0
-        for p in range(self._page(end - 1), -1, -1):
-            if p not in self._page2map:
-                consecutive_free += 0x1000
-            else:
-                consecutive_free = 0
-            if consecutive_free >= size:
-                return p << self.page_bit_size
-            counter += 1
-            if counter >= self.memory_size // self.page_size:
-                raise MemoryException('Not enough memory')
+        # The highest free space ending below `end`, or else below the end of memory
+        for top in (end, self.memory_size):
+            i = bisect_left(self._starts, top) - 1
+            while top >= size:
+                if i < 0 or self._sorted_maps[i].end <= top - size:
+                    return top - size
+                top = self._sorted_maps[i].start
+                i -= 1
 
-        return self._search(size, self.memory_size - size, counter)
+        raise MemoryException('Not enough memory')
 
     def mmapFile(self, addr, size, perms, filename, offset=0):
         '''
@@ -641,8 +792,7 @@ class Memory(object, metaclass=ABCMeta):
         addr = self._search(size, addr)
 
         # It should not be allocated
-        for i in range(self._page(addr), self._page(addr + size)):
-            assert i not in self._page2map, 'Map already used'
+        assert not self._maps_in_range(addr, addr + size), 'Map already used'
 
         # Create the map
         m = FileMap(addr, size, perms, filename, offset)
@@ -686,8 +836,7 @@ class Memory(object, metaclass=ABCMeta):
         addr = self._search(size, addr)
 
         # It should not be allocated
-        for i in range(self._page(addr), self._page(addr + size)):
-            assert i not in self._page2map, 'Map already used'
+        assert not self._maps_in_range(addr, addr + size), 'Map already used'
 
         # Create the anonymous map
         m = AnonMap(start=addr, size=size, perms=perms, data_init=data_init, name=name)
@@ -704,18 +853,67 @@ class Memory(object, metaclass=ABCMeta):
         assert m.start & self.page_mask == 0
         assert m.end & self.page_mask == 0
         self._maps.add(m)
-        # updating the page to map translation
-        for i in range(self._page(m.start), self._page(m.end)):
-            self._page2map[i] = m
+        self._maps_version += 1
+        i = bisect_left(self._starts, m.start)
+        assert i == 0 or self._sorted_maps[i - 1].end <= m.start, 'Map already used'
+        assert i == len(self._starts) or self._starts[i] >= m.end, 'Map already used'
+        self._starts.insert(i, m.start)
+        self._sorted_maps.insert(i, m)
 
     def _del(self, m):
         assert isinstance(m, Map)
         assert m in self._maps
-        # remove m pages from the page2maps..
-        for p in range(self._page(m.start), self._page(m.end)):
-            del self._page2map[p]
+        i = bisect_left(self._starts, m.start)
+        assert self._sorted_maps[i] is m
+        del self._starts[i]
+        del self._sorted_maps[i]
+        if self._last_map is m:
+            self._last_map = None
         # remove m from the maps set
         self._maps.remove(m)
+        self._maps_version += 1
+        if 'x' in m.perms and self._code_watchers:
+            self._code_changed(m.start, m.end)
+
+    def watch_code(self, watcher):
+        '''
+        Registers an object caching code decoded from this memory. Its
+        invalidate_cache(address, size) method is called on writes to executable
+        maps, and when they are unmapped or change permissions. The watcher is
+        weakly referenced, and not pickled with the memory.
+
+        :param watcher: the object to notify, usually a Cpu
+        '''
+        self._code_watchers.add(watcher)
+
+    def watch_writes(self, watcher):
+        '''
+        Registers an object keeping a copy of the contents of the maps of this
+        memory. Its memory_written(address, size) method is called on every
+        write to a map. The watcher is weakly referenced, and not pickled with
+        the memory.
+
+        :param watcher: the object to notify, usually a Unicorn emulator
+        '''
+        self._write_watchers.add(watcher)
+
+    def _code_changed(self, start, end):
+        for watcher in list(self._code_watchers):
+            watcher.invalidate_cache(start, end - start)
+
+    def _map_written(self, start, end):
+        for watcher in list(self._write_watchers):
+            watcher.memory_written(start, end - start)
+
+    def _write_code(self, start, end):
+        '''
+        Notifies the code watchers of a write to the executable maps in
+        [start, end), for writes that do not go through a map.
+        '''
+        if self._code_watchers:
+            for m in self._maps_in_range(start, end):
+                if 'x' in m.perms:
+                    self._code_changed(max(start, m.start), min(end, m.end))
 
     def map_containing(self, address):
         '''
@@ -726,10 +924,25 @@ class Memory(object, metaclass=ABCMeta):
 
         @todo: symbolic address
         '''
-        page_offset = self._page(address)
-        if page_offset not in self._page2map:
+        m = self._map_at(address)
+        if m is None:
             raise MemoryException("Page not mapped", address)
-        return self._page2map[page_offset]
+        return m
+
+    def _map_at(self, address):
+        '''
+        Returns the map containing the address, or None.
+        '''
+        m = self._last_map
+        if m is not None and m.start <= address < m.end:
+            return m
+        i = bisect_right(self._starts, address) - 1
+        if i >= 0:
+            m = self._sorted_maps[i]
+            if address < m.end:
+                self._last_map = m
+                return m
+        return None
 
     def mappings(self):
         '''
@@ -754,18 +967,13 @@ class Memory(object, metaclass=ABCMeta):
 
     def _maps_in_range(self, start, end):
         '''
-        Generates the list of maps that overlaps with the range [start:end]
+        Returns the list of maps that overlap with the range [start:end]
         '''
-
-        # Search for the first matching map
-        addr = start
-        while addr < end:
-            if addr not in self:
-                addr += self.page_size
-            else:
-                m = self._page2map[self._page(addr)]
-                yield m
-                addr = m.end
+        i = bisect_right(self._starts, start) - 1
+        if i < 0 or self._sorted_maps[i].end <= start:
+            i += 1
+        j = bisect_left(self._starts, end)
+        return self._sorted_maps[i:j]
 
     def munmap(self, start, size):
         '''
@@ -813,7 +1021,7 @@ class Memory(object, metaclass=ABCMeta):
 
     # Permissions
     def __contains__(self, address):
-        return self._page(address) in self._page2map
+        return self._map_at(address) is not None
 
     def perms(self, index):
         # not happy with this interface.
@@ -912,9 +1120,72 @@ class Memory(object, metaclass=ABCMeta):
             m = self.map_containing(addr)
             size = min(m.end - addr, stop - addr)
             m[addr:addr + size] = buf[addr - start:addr - start + size]
+            if 'x' in m.perms and self._code_watchers:
+                self._code_changed(addr, addr + size)
+            if self._write_watchers:
+                self._map_written(addr, addr + size)
             addr += size
         assert addr == stop
 
+    def _int_map(self, address, size, access, force=False):
+        '''
+        Returns the map holding all the bytes in [address, address + size) if
+        the access is allowed, and they can be accessed from the map alone.
+
+        :rtype: Map or None
+        '''
+        if not isinstance(address, int):
+            return None
+        m = self._map_at(address)
+        if m is None or address + size > m.end or not (force or m.access_ok(access)):
+            return None
+        return m
+
+    def read_int(self, address, size, force=False):
+        '''
+        Reads a little endian integer from memory. If the bytes are concrete and
+        in a single map, the integer is read from them directly, otherwise it
+        is the concatenation of the bytes read.
+
+        :param address: the address to read from.
+        :param int size: the size of the integer in bits.
+        :param force: whether to ignore memory permissions.
+        :return: the value read.
+        :rtype: int or BitVec
+        '''
+        m = self._int_map(address, size // 8, 'r', force)
+        if m is not None:
+            data = m.concrete(slice(address, address + size // 8))
+            if data is not None:
+                return int.from_bytes(data, 'little')
+        data = self.read(address, size // 8, force)
+        return Operators.CONCAT(size, *map(Operators.ORD, reversed(data)))
+
+    def write_int(self, address, value, size, force=False):
+        '''
+        Writes a little endian integer to memory. A concrete integer is written
+        to the map holding it in a single slice, when there is one.
+
+        :param address: the address to write to.
+        :param value: the value to write.
+        :type value: int or BitVec
+        :param int size: the size of the integer in bits.
+        :param force: whether to ignore memory permissions.
+        '''
+        if isinstance(value, int):
+            m = self._int_map(address, size // 8, 'w', force)
+            if m is not None:
+                data = (value & ((1 << size) - 1)).to_bytes(size // 8, 'little')
+                if self._recording_stack:
+                    self._recording_stack[-1].append((address, list(map(_BYTES.__getitem__, data))))
+                m[address:address + size // 8] = data
+                if 'x' in m.perms and self._code_watchers:
+                    self._code_changed(address, address + size // 8)
+                if self._write_watchers:
+                    self._map_written(address, address + size // 8)
+                return
+        self.write(address, [Operators.CHR(Operators.EXTRACT(value, offset, 8)) for offset in range(0, size, 8)], force)
+
     def _get_size(self, size):
         return size
 
@@ -937,11 +1208,8 @@ class Memory(object, metaclass=ABCMeta):
         """
         Iterate all valid addresses
         """
-        for page_addr in sorted(self._page2map.keys()):
-            start = page_addr * self.page_size
-            end = start + self.page_size
-            for addr in range(start, end):
-                yield addr
+        for m in list(self._sorted_maps):
+            yield from range(m.start, m.end)
 
 
 class SMemory(Memory):
@@ -966,9 +1234,25 @@ class SMemory(Memory):
             self._symbols = {}
         else:
             self._symbols = dict(symbols)
+        # The array symbolic reads select from (see _read_array), created on
+        # the first one
+        self._read_array_proxy = None
+        # Addresses whose current contents are in the array
+        self._read_array_imported = IntervalSet()
+        # Addresses constrained on the array variable. Once constrained,
+        # importing them again takes a store
+        self._read_array_constrained = IntervalSet()
 
     def __reduce__(self):
-        return (self.__class__, (self.constraints, self._symbols, self._maps, ))
+        return (self.__class__, (self.constraints, self._symbols, self._maps, ),
+                {'read_array': self._read_array_proxy,
+                 'read_array_imported': self._read_array_imported,
+                 'read_array_constrained': self._read_array_constrained})
+
+    def __setstate__(self, state):
+        self._read_array_proxy = state['read_array']
+        self._read_array_imported = state['read_array_imported']
+        self._read_array_constrained = state['read_array_constrained']
 
     @property
     def constraints(self):
@@ -978,6 +1262,12 @@ class SMemory(Memory):
     def constraints(self, constraints):
         self._constraints = constraints
 
+    def _int_map(self, address, size, access, force=False):
+        if self._symbols and isinstance(address, int) and \
+                any(address + offset in self._symbols for offset in range(size)):
+            return None
+        return super()._int_map(address, size, access, force)
+
     def _get_size(self, size):
         if isinstance(size, BitVec):
             size = arithmetic_simplify(size)
@@ -1000,6 +1290,7 @@ class SMemory(Memory):
                 break
             if addr in self._symbols:
                 del self._symbols[addr]
+        self._read_array_imported.remove(self._floor(start), self._ceil(start + size))
         super().munmap(start, size)
 
     def read(self, address, size, force=False):
@@ -1019,10 +1310,16 @@ class SMemory(Memory):
             assert solver.check(self.constraints)
             logger.debug(f'Reading {size} bytes from symbolic address {address}')
             try:
-                solutions = self._try_get_solutions(address, size, 'r', force=force)
+                solutions = self._try_get_solutions(address, size, 'r', max_solutions=consts.symbolic_ite_max,
+                                                    force=force)
                 assert len(solutions) > 0
             except TooManySolutions as e:
                 m, M = solver.minmax(self.constraints, address)
+                if M + size - m <= consts.symbolic_array_max:
+                    symbolic_reads['array'] += 1
+                    return self._read_array(address, size, m, M + size, force)
+
+                symbolic_reads['fork'] += 1
                 logger.debug(f'Got TooManySolutions on a symbolic read. Range [{m:x}, {M:x}]. Not crashing!')
 
                 # The force param shouldn't affect this, as this is checking for unmapped reads, not bad perms
@@ -1040,10 +1337,11 @@ class SMemory(Memory):
                 condition = False
                 for base in e.solutions:
                     condition = Operators.OR(address == base, condition)
-                from .state import ForkState
+                from ..core.state import ForkState
                 raise ForkState("Forking state on incomplete result", condition)
 
             # So here we have all potential solutions to address
+            symbolic_reads['ite'] += 1
 
             condition = False
             for base in solutions:
@@ -1066,15 +1364,77 @@ class SMemory(Memory):
                     assert len(result) == offset + 1
             return list(map(Operators.CHR, result))
         else:
-            result = list(map(Operators.ORD, super().read(address, size, force)))
-            for offset in range(size):
-                if address + offset in self._symbols:
-                    for condition, value in self._symbols[address + offset]:
-                        if condition is True:
-                            result[offset] = Operators.ORD(value)
-                        else:
-                            result[offset] = Operators.ITEBV(8, condition, Operators.ORD(value), result[offset])
-            return list(map(Operators.CHR, result))
+            result = super().read(address, size, force)
+            if len(self._symbols) < size:
+                offsets = [addr - address for addr in self._symbols if address <= addr < address + size]
+            else:
+                offsets = [offset for offset in range(size) if address + offset in self._symbols]
+            for offset in offsets:
+                byte = Operators.ORD(result[offset])
+                for condition, value in self._symbols[address + offset]:
+                    if condition is True:
+                        byte = Operators.ORD(value)
+                    else:
+                        byte = Operators.ITEBV(8, condition, Operators.ORD(value), byte)
+                result[offset] = Operators.CHR(byte)
+            return result
+
+    def _read_array(self, address, size, start, end, force=False):
+        '''
+        Read a stream of bytes from a symbolic address as selects over the
+        array of the memory. The bytes of the maps in [start, end), the range
+        the address can reach, are imported into the array unless they were
+        already imported and not written since. They are constrained on the
+        array variable the first time, rather than stored, as solvers handle
+        long store chains poorly.
+
+        :param address: Where to read from
+        :param size: How many bytes
+        :param start: The lowest address the read can reach
+        :param end: One past the highest address the read can reach
+        :param force: Whether to ignore permissions
+        :rtype: list
+        '''
+        # Contiguous runs of accessible maps in the range
+        runs = []
+        for m in self._maps_in_range(start, end):
+            if not force and 'r' not in m.perms:
+                continue
+            span = interval_intersection(m.start, m.end, start, end)
+            if runs and runs[-1][1] == span[0]:
+                runs[-1][1] = span[1]
+            else:
+                runs.append(list(span))
+
+        valid = False
+        for run_start, run_end in runs:
+            if run_end - run_start >= size:
+                valid = Operators.OR(Operators.AND(Operators.UGE(address, run_start),
+                                                   Operators.ULE(address, run_end - size)), valid)
+        crashing_condition = Operators.NOT(valid)
+        if solver.can_be_true(self.constraints, crashing_condition):
+            raise InvalidSymbolicMemoryAccess(address, 'r', size, crashing_condition)
+
+        if self._read_array_proxy is None:
+            self._read_array_proxy = self.constraints.new_array(index_bits=self.memory_bit_size, name='memory',
+                                                                avoid_collisions=True)
+        array = self._read_array_proxy
+        variable = array.underlying_variable
+        for run_start, run_end in runs:
+            for gap_start, gap_end in list(self._read_array_imported.gaps(run_start, run_end)):
+                values = self.read(gap_start, gap_end - gap_start, force=True)
+                stored = gap_start
+                for fresh_start, fresh_end in list(self._read_array_constrained.gaps(gap_start, gap_end)):
+                    for addr in range(stored, fresh_start):
+                        array[addr] = Operators.ORD(values[addr - gap_start])
+                    for addr in range(fresh_start, fresh_end):
+                        self.constraints.add(variable.select(addr) == Operators.ORD(values[addr - gap_start]))
+                    self._read_array_constrained.add(fresh_start, fresh_end)
+                    stored = fresh_end
+                for addr in range(stored, gap_end):
+                    array[addr] = Operators.ORD(values[addr - gap_start])
+                self._read_array_imported.add(gap_start, gap_end)
+        return [Operators.CHR(array[address + offset]) for offset in range(size)]
 
     def write(self, address, value, force=False):
         '''
@@ -1090,12 +1450,20 @@ class SMemory(Memory):
 
             solutions = self._try_get_solutions(address, size, 'w', force=force)
 
+            for base in solutions:
+                self._read_array_imported.remove(base, base + size)
             for offset in range(size):
                 for base in solutions:
                     condition = base == address
                     self._symbols.setdefault(base + offset, []).append((condition, value[offset]))
-        else:
+            for base in solutions:
+                self._write_code(base, base + size)
+            return
 
+        self._read_array_imported.remove(address, address + size)
+        if not self.access_ok(slice(address, address + size), 'w', force):
+            # Write byte by byte up to the faulting address
+            self._write_code(address, address + size)
             for offset in range(size):
                 if issymbolic(value[offset]):
                     if not self.access_ok(address + offset, 'w', force):
@@ -1106,6 +1474,32 @@ class SMemory(Memory):
                     if address + offset in self._symbols:
                         del self._symbols[address + offset]
                     super().write(address + offset, [value[offset]], force)
+        else:
+            # Write the runs of concrete bytes in bulk
+            symbolic = [offset for offset, byte in enumerate(value) if isinstance(byte, Expression)]
+            if symbolic:
+                self._write_code(address, address + size)
+            if len(self._symbols) < size:
+                # overwrite all previous items
+                for addr in [addr for addr in self._symbols if address <= addr < address + size]:
+                    del self._symbols[addr]
+            else:
+                for offset in range(size):
+                    self._symbols.pop(address + offset, None)
+            start = 0
+            for offset in symbolic:
+                if start < offset:
+                    super().write(address + start, list(value[start:offset]), force)
+                self._symbols[address + offset] = [(True, value[offset])]
+                start = offset + 1
+            if start < size:
+                super().write(address + start, list(value[start:]), force)
+
+    def write_int(self, address, value, size, force=False):
+        # The concrete fast path writes to the map, not through write
+        if isinstance(address, int):
+            self._read_array_imported.remove(address, address + size // 8)
+        super().write_int(address, value, size, force)
 
     def _try_get_solutions(self, address, size, access, max_solutions=0x1000, force=False):
         '''
@@ -1137,70 +1531,43 @@ class LazySMemory(SMemory):
     '''
     A fully symbolic memory.
 
+    Reads and writes through symbolic addresses go to backing_array. The
+    concrete contents of the memory they can reach are imported into the
+    array first, a map at a time.
+
     Currently does not support cross-page reads/writes.
     '''
 
     def __init__(self, constraints, *args, **kwargs):
         super(LazySMemory, self).__init__(constraints, *args, **kwargs)
         self.backing_array = constraints.new_array(index_bits=self.memory_bit_size)
-        self.backed_by_symbolic_store = set()
+        # Addresses that writes through symbolic addresses may have changed.
+        # They are read from backing_array
+        self.backed_by_symbolic_store = IntervalSet()
+        # Addresses whose concrete contents are in backing_array
+        self._imported = IntervalSet()
+        # Addresses constrained on the array variable under backing_array. Once
+        # constrained, importing them again takes a store
+        self._constrained = IntervalSet()
 
     def __reduce__(self):
         return (self.__class__, (self.constraints, self._symbols, self._maps),
                 {'backing_array': self.backing_array,
-                 'backed_by_symbolic_store': self.backed_by_symbolic_store})
+                 'backed_by_symbolic_store': self.backed_by_symbolic_store,
+                 'imported': self._imported,
+                 'constrained': self._constrained})
 
     def __setstate__(self, state):
         self.backing_array = state['backing_array']
         self.backed_by_symbolic_store = state['backed_by_symbolic_store']
+        self._imported = state['imported']
+        self._constrained = state['constrained']
 
-    def mmapFile(self, addr, size, perms, filename, offset=0):
-        '''
-        Creates a new file mapping in the memory address space.
-
-        :param addr: the starting address (took as hint). If C{addr} is C{0} the first big enough
-                     chunk of memory will be selected as starting address.
-        :param size: the contents of a file mapping are initialized using C{size} bytes starting
-                     at offset C{offset} in the file C{filename}.
-        :param perms: the access permissions to this memory.
-        :param filename: the pathname to the file to map.
-        :param offset: the contents of a file mapping are initialized using C{size} bytes starting
-                      at offset C{offset} in the file C{filename}.
-        :return: the starting address where the file was mapped.
-        :rtype: int
-        :raises error:
-                   - 'Address shall be concrete' if C{addr} is not an integer number.
-                   - 'Address too big' if C{addr} goes beyond the limit of the memory.
-                   - 'Map already used' if the piece of memory starting in C{addr} and with length C{size} isn't free.
-        '''
-        # If addr is NULL, the system determines where to allocate the region.
-        assert addr is None or isinstance(addr, int), 'Address shall be concrete'
-        assert addr < self.memory_size, 'Address too big'
-        assert size > 0
-
-        map = AnonMap(addr, size, perms)
-        self._add(map)
-
-        # address is rounded down to the nearest multiple of the allocation granularity
-        if addr is not None:
-            addr = self._floor(addr)
-
-        # size value is rounded up to the next page boundary
-        size = self._ceil(size)
-
-        with open(filename, 'rb') as f:
-            fdata = f.read()  # fdata is a bytes now
-
-        # this worked
-        fdata = fdata[offset:]
-        fdata = fdata.ljust(size, b'\0')
-
-        for i in range(size):
-            Memory.write(self, addr + i, chr(fdata[i]), force=True)
-
-        logger.debug('New file-memory map @%x size:%x', addr, size)
-
-        return addr
+    def munmap(self, start, size):
+        start, end = self._floor(start), self._ceil(start + size)
+        self.backed_by_symbolic_store.remove(start, end)
+        self._imported.remove(start, end)
+        super().munmap(start, size)
 
     def _deref_can_succeed(self, mapping, address, size):
         if not issymbolic(address):
@@ -1211,9 +1578,11 @@ class LazySMemory(SMemory):
 
     def _import_concrete_memory(self, from_addr, to_addr):
         """
-        for each address in this range need to read from concrete and write to symbolic
-        it's possible that there will be invalid/unmapped addresses in this range. need to skip to next map if so
-        also need to mark all of these addresses as now in the symbolic store
+        Copy the concrete contents of the mapped addresses in [from_addr, to_addr)
+        that are not imported yet into backing_array. Each map is read in one
+        slice. The bytes are constrained on the array variable the first time
+        they are imported, rather than stored, as solvers handle long store
+        chains poorly.
 
         :param int from_addr:
         :param int to_addr:
@@ -1221,19 +1590,22 @@ class LazySMemory(SMemory):
         """
         logger.debug("Importing concrete memory: {:x} - {:x} ({} bytes)".format(from_addr, to_addr, to_addr - from_addr))
 
-        for m in self.maps:
+        variable = self.backing_array.underlying_variable
+        for m in self._maps_in_range(from_addr, to_addr):
             span = interval_intersection(m.start, m.end, from_addr, to_addr)
-            if span is None:
-                continue
-
-            start, stop = span
-
-            for addr in range(start, stop):
-                if addr in self.backed_by_symbolic_store:
-                    continue
-
-                self.backing_array[addr] = Memory.read(self, addr, 1)[0]
-                self.backed_by_symbolic_store.add(addr)
+            for start, stop in list(self._imported.gaps(*span)):
+                values = m[start:stop]
+                stored = start
+                for fresh_start, fresh_stop in list(self._constrained.gaps(start, stop)):
+                    for addr in range(stored, fresh_start):
+                        self.backing_array[addr] = values[addr - start]
+                    for addr in range(fresh_start, fresh_stop):
+                        self.constraints.add(variable.select(addr) == Operators.ORD(values[addr - start]))
+                    self._constrained.add(fresh_start, fresh_stop)
+                    stored = fresh_stop
+                for addr in range(stored, stop):
+                    self.backing_array[addr] = values[addr - start]
+                self._imported.add(start, stop)
 
     def _map_deref_expr(self, map, address):
         return Operators.AND(
@@ -1255,21 +1627,26 @@ class LazySMemory(SMemory):
     def invalid_ptr(self, address):
         return Operators.NOT(self.valid_ptr(address))
 
+    def _int_map(self, address, size, access, force=False):
+        if isinstance(address, int) and self.backed_by_symbolic_store.overlaps(address, address + size):
+            return None
+        return super()._int_map(address, size, access, force)
+
     def read(self, address, size, force=False):
 
         access_min, access_max = self._reachable_range(address, size)
 
         if issymbolic(address):
-            self._import_concrete_memory(access_min, access_max)
+            self._import_concrete_memory(access_min, access_max + 1)
 
         retvals = []
         # Not range() because `address` can be symbolic.
         addrs_to_access = [address + i for i in range(size)]
         for addr in addrs_to_access:
 
-            # If the deref is symbolic, or it's backed by a symbolic store on a page
-            # that is writeable, go from backing_array. (if page is r-- or r-x, it would
-            # not have had symbolic data written to it.)
+            # If the deref is symbolic, or it may have been written through a
+            # symbolic address on a page that is writeable, go from backing_array.
+            # (if page is r-- or r-x, it would not have had symbolic data written to it.)
             if issymbolic(addr):
                 from_array = True
             elif addr in self.backed_by_symbolic_store:
@@ -1296,14 +1673,23 @@ class LazySMemory(SMemory):
         if issymbolic(address):
             access_min, access_max = self._reachable_range(address, size)
 
-            self._import_concrete_memory(access_min, access_max)
+            self._import_concrete_memory(access_min, access_max + 1)
 
             for addr, byte in zip(addrs_to_access, value):
                 self.backing_array[addr] = Operators.ORD(byte)
+            for m in self._maps_in_range(access_min, access_max + 1):
+                self.backed_by_symbolic_store.add(*interval_intersection(m.start, m.end, access_min, access_max + 1))
+            self._write_code(access_min, access_max + 1)
         else:
-            self.backed_by_symbolic_store -= set(addrs_to_access)
+            self.backed_by_symbolic_store.remove(address, address + size)
+            self._imported.remove(address, address + size)
             Memory.write(self, address, value)
 
+    def write_int(self, address, value, size, force=False):
+        if isinstance(address, int):
+            self._imported.remove(address, address + size // 8)
+        super().write_int(address, value, size, force)
+
     def scan_mem(self, data_to_find):
         """
         Scan for concrete bytes in all mapped memory. Successively yield addresses of all matches.
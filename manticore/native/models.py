@@ -2,14 +2,35 @@
 Models here are intended to be passed to :meth:`~manticore.native.state.State.invoke_model`, not invoked directly.
 """
 
+import functools
+
 from .cpu.abstractcpu import ConcretizeArgument
+from .memory import MemoryException
+from ..core.state import TerminateState
 from ..utils.helpers import issymbolic
 from ..core.smtlib.solver import solver
-from ..core.smtlib.operators import ITEBV, ZEXTEND
+from ..core.smtlib.operators import AND, EXTRACT, ITEBV, OR, ORD, ZEXTEND
 
 
 VARIADIC_FUNC_ATTR = '_variadic'
 
+# Bytes read at a time while looking for the end of a string
+STRING_CHUNK_SIZE = 64
+
+# Size of the memory maps malloc allocates from. Larger blocks get a map of
+# their own
+HEAP_ARENA_SIZE = 0x100000
+
+# Largest block malloc allocates, the maps are backed by host memory
+MALLOC_MAX_SIZE = 0x40000000
+
+# Largest size a symbolic malloc size is allocated with, the larger sizes it
+# can take are not explored
+MALLOC_SYMBOLIC_MAX = HEAP_ARENA_SIZE
+
+# Alignment of the pointers malloc returns
+HEAP_ALIGNMENT = 16
+
 
 def isvariadic(model):
     """
@@ -32,32 +53,113 @@ def variadic(func):
     return func
 
 
-def _find_zero(cpu, constrs, ptr):
+def _read_bytes(cpu, ptr, size):
+    """
+    Reads `size` bytes in one go, as ints or 8 bit expressions.
+    """
+    return [ORD(byte) for byte in cpu.read_bytes(ptr, size)]
+
+
+def _find_zero(cpu, constrs, ptr, max_length=None):
     """
     Helper for finding the closest NULL or, effectively NULL byte from a starting address.
 
+    The string is read a chunk at a time up to the first concrete NULL. The
+    symbolic bytes before it are checked together in one solver query, and
+    only if they can not all be non NULL at once the first one that ends
+    every possible string is searched for.
+
     :param Cpu cpu:
     :param ConstraintSet constrs: Constraints for current `State`
     :param int ptr: Address to start searching for a zero from
+    :param int max_length: Maximum offset to search up to, or None for no limit
     :return: Offset from `ptr` to first byte that is 0 or an `Expression` that must be zero
     """
 
     offset = 0
-    while True:
-        byt = cpu.read_int(ptr + offset, 8)
-
-        if issymbolic(byt):
-            if not solver.can_be_true(constrs, byt != 0):
-                break
-        else:
-            if byt == 0:
+    # Offsets and non NULL conditions of the symbolic bytes walked over
+    symbolic = []
+    checked = 0
+    found = False
+    while not found and (max_length is None or offset < max_length):
+        size = STRING_CHUNK_SIZE
+        if max_length is not None:
+            size = min(size, max_length - offset)
+        # Do not read past the end of the map holding the string
+        size = min(size, cpu.memory.map_containing(ptr + offset).end - (ptr + offset))
+
+        for byt in _read_bytes(cpu, ptr + offset, size):
+            if issymbolic(byt):
+                symbolic.append((offset, byt != 0))
+            elif byt == 0:
+                found = True
                 break
+            offset += 1
 
-        offset += 1
+        # Query the solver once per chunk that adds symbolic bytes
+        if len(symbolic) > checked:
+            checked = len(symbolic)
+            zero = _first_zero(constrs, symbolic)
+            if zero is not None:
+                return zero
 
     return offset
 
 
+def _first_zero(constrs, symbolic):
+    """
+    Returns the offset of the first symbolic byte such that it or one of
+    the ones before it must be NULL, or None if all of them can be non NULL
+    at once.
+
+    :param ConstraintSet constrs: Constraints for current `State`
+    :param list symbolic: (offset, non NULL condition) of the symbolic bytes
+    """
+    def can_all_be_non_null(count):
+        return solver.can_be_true(constrs, functools.reduce(AND, [condition for _, condition in symbolic[:count]]))
+
+    if can_all_be_non_null(len(symbolic)):
+        return None
+
+    # Bisect for the shortest prefix that can not be all non NULL
+    low, high = 1, len(symbolic)
+    while low < high:
+        middle = (low + high) // 2
+        if can_all_be_non_null(middle):
+            low = middle + 1
+        else:
+            high = middle
+    return symbolic[low - 1][0]
+
+
+def _compare(cpu, bytes1, bytes2):
+    """
+    Compares two lists of bytes as unsigned chars, the way memcmp does.
+
+    Walks from the end to the beginning, building a tree of ITEs each time
+    either of the bytes at the current offset is symbolic and dropping it
+    whenever two concrete bytes differ.
+    """
+    ret = None
+
+    for byte1, byte2 in zip(reversed(bytes1), reversed(bytes2)):
+        s1char = ZEXTEND(byte1, cpu.address_bit_size)
+        s2char = ZEXTEND(byte2, cpu.address_bit_size)
+
+        if issymbolic(s1char) or issymbolic(s2char):
+            if ret is None or (not issymbolic(ret) and ret == 0):
+                ret = s1char - s2char
+            else:
+                ret = ITEBV(cpu.address_bit_size, s1char != s2char, s1char - s2char, ret)
+        else:
+            if s1char != s2char:
+                ret = s1char - s2char
+            elif ret is None:
+                ret = 0
+
+    return 0 if ret is None else ret
+
+
 def strcmp(state, s1, s2):
     """
     strcmp symbolic model.
@@ -91,27 +193,10 @@ def strcmp(state, s1, s2):
         raise ConcretizeArgument(state.cpu, 2)
 
     s1_zero_idx = _find_zero(cpu, state.constraints, s1)
-    s2_zero_idx = _find_zero(cpu, state.constraints, s2)
+    s2_zero_idx = _find_zero(cpu, state.constraints, s2, s1_zero_idx + 1)
     min_zero_idx = min(s1_zero_idx, s2_zero_idx)
 
-    ret = None
-
-    for offset in range(min_zero_idx, -1, -1):
-        s1char = ZEXTEND(cpu.read_int(s1 + offset, 8), cpu.address_bit_size)
-        s2char = ZEXTEND(cpu.read_int(s2 + offset, 8), cpu.address_bit_size)
-
-        if issymbolic(s1char) or issymbolic(s2char):
-            if ret is None or (not issymbolic(ret) and ret == 0):
-                ret = s1char - s2char
-            else:
-                ret = ITEBV(cpu.address_bit_size, s1char != s2char, s1char - s2char, ret)
-        else:
-            if s1char != s2char:
-                ret = s1char - s2char
-            elif ret is None:
-                ret = 0
-
-    return ret
+    return _compare(cpu, _read_bytes(cpu, s1, min_zero_idx + 1), _read_bytes(cpu, s2, min_zero_idx + 1))
 
 
 def strlen(state, s):
@@ -135,9 +220,234 @@ def strlen(state, s):
 
     ret = zero_idx
 
-    for offset in range(zero_idx - 1, -1, -1):
-        byt = cpu.read_int(s + offset, 8)
+    for offset, byt in reversed(list(enumerate(_read_bytes(cpu, s, zero_idx)))):
         if issymbolic(byt):
             ret = ITEBV(cpu.address_bit_size, byt == 0, offset, ret)
 
     return ret
+
+
+def memcmp(state, s1, s2, n):
+    """
+    memcmp symbolic model.
+
+    Algorithm: Reads both buffers at once and walks them from end to beginning
+    the same way as strcmp.
+
+    :param State state: Current program state
+    :param int s1: Address of buffer 1
+    :param int s2: Address of buffer 2
+    :param int n: Number of bytes to compare
+    :return: Symbolic memcmp result
+    :rtype: Expression or int
+    """
+
+    cpu = state.cpu
+
+    if issymbolic(s1):
+        raise ConcretizeArgument(state.cpu, 1)
+    if issymbolic(s2):
+        raise ConcretizeArgument(state.cpu, 2)
+    if issymbolic(n):
+        raise ConcretizeArgument(state.cpu, 3)
+
+    return _compare(cpu, _read_bytes(cpu, s1, n), _read_bytes(cpu, s2, n))
+
+
+def memcpy(state, dest, src, n):
+    """
+    memcpy symbolic model. Copies the potentially symbolic bytes of `src` in
+    one read and one write.
+
+    :param State state: Current program state
+    :param int dest: Address to copy to
+    :param int src: Address to copy from
+    :param int n: Number of bytes to copy
+    :return: `dest`
+    :rtype: int
+    """
+
+    cpu = state.cpu
+
+    if issymbolic(dest):
+        raise ConcretizeArgument(state.cpu, 1)
+    if issymbolic(src):
+        raise ConcretizeArgument(state.cpu, 2)
+    if issymbolic(n):
+        raise ConcretizeArgument(state.cpu, 3)
+
+    cpu.write_bytes(dest, cpu.read_bytes(src, n))
+    return dest
+
+
+def memset(state, s, c, n):
+    """
+    memset symbolic model. `c` can be symbolic.
+
+    :param State state: Current program state
+    :param int s: Address to fill
+    :param c: Value to fill with, converted to an unsigned char
+    :param int n: Number of bytes to fill
+    :return: `s`
+    :rtype: int
+    """
+
+    cpu = state.cpu
+
+    if issymbolic(s):
+        raise ConcretizeArgument(state.cpu, 1)
+    if issymbolic(n):
+        raise ConcretizeArgument(state.cpu, 3)
+
+    byt = EXTRACT(c, 0, 8) if issymbolic(c) else c & 0xff
+    cpu.write_bytes(s, [byt] * n)
+    return s
+
+
+def strncpy(state, dest, src, n):
+    """
+    strncpy symbolic model.
+
+    Algorithm: Copies up to the first byte of `src` that is NULL or must be
+    NULL, and fills the rest of the `n` bytes with NULLs. A copied byte that
+    may come after a symbolic NULL is an ITE choosing NULL in that case.
+
+    :param State state: Current program state
+    :param int dest: Address to copy to
+    :param int src: Address of the string to copy
+    :param int n: Size of `dest`
+    :return: `dest`
+    :rtype: int
+    """
+
+    cpu = state.cpu
+
+    if issymbolic(dest):
+        raise ConcretizeArgument(state.cpu, 1)
+    if issymbolic(src):
+        raise ConcretizeArgument(state.cpu, 2)
+    if issymbolic(n):
+        raise ConcretizeArgument(state.cpu, 3)
+
+    zero_idx = _find_zero(cpu, state.constraints, src, n)
+
+    result = []
+    terminated = False
+    for byt in _read_bytes(cpu, src, min(zero_idx, n)):
+        if issymbolic(terminated):
+            result.append(ITEBV(8, terminated, 0, byt))
+        else:
+            result.append(byt)
+        if issymbolic(byt):
+            terminated = OR(terminated, byt == 0)
+    result.extend([0] * (n - len(result)))
+
+    cpu.write_bytes(dest, result)
+    return dest
+
+
+def strchr(state, s, c):
+    """
+    strchr symbolic model.
+
+    Algorithm: Walks from the end of the string, NULL included, to the
+    beginning building a tree of ITEs each time the current byte or `c` is
+    symbolic.
+
+    :param State state: Current program state
+    :param int s: Address of string
+    :param c: Character to look for, converted to a char
+    :return: Address of the first occurrence of `c` in `s`, or NULL
+    :rtype: Expression or int
+    """
+
+    cpu = state.cpu
+
+    if issymbolic(s):
+        raise ConcretizeArgument(state.cpu, 1)
+
+    c = EXTRACT(c, 0, 8) if issymbolic(c) else c & 0xff
+    zero_idx = _find_zero(cpu, state.constraints, s)
+
+    ret = 0
+    for offset, byt in reversed(list(enumerate(_read_bytes(cpu, s, zero_idx + 1)))):
+        if issymbolic(byt) or issymbolic(c):
+            ret = ITEBV(cpu.address_bit_size, byt == c, s + offset,
+                        ITEBV(cpu.address_bit_size, byt == 0, 0, ret))
+        elif byt == c:
+            ret = s + offset
+        elif byt == 0:
+            ret = 0
+
+    return ret
+
+
+def malloc(state, size):
+    """
+    malloc model.
+
+    Allocates from read/write maps of HEAP_ARENA_SIZE bytes, mapped when
+    needed, and maps larger blocks, up to MALLOC_MAX_SIZE, on their own. Freed
+    memory is not reused, the blocks mapped on their own are unmapped.
+    A symbolic size is allocated with the largest value it can take, so the
+    block is big enough for all of them. It is constrained to be at most
+    MALLOC_SYMBOLIC_MAX if it can, and to its smallest value otherwise.
+
+    :param State state: Current program state
+    :param size: Number of bytes to allocate
+    :return: Address of the allocated memory, or NULL if it can not be allocated
+    :rtype: int
+    """
+
+    if issymbolic(size):
+        low, high = solver.minmax(state.constraints, size)
+        if high > MALLOC_SYMBOLIC_MAX:
+            if low <= MALLOC_SYMBOLIC_MAX:
+                state.constrain(size.ule(MALLOC_SYMBOLIC_MAX))
+                high = MALLOC_SYMBOLIC_MAX
+            else:
+                state.constrain(size == low)
+                high = low
+        size = high
+
+    if size > MALLOC_MAX_SIZE:
+        return 0
+
+    heap = state.context.setdefault('malloc', {'top': 0, 'end': 0, 'chunks': {}})
+    size = max(size, 1)
+    size = (size + HEAP_ALIGNMENT - 1) & ~(HEAP_ALIGNMENT - 1)
+    if size > HEAP_ARENA_SIZE:
+        try:
+            ptr = state.cpu.memory.mmap(None, size, 'rw', name='heap')
+        except MemoryException:
+            return 0
+    else:
+        if heap['top'] + size > heap['end']:
+            heap['top'] = state.cpu.memory.mmap(None, HEAP_ARENA_SIZE, 'rw', name='heap')
+            heap['end'] = heap['top'] + HEAP_ARENA_SIZE
+        ptr = heap['top']
+        heap['top'] += size
+    heap['chunks'][ptr] = size
+    return ptr
+
+
+def free(state, ptr):
+    """
+    free model. Terminates the state on frees of pointers not returned by
+    malloc or already freed.
+
+    :param State state: Current program state
+    :param int ptr: Address of the memory to free
+    """
+
+    if issymbolic(ptr):
+        raise ConcretizeArgument(state.cpu, 1)
+    if ptr == 0:
+        return
+
+    heap = state.context.get('malloc', {'chunks': {}})
+    size = heap['chunks'].pop(ptr, None)
+    if size is None:
+        raise TerminateState(f'Invalid free of 0x{ptr:x}', testcase=True)
+    if size > HEAP_ARENA_SIZE:
+        state.cpu.memory.munmap(ptr, size)
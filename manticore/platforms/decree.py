@@ -877,25 +877,31 @@ class Decree(Platform):
 
     def execute(self):
         """
-        Execute one cpu instruction in the current thread (only one supported).
+        Execute a basic block of cpu instructions in the current thread (only one supported).
         :rtype: bool
         :return: C{True}
 
         :todo: This is where we could implement a simple schedule.
         """
+        cpu = self.current
+        icount, clocks = cpu.icount, self.clocks
         try:
-            self.current.execute()
-            self.clocks += 1
-            if self.clocks % 10000 == 0:
-                self.check_timers()
-                self.sched()
+            cpu.execute_block()
         except Interruption as e:
+            # The clocks advance once per instruction executed, the one
+            # raising not included
+            self.clocks += cpu.icount - icount
             if e.N != 0x80:
                 raise
             try:
                 self.int80(self.current)
             except RestartSyscall:
                 pass
+        else:
+            self.clocks += cpu.icount - icount
+        if self.clocks // 10000 != clocks // 10000:
+            self.check_timers()
+            self.sched()
 
         return True
 
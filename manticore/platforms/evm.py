@@ -7,10 +7,11 @@ import inspect
 from functools import wraps
 from typing import List, Set, Tuple, Union
 from ..exceptions import EthereumError
-from ..utils.helpers import issymbolic, get_taints, taint_with, istainted
+from ..utils.helpers import issymbolic, get_taints, taint_with, istainted, CacheDict
 from ..platforms.platform import *
 from ..core.smtlib import solver, BitVec, Array, ArrayProxy, Operators, Constant, ArrayVariable, ArrayStore, BitVecConstant, translate_to_smtlib, to_constant
 from ..core.state import Concretize, TerminateState
+from ..utils.config import get_group
 from ..utils.event import Eventful
 from ..utils.rlp import rlp_encode
 from ..core.smtlib.visitors import simplify
@@ -26,12 +27,19 @@ logger = logging.getLogger(__name__)
 config = namedtuple("config", "out_of_gas")
 config.out_of_gas = None  # 0: default not enough gas, 1 default to always enough gas, 2: for on both
 
+consts = get_group('evm')
+consts.add('concrete_tier', default=True,
+           description='Keep the code, calldata and memory of a VM as bytes while they are concrete. Memory is '
+                       'moved to a symbolic array the first time a symbolic value or offset is used on it')
+
 # Auxiliary constants and functions
 TT256 = 2 ** 256
 TT256M1 = 2 ** 256 - 1
 MASK160 = 2 ** 160 - 1
 TT255 = 2 ** 255
 TOOHIGHMEM = 0x1000
+# Memory used through higher offsets is kept in a symbolic array
+MAX_CONCRETE_MEMORY = 0x1000000
 
 #FIXME. We should just use a Transaction() for this
 PendingTransaction = namedtuple("PendingTransaction", ['type', 'address', 'price', 'data', 'caller', 'value', 'gas'])
@@ -45,6 +53,63 @@ def ceil32(x):
     return Operators.ITEBV(size, Operators.UREM(x, 32) == 0, x, x + 32 - Operators.UREM(x, 32))
 
 
+def concrete_bytes(data):
+    '''
+    The bytes of `data` (bytes, bytearray, str or a sequence of byte values),
+    or None if it is symbolic or holds a symbolic value.
+    '''
+    if issymbolic(data):
+        return None
+    if isinstance(data, (bytes, bytearray)):
+        return bytes(data)
+    values = [Operators.ORD(c) for c in data]
+    if any(map(issymbolic, values)):
+        return None
+    return bytes(values)
+
+
+class ConcreteMemory(bytearray):
+    '''
+    The memory of a VM while it is concrete. Writing past its end extends it
+    with zeroes.
+    '''
+
+    def __setitem__(self, index, value):
+        if isinstance(index, int) and index >= len(self):
+            self.extend(bytes(index + 1 - len(self)))
+        super().__setitem__(index, value)
+
+
+class CodeAnalysis(object):
+    '''
+    The valid jump destinations and the instructions, indexed by pc, of a
+    concrete bytecode. Analyses are cached per process and shared by all the
+    VMs running the same code, see :meth:`get`.
+    '''
+    _cache = CacheDict(max_size=1000)
+
+    def __init__(self, bytecode):
+        self.instructions = [None] * len(bytecode)
+        jumpdests = set()
+        # Instructions running past the end of the code read zeroes
+        for instruction in EVMAsm.disassemble_all(bytecode + bytes(32)):
+            if instruction.pc >= len(bytecode):
+                break
+            self.instructions[instruction.pc] = instruction
+            if instruction.mnemonic == 'JUMPDEST':
+                jumpdests.add(instruction.pc)
+        self.jumpdests = frozenset(jumpdests)
+
+    @classmethod
+    def get(cls, bytecode):
+        ''' Returns the analysis of the bytes `bytecode` '''
+        try:
+            return cls._cache[bytecode]
+        except KeyError:
+            analysis = cls._cache[bytecode] = cls(bytecode)
+            return analysis
+
+
 def to_signed(i):
     return Operators.ITEBV(256, i < TT255, i, i - TT256)
 
@@ -64,15 +129,28 @@ class Transaction(object):
         self.set_result(result, return_data)
 
     def concretize(self, state):
-        conc_caller = state.solve_one(self.caller)
-        conc_address = state.solve_one(self.address)
-        conc_value = state.solve_one(self.value)
-        conc_gas = state.solve_one(self.gas)
-        conc_data = state.solve_one(self.data)
-        conc_return_data = state.solve_one(self.return_data)
+        return Transaction.concretize_all(state, [self])[0][0]
 
-        return Transaction(self.sort, conc_address, self.price, conc_data, conc_caller, conc_value, conc_gas,
-                           depth=self.depth, result=self.result, return_data=bytearray(conc_return_data))
+    @staticmethod
+    def concretize_all(state, transactions, exprs=()):
+        '''
+        Concretizes `transactions` with the values of a single model, so the
+        data, callers and values of all of them are consistent.
+
+        :param exprs: other expressions to solve from the same model
+        :return: the concrete transactions and the values of `exprs`
+        '''
+        fields = []
+        for tx in transactions:
+            fields += [tx.caller, tx.address, tx.value, tx.gas, tx.data, tx.return_data]
+        values = iter(state.solve_one_n(*fields, *exprs))
+
+        result = []
+        for tx in transactions:
+            conc_caller, conc_address, conc_value, conc_gas, conc_data, conc_return_data = (next(values) for _ in range(6))
+            result.append(Transaction(tx.sort, conc_address, tx.price, conc_data, conc_caller, conc_value, conc_gas,
+                                      depth=tx.depth, result=tx.result, return_data=bytearray(conc_return_data)))
+        return result, list(values)
 
     def to_dict(self, mevm):
         """
@@ -466,17 +544,26 @@ class EVM(Eventful):
 
         '''
         super().__init__(**kwargs)
+        # Concrete code and calldata are kept as bytes, see consts.concrete_tier
         if data is not None and not issymbolic(data):
-            data_size = len(data)
-            data_symbolic = constraints.new_array(index_bits=256, value_bits=8, index_max=data_size, name='DATA_{:x}'.format(address), avoid_collisions=True)
-            data_symbolic[0:data_size] = data
-            data = data_symbolic
+            data_bytes = concrete_bytes(data) if consts.concrete_tier else None
+            if data_bytes is not None:
+                data = data_bytes
+            else:
+                data_size = len(data)
+                data_symbolic = constraints.new_array(index_bits=256, value_bits=8, index_max=data_size, name='DATA_{:x}'.format(address), avoid_collisions=True)
+                data_symbolic[0:data_size] = data
+                data = data_symbolic
 
         if bytecode is not None and not issymbolic(bytecode):
-            bytecode_size = len(bytecode)
-            bytecode_symbolic = constraints.new_array(index_bits=256, value_bits=8, index_max=bytecode_size, name='BYTECODE_{:x}'.format(address), avoid_collisions=True)
-            bytecode_symbolic[0:bytecode_size] = bytecode
-            bytecode = bytecode_symbolic
+            bytecode_bytes = concrete_bytes(bytecode) if consts.concrete_tier else None
+            if bytecode_bytes is not None:
+                bytecode = bytecode_bytes
+            else:
+                bytecode_size = len(bytecode)
+                bytecode_symbolic = constraints.new_array(index_bits=256, value_bits=8, index_max=bytecode_size, name='BYTECODE_{:x}'.format(address), avoid_collisions=True)
+                bytecode_symbolic[0:bytecode_size] = bytecode
+                bytecode = bytecode_symbolic
 
         #TODO: Handle the case in which bytecode is symbolic (This happens at
         # CREATE instructions that has the arguments appended to the bytecode)
@@ -485,31 +572,40 @@ class EVM(Eventful):
         # (*) bytecode that could take more than a single value
         self._check_jumpdest = False
         self._valid_jumpdests = set()
+        self._code_analysis = None
 
-        #Compile the list of valid jumpdests via linear dissassembly
-        def extend_with_zeroes(b):
-            try:
-                for x in b:
-                    x = to_constant(x)
-                    if isinstance(x, int):
-                        yield(x)
-                    else:
+        if isinstance(bytecode, bytes):
+            self._code_analysis = CodeAnalysis.get(bytecode)
+            self._valid_jumpdests = self._code_analysis.jumpdests
+        else:
+            #Compile the list of valid jumpdests via linear dissassembly
+            def extend_with_zeroes(b):
+                try:
+                    for x in b:
+                        x = to_constant(x)
+                        if isinstance(x, int):
+                            yield(x)
+                        else:
+                            yield(0)
+                    for _ in range(32):
                         yield(0)
-                for _ in range(32):
-                    yield(0)
-            except Exception as e:
-                return
+                except Exception as e:
+                    return
 
-        for i in EVMAsm.disassemble_all(extend_with_zeroes(bytecode)):
-            if i.mnemonic == 'JUMPDEST':
-                self._valid_jumpdests.add(i.pc)
+            for i in EVMAsm.disassemble_all(extend_with_zeroes(bytecode)):
+                if i.mnemonic == 'JUMPDEST':
+                    self._valid_jumpdests.add(i.pc)
 
         #A no code VM is used to execute transactions to normal accounts.
         #I'll execute a STOP and close the transaction
         #if len(bytecode) == 0:
         #    raise EVMException("Need code")
         self._constraints = constraints
-        self.memory = constraints.new_array(index_bits=256, value_bits=8, name='EMPTY_MEMORY_{:x}'.format(address), avoid_collisions=True)
+        # A bytearray until a symbolic value or offset is used on it, see _symbolic_memory
+        if consts.concrete_tier:
+            self.memory = ConcreteMemory()
+        else:
+            self.memory = constraints.new_array(index_bits=256, value_bits=8, name='EMPTY_MEMORY_{:x}'.format(address), avoid_collisions=True)
         self.address = address
         self.caller = caller  # address of the account that is directly responsible for this execution
         self.data = data
@@ -549,7 +645,6 @@ class EVM(Eventful):
     @constraints.setter
     def constraints(self, constraints):
         self._constraints = constraints
-        self.memory.constraints = constraints
 
     @property
     def gas(self):
@@ -576,7 +671,8 @@ class EVM(Eventful):
         state['_published_pre_instruction_events'] = self._published_pre_instruction_events
         state['_used_calldata_size'] = self._used_calldata_size
         state['_calldata_size'] = self._calldata_size
-        state['_valid_jumpdests'] = self._valid_jumpdests
+        if self._code_analysis is None:
+            state['_valid_jumpdests'] = self._valid_jumpdests
         state['_check_jumpdest'] = self._check_jumpdest
         return state
 
@@ -594,13 +690,17 @@ class EVM(Eventful):
         self.data = state['data']
         self.value = state['value']
         self._bytecode = state['bytecode']
+        self._code_analysis = CodeAnalysis.get(self._bytecode) if isinstance(self._bytecode, bytes) else None
         self.pc = state['pc']
         self.stack = state['stack']
         self._allocated = state['allocated']
         self.suicides = state['suicides']
         self._used_calldata_size = state['_used_calldata_size']
         self._calldata_size = state['_calldata_size']
-        self._valid_jumpdests = state['_valid_jumpdests']
+        if self._code_analysis is not None:
+            self._valid_jumpdests = self._code_analysis.jumpdests
+        else:
+            self._valid_jumpdests = state['_valid_jumpdests']
         self._check_jumpdest = state['_check_jumpdest']
         super().__setstate__(state)
 
@@ -672,13 +772,21 @@ class EVM(Eventful):
         if isinstance(pc, Constant):
             pc = pc.value
 
+        if self._code_analysis is not None:
+            instructions = self._code_analysis.instructions
+            if 0 <= pc < len(instructions) and instructions[pc] is not None:
+                return instructions[pc]
+
         if pc in _decoding_cache:
             return _decoding_cache[pc]
 
         def getcode():
             bytecode = self.bytecode
-            for pc_i in range(pc, len(bytecode)):
-                yield simplify(bytecode[pc_i]).value
+            if isinstance(bytecode, bytes):
+                yield from bytecode[pc:]
+            else:
+                for pc_i in range(pc, len(bytecode)):
+                    yield simplify(bytecode[pc_i]).value
             while True:
                 yield 0
         instruction = EVMAsm.disassemble_one(getcode(), pc=pc)
@@ -700,10 +808,10 @@ class EVM(Eventful):
 
         if isinstance(value, int):
             value = value & TT256M1
-
-        value = simplify(value)
-        if isinstance(value, Constant) and not value.taint:
-            value = value.value
+        else:
+            value = simplify(value)
+            if isinstance(value, Constant) and not value.taint:
+                value = value.value
         self.stack.append(value)
 
     def _top(self, n=0):
@@ -935,31 +1043,82 @@ class EVM(Eventful):
         if size == 0:
             return bytearray()
         self._allocate(offset + size)
-        return self.memory[offset: offset + size]
+        if isinstance(self.memory, bytearray) and not issymbolic(offset):
+            return self.memory[offset: offset + size].ljust(size, b'\x00')
+        return self._symbolic_memory()[offset: offset + size]
 
     def write_buffer(self, offset, data):
         self._allocate(offset + len(data))
-        for i, c in enumerate(data):
-            self._store(offset + i, Operators.ORD(c))
+        if isinstance(data, (bytes, bytearray)):
+            self._store_bytes(offset, data)
+        else:
+            for i, c in enumerate(data):
+                self._store(offset + i, Operators.ORD(c))
+
+    def _symbolic_memory(self):
+        '''
+        Returns the memory as a symbolic array, moving the concrete bytes
+        written so far into a new one the first time.
+        '''
+        if isinstance(self.memory, bytearray):
+            memory = self.constraints.new_array(index_bits=256, value_bits=8, name='EMPTY_MEMORY_{:x}'.format(self.address), avoid_collisions=True)
+            for offset, value in enumerate(self.memory):
+                memory[offset] = value
+            self.memory = memory
+        return self.memory
+
+    def _concrete_memory(self, offset, size):
+        '''
+        Returns the memory as a bytearray holding [offset, offset + size), or
+        None if the access must go to the symbolic array.
+        '''
+        memory = self.memory
+        if not isinstance(memory, bytearray) or issymbolic(offset):
+            return None
+        end = offset + size
+        if end > len(memory):
+            if end > MAX_CONCRETE_MEMORY:
+                return None
+            memory.extend(bytes(end - len(memory)))
+        return memory
 
     def _load(self, offset, size=1):
-        value = self.memory.read_BE(offset, size)
-        try:
-            value = simplify(value)
-            if not value.taint:
-                value = value.value
-        except:
-            pass
+        memory = self.memory
+        if isinstance(memory, bytearray) and not issymbolic(offset):
+            value = int.from_bytes(memory[offset:offset + size].ljust(size, b'\x00'), 'big')
+        else:
+            value = self._symbolic_memory().read_BE(offset, size)
+            try:
+                value = simplify(value)
+                if not value.taint:
+                    value = value.value
+            except:
+                pass
 
-        for i in range(size):
-            self._publish('did_evm_read_memory', offset + i, Operators.EXTRACT(value, (size - i - 1) * 8, 8))
+        if self._is_subscribed('did_evm_read_memory'):
+            for i in range(size):
+                self._publish('did_evm_read_memory', offset + i, Operators.EXTRACT(value, (size - i - 1) * 8, 8))
         return value
 
     def _store(self, offset, value, size=1):
         ''' Stores value in memory as a big endian '''
-        self.memory.write_BE(offset, value, size)
-        for i in range(size):
-            self._publish('did_evm_write_memory', offset + i, Operators.EXTRACT(value, (size - i - 1) * 8, 8))
+        memory = self._concrete_memory(offset, size) if isinstance(value, int) else None
+        if memory is not None:
+            memory[offset:offset + size] = (value & ((1 << (size * 8)) - 1)).to_bytes(size, 'big')
+        else:
+            self._symbolic_memory().write_BE(offset, value, size)
+        if self._is_subscribed('did_evm_write_memory'):
+            for i in range(size):
+                self._publish('did_evm_write_memory', offset + i, Operators.EXTRACT(value, (size - i - 1) * 8, 8))
+
+    def _store_bytes(self, offset, data):
+        ''' Stores the concrete bytes `data` in memory at `offset` '''
+        memory = self._concrete_memory(offset, len(data))
+        if memory is not None and not self._is_subscribed('did_evm_write_memory'):
+            memory[offset:offset + len(data)] = data
+        else:
+            for i, c in enumerate(data):
+                self._store(offset + i, c)
 
     def safe_add(self, a, b):
         a = Operators.ZEXTEND(a, 512)
@@ -1145,6 +1304,8 @@ class EVM(Eventful):
         return Operators.ZEXTEND(Operators.EXTRACT(value, offset, 8), 256)
 
     def try_simplify_to_constant(self, data):
+        if isinstance(data, (bytes, bytearray)):
+            return bytes(data)
         concrete_data = bytearray()
         for c in data:
             simplified = simplify(c)
@@ -1224,9 +1385,12 @@ class EVM(Eventful):
 
         self._use_calldata(offset + 32)
 
+        if isinstance(self.data, bytes):
+            return int.from_bytes(self.data[offset:offset + 32].ljust(32, b'\x00'), 'big')
+
         data_length = len(self.data)
 
-        bytes = []
+        data = []
         for i in range(32):
             try:
                 c = Operators.ITEBV(8, offset + i < data_length, self.data[offset + i], 0)
@@ -1234,8 +1398,8 @@ class EVM(Eventful):
                 # offset + i is concrete and outside data
                 c = 0
 
-            bytes.append(c)
-        return Operators.CONCAT(256, *bytes)
+            data.append(c)
+        return Operators.CONCAT(256, *data)
 
     def _use_calldata(self, n):
         assert not issymbolic(n)
@@ -1269,6 +1433,9 @@ class EVM(Eventful):
         self._consume(memfee)
 
         self._allocate(self.safe_add(mem_offset, size))
+        if isinstance(self.data, bytes):
+            self._store_bytes(mem_offset, self.data[data_offset:data_offset + size].ljust(size, b'\x00'))
+            return
         for i in range(size):
             try:
                 c = Operators.ITEBV(8, data_offset + i < len(self.data), Operators.ORD(self.data[data_offset + i]), 0)
@@ -1287,6 +1454,11 @@ class EVM(Eventful):
 
         self._allocate(mem_offset + size)
 
+        if isinstance(self.bytecode, bytes) and not issymbolic(size) and not issymbolic(code_offset):
+            self._store_bytes(mem_offset, self.bytecode[code_offset:code_offset + size].ljust(size, b'\x00'))
+            self._publish('did_evm_read_code', code_offset, size)
+            return
+
         if issymbolic(size):
             max_size = solver.max(self.constraints, size)
         else:
@@ -1329,6 +1501,10 @@ class EVM(Eventful):
 
         self._allocate(address + size)
 
+        if isinstance(extbytecode, (bytes, bytearray)) and not issymbolic(offset) and not issymbolic(size):
+            self._store_bytes(address, bytes(extbytecode[offset:offset + size]).ljust(size, b'\x00'))
+            return
+
         for i in range(size):
             if offset + i < len(extbytecode):
                 self._store(address + i, extbytecode[offset + i])
@@ -1339,6 +1515,9 @@ class EVM(Eventful):
         return_data = self.world.last_transaction.return_data
 
         self._allocate(mem_offset + size)
+        if isinstance(return_data, (bytes, bytearray)) and not issymbolic(return_offset) and not issymbolic(size):
+            self._store_bytes(mem_offset, bytes(return_data[return_offset:return_offset + size]).ljust(size, b'\x00'))
+            return
         for i in range(size):
             if return_offset + i < len(return_data):
                 self._store(mem_offset + i, return_data[return_offset + i])
@@ -2365,6 +2544,12 @@ class EVMWorld(Platform):
             self._close_transaction('STOP')
             
     def dump(self, stream, state, mevm, message):
+        """
+        Write a summary of the accounts in `state` into the stream.
+
+        :return: whether a value written is symbolic, and the human transactions
+                 concretized from the model of the balances and storage written
+        """
         from ..ethereum.manticore import calculate_coverage, flagged
         blockchain = state.platform
         last_tx = blockchain.last_transaction
@@ -2388,27 +2573,16 @@ class EVMWorld(Platform):
                     stream.write('\n')
 
         # Accounts summary
-        is_something_symbolic = False
-        stream.write("%d accounts.\n" % len(blockchain.accounts))
+        accounts = []
+        exprs = []
         for account_address in blockchain.accounts:
             is_account_address_symbolic = issymbolic(account_address)
             account_address = state.solve_one(account_address)
-
-            stream.write("* %s::\n" % mevm.account_name(account_address))
-            stream.write("Address: 0x%x %s\n" % (account_address, flagged(is_account_address_symbolic)))
-            balance = blockchain.get_balance(account_address)
-            is_balance_symbolic = issymbolic(balance)
-            is_something_symbolic = is_something_symbolic or is_balance_symbolic
-            balance = state.solve_one(balance)
-            stream.write("Balance: %d %s\n" % (balance, flagged(is_balance_symbolic)))
-
             storage = blockchain.get_storage(account_address)
-            stream.write("Storage: %s\n" % translate_to_smtlib(storage, use_bindings=True))
 
             all_used_indexes = []
             with state.constraints as temp_cs:
                 index = temp_cs.new_bitvec(256)
-                storage = blockchain.get_storage(account_address)
                 temp_cs.add(storage.get(index) != 0)
 
                 try:
@@ -2421,12 +2595,29 @@ class EVMWorld(Platform):
                 except:
                     pass
 
+            accounts.append((account_address, is_account_address_symbolic, storage, all_used_indexes))
+            exprs.append(blockchain.get_balance(account_address))
+            exprs += [storage.get(i) for i in all_used_indexes]
+
+        # Balances and storage come from the model of the human transactions
+        conc_txs, values = Transaction.concretize_all(state, blockchain.human_transactions, exprs)
+        values = iter(values)
+
+        is_something_symbolic = False
+        stream.write("%d accounts.\n" % len(blockchain.accounts))
+        for account_address, is_account_address_symbolic, storage, all_used_indexes in accounts:
+            stream.write("* %s::\n" % mevm.account_name(account_address))
+            stream.write("Address: 0x%x %s\n" % (account_address, flagged(is_account_address_symbolic)))
+            is_balance_symbolic = issymbolic(blockchain.get_balance(account_address))
+            is_something_symbolic = is_something_symbolic or is_balance_symbolic
+            stream.write("Balance: %d %s\n" % (next(values), flagged(is_balance_symbolic)))
+            stream.write("Storage: %s\n" % translate_to_smtlib(storage, use_bindings=True))
+
             if all_used_indexes:
                 stream.write("Storage:\n")
                 for i in all_used_indexes:
-                    value = storage.get(i)
-                    is_storage_symbolic = issymbolic(value)
-                    stream.write("storage[%x] = %x %s\n" % (state.solve_one(i), state.solve_one(value), flagged(is_storage_symbolic)))
+                    is_storage_symbolic = issymbolic(storage.get(i))
+                    stream.write("storage[%x] = %x %s\n" % (i, next(values), flagged(is_storage_symbolic)))
             """if blockchain.has_storage(account_address):
                 stream.write("Storage:\n")
                 for offset, value in blockchain.get_storage_items(account_address):
@@ -2446,5 +2637,5 @@ class EVMWorld(Platform):
                 runtime_trace = set((pc for contract, pc, at_init in state.context['evm.trace'] if address == contract and not at_init))
                 stream.write("Coverage %d%% (on this state)\n" % calculate_coverage(runtime_code, runtime_trace))  # coverage % for address in this account/state
             stream.write("\n")
-        return is_something_symbolic
+        return is_something_symbolic, conc_txs
 
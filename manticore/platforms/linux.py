@@ -2219,25 +2219,31 @@ class Linux(Platform):
 
     def execute(self):
         """
-        Execute one cpu instruction in the current thread (only one supported).
+        Execute a basic block of cpu instructions in the current thread (only one supported).
         :rtype: bool
         :return: C{True}
 
         :todo: This is where we could implement a simple schedule.
         """
+        cpu = self.current
+        icount, clocks = cpu.icount, self.clocks
         try:
-            self.current.execute()
-            self.clocks += 1
-            if self.clocks % 10000 == 0:
-                self.check_timers()
-                self.sched()
+            cpu.execute_block()
         except (Interruption, Syscall) as e:
+            # The clocks advance once per instruction executed, the one
+            # raising not included
+            self.clocks += cpu.icount - icount
             try:
                 self.syscall()
                 if hasattr(e, 'on_handled'):
                     e.on_handled()
             except RestartSyscall:
                 pass
+        else:
+            self.clocks += cpu.icount - icount
+        if self.clocks // 10000 != clocks // 10000:
+            self.check_timers()
+            self.sched()
 
         return True
 
@@ -2681,20 +2687,12 @@ class SLinux(Linux):
         return super().sys_getrandom(buf, size, flags)
 
     def generate_workspace_files(self):
-        def solve_to_fd(data, fd):
-            def make_chr(c):
-                if isinstance(c, int):
-                    return bytes([c])
-                elif isinstance(c, str):
-                    return c.encode()
-                return c
-            try:
-                for c in data:
-                    if issymbolic(c):
-                        c = solver.get_value(self.constraints, c)
-                    fd.write(make_chr(c))
-            except SolverException:
-                fd.write('{SolverException}')
+        def make_chr(c):
+            if isinstance(c, int):
+                return bytes([c])
+            elif isinstance(c, str):
+                return c.encode()
+            return c
 
         out = io.BytesIO()
         inn = io.BytesIO()
@@ -2703,24 +2701,48 @@ class SLinux(Linux):
         argIO = io.BytesIO()
         envIO = io.BytesIO()
 
+        writes = []
         for name, fd, data in self.syscall_trace:
             if name in ('_transmit', '_write'):
                 if fd == 1:
-                    solve_to_fd(data, out)
+                    writes.append((out, data))
                 elif fd == 2:
-                    solve_to_fd(data, err)
+                    writes.append((err, data))
             if name in ('_recv'):
-                solve_to_fd(data, net)
+                writes.append((net, data))
             if name in ('_receive', '_read') and fd == 0:
-                solve_to_fd(data, inn)
+                writes.append((inn, data))
 
         for a in self.argv:
-            solve_to_fd(a, argIO)
-            argIO.write(b"\n")
+            writes.append((argIO, a))
+            writes.append((argIO, b"\n"))
 
         for e in self.envp:
-            solve_to_fd(e, envIO)
-            envIO.write(b"\n")
+            writes.append((envIO, e))
+            writes.append((envIO, b"\n"))
+
+        files = {}
+        for f in self.files + self._closed_files:
+            if not isinstance(f, SymbolicFile):
+                continue
+            files[f.name] = io.BytesIO()
+            writes.append((files[f.name], f.array))
+
+        # Solve all the symbolic bytes at once, from a single model
+        symbols = [c for _, data in writes for c in data if issymbolic(c)]
+        try:
+            values = iter(solver.get_values(self.constraints, symbols))
+        except SolverException:
+            values = None
+
+        for fd, data in writes:
+            if values is None and any(map(issymbolic, data)):
+                fd.write(b'{SolverException}')
+                continue
+            for c in data:
+                if issymbolic(c):
+                    c = next(values)
+                fd.write(make_chr(c))
 
         ret = {
             'syscalls': repr(self.syscall_trace),
@@ -2732,11 +2754,7 @@ class SLinux(Linux):
             'net': net.getvalue()
         }
 
-        for f in self.files + self._closed_files:
-            if not isinstance(f, SymbolicFile):
-                continue
-            fdata = io.BytesIO()
-            solve_to_fd(f.array, fdata)
-            ret[f.name] = fdata.getvalue()
+        for name, fdata in files.items():
+            ret[name] = fdata.getvalue()
 
         return ret
@@ -18,10 +18,17 @@ logger = logging.getLogger(__name__)
 class UnicornEmulator(object):
     '''
     Helper class to emulate a single instruction via Unicorn.
+
+    The same emulator can be used for any number of instructions of its cpu.
+    The Unicorn instance and its memory mappings are kept between them and
+    only rebuilt when the mappings of the cpu memory change (mmap, munmap,
+    mprotect) or the cpu changes mode. The registers are only written to
+    Unicorn, and back to the cpu, when they changed.
     '''
 
     def __init__(self, cpu):
         self._cpu = cpu
+        self._emu = None
 
         text = cpu.memory.map_containing(cpu.PC)
         # Keep track of all memory mappings. We start with just the text section
@@ -33,6 +40,11 @@ class UnicornEmulator(object):
         # instruction
         self._should_be_written = {}
 
+        # Register values last synchronized with Unicorn
+        self._registers = {}
+        # Instruction bytes written to Unicorn, by address
+        self._code = {}
+
         if self._cpu.arch == CS_ARCH_ARM:
             self._uc_arch = UC_ARCH_ARM
             self._uc_mode = {
@@ -56,11 +68,50 @@ class UnicornEmulator(object):
 
         else:
             raise NotImplementedError(f'Unsupported architecture: {self._cpu.arch}')
+        self._mode = self._cpu.mode
 
     def reset(self):
         self._emu = Uc(self._uc_arch, self._uc_mode)
         self._to_raise = None
 
+    @property
+    def stale(self):
+        '''
+        Whether the cpu changed mode since this emulator was created; a new
+        emulator is needed then.
+        '''
+        return self._cpu.mode != self._mode
+
+    def _ensure_emulator(self):
+        '''
+        Creates the Unicorn instance on first use, and recreates it when the
+        memory mappings changed since.
+        '''
+        memory = self._cpu.memory
+        if self._emu is not None and self._maps_version == memory._maps_version:
+            return
+
+        if self._emu is not None:
+            # Forget the mappings, the hooks bring back those still needed
+            text = memory.map_containing(self._cpu.PC)
+            self._should_be_mapped = {
+                text.start: (len(text), UC_PROT_READ | UC_PROT_EXEC)
+            }
+        self._maps_version = memory._maps_version
+        self._registers = {}
+        self._code = {}
+
+        self.reset()
+        for base, (size, perms) in self._should_be_mapped.items():
+            self._emu.mem_map(base, size, perms)
+
+        self._emu.hook_add(UC_HOOK_MEM_READ_UNMAPPED, self._hook_unmapped)
+        self._emu.hook_add(UC_HOOK_MEM_WRITE_UNMAPPED, self._hook_unmapped)
+        self._emu.hook_add(UC_HOOK_MEM_FETCH_UNMAPPED, self._hook_unmapped)
+        self._emu.hook_add(UC_HOOK_MEM_READ, self._hook_xfer_mem)
+        self._emu.hook_add(UC_HOOK_MEM_WRITE, self._hook_xfer_mem)
+        self._emu.hook_add(UC_HOOK_INTR, self._interrupt)
+
     def _create_emulated_mapping(self, uc, address):
         '''
         Create a mapping in Unicorn and note that we'll need it if we retry.
@@ -160,23 +211,46 @@ class UnicornEmulator(object):
             # TODO(yan): raise a more appropriate exception
             raise TypeError
 
+    def _emulated_registers(self):
+        '''
+        The registers synchronized between Manticore and Unicorn.
+        '''
+        registers = set(self._cpu.canonical_registers)
+
+        # Refer to EFLAGS instead of individual flags for x86
+        if self._cpu.arch == CS_ARCH_X86:
+            # The last 8 canonical registers of x86 are individual flags; replace
+            # with the eflags
+            registers -= set(['CF', 'PF', 'AF', 'ZF', 'SF', 'IF', 'DF', 'OF'])
+            registers.add('EFLAGS')
+
+            # TODO(mark): Unicorn 1.0.1 does not support reading YMM registers,
+            # and simply returns back zero. If a unicorn emulated instruction writes to an
+            # XMM reg, we will read back the corresponding YMM register, resulting in an
+            # incorrect zero value being actually written to the XMM register. This is
+            # fixed in Unicorn PR #819, so when that is included in a release, delete
+            # these two lines.
+            registers -= set(['YMM0', 'YMM1', 'YMM2', 'YMM3', 'YMM4', 'YMM5', 'YMM6', 'YMM7',
+                              'YMM8', 'YMM9', 'YMM10', 'YMM11', 'YMM12', 'YMM13', 'YMM14', 'YMM15'])
+            registers |= set(['XMM0', 'XMM1', 'XMM2', 'XMM3', 'XMM4', 'XMM5', 'XMM6', 'XMM7',
+                              'XMM8', 'XMM9', 'XMM10', 'XMM11', 'XMM12', 'XMM13', 'XMM14', 'XMM15'])
+
+        return registers
+
     def emulate(self, instruction):
         '''
         Emulate a single instruction.
         '''
+        self._ensure_emulator()
+        self._should_be_written = {}
+        self._to_raise = None
 
         # The emulation might restart if Unicorn needs to bring in a memory map
         # or bring a value from Manticore state.
         while True:
 
-            self.reset()
-
             # Establish Manticore state, potentially from past emulation
             # attempts
-            for base in self._should_be_mapped:
-                size, perms = self._should_be_mapped[base]
-                self._emu.mem_map(base, size, perms)
-
             for address, values in self._should_be_written.items():
                 for offset, byte in enumerate(values, start=address):
                     if issymbolic(byte):
@@ -194,6 +268,9 @@ class UnicornEmulator(object):
             if not self._should_try_again:
                 break
 
+            # The failed attempt may have left its results in Unicorn
+            self._registers = {}
+
     def _step(self, instruction):
         '''
         A single attempt at executing an instruction.
@@ -201,49 +278,32 @@ class UnicornEmulator(object):
         logger.debug("0x%x:\t%s\t%s"
                      % (instruction.address, instruction.mnemonic, instruction.op_str))
 
-        registers = set(self._cpu.canonical_registers)
-
-        # Refer to EFLAGS instead of individual flags for x86
-        if self._cpu.arch == CS_ARCH_X86:
-            # The last 8 canonical registers of x86 are individual flags; replace
-            # with the eflags
-            registers -= set(['CF', 'PF', 'AF', 'ZF', 'SF', 'IF', 'DF', 'OF'])
-            registers.add('EFLAGS')
-
-            # TODO(mark): Unicorn 1.0.1 does not support reading YMM registers,
-            # and simply returns back zero. If a unicorn emulated instruction writes to an
-            # XMM reg, we will read back the corresponding YMM register, resulting in an
-            # incorrect zero value being actually written to the XMM register. This is
-            # fixed in Unicorn PR #819, so when that is included in a release, delete
-            # these two lines.
-            registers -= set(['YMM0', 'YMM1', 'YMM2', 'YMM3', 'YMM4', 'YMM5', 'YMM6', 'YMM7',
-                              'YMM8', 'YMM9', 'YMM10', 'YMM11', 'YMM12', 'YMM13', 'YMM14', 'YMM15'])
-            registers |= set(['XMM0', 'XMM1', 'XMM2', 'XMM3', 'XMM4', 'XMM5', 'XMM6', 'XMM7',
-                              'XMM8', 'XMM9', 'XMM10', 'XMM11', 'XMM12', 'XMM13', 'XMM14', 'XMM15'])
+        registers = self._emulated_registers()
 
         # XXX(yan): This concretizes the entire register state. This is overly
         # aggressive. Once capstone adds consistent support for accessing
         # referred registers, make this only concretize those registers being
         # read from.
+        regfile = self._cpu.regfile
         for reg in registers:
-            val = self._cpu.read_register(reg)
+            val = regfile.read(reg)
             if issymbolic(val):
                 from ..native.cpu.abstractcpu import ConcretizeRegister
                 raise ConcretizeRegister(self._cpu, reg, "Concretizing for emulation.",
                                          policy='ONE')
-            self._emu.reg_write(self._to_unicorn_id(reg), val)
+            if self._registers.get(reg) != val:
+                self._emu.reg_write(self._to_unicorn_id(reg), val)
+                self._registers[reg] = val
 
         # Bring in the instruction itself
         instruction = self._cpu.decode_instruction(self._cpu.PC)
-        text_bytes = self._cpu.read_bytes(self._cpu.PC, instruction.size)
-        self._emu.mem_write(self._cpu.PC, b''.join(text_bytes))
-
-        self._emu.hook_add(UC_HOOK_MEM_READ_UNMAPPED, self._hook_unmapped)
-        self._emu.hook_add(UC_HOOK_MEM_WRITE_UNMAPPED, self._hook_unmapped)
-        self._emu.hook_add(UC_HOOK_MEM_FETCH_UNMAPPED, self._hook_unmapped)
-        self._emu.hook_add(UC_HOOK_MEM_READ, self._hook_xfer_mem)
-        self._emu.hook_add(UC_HOOK_MEM_WRITE, self._hook_xfer_mem)
-        self._emu.hook_add(UC_HOOK_INTR, self._interrupt)
+        text_bytes = bytes(instruction.bytes)
+        if self._code.get(self._cpu.PC) != text_bytes:
+            if self._cpu.PC in self._code and hasattr(self._emu, 'ctl_remove_cache'):
+                # Drop the stale translation of the old code
+                self._emu.ctl_remove_cache(self._cpu.PC, self._cpu.PC + len(self._code[self._cpu.PC]))
+            self._emu.mem_write(self._cpu.PC, text_bytes)
+            self._code[self._cpu.PC] = text_bytes
 
         saved_PC = self._cpu.PC
 
@@ -256,6 +316,8 @@ class UnicornEmulator(object):
             # We request re-execution by signaling error; if we we didn't set
             # _should_try_again, it was likely an actual error
             if not self._should_try_again:
+                # Unicorn state is unknown from here on
+                self._registers = {}
                 raise
 
         if self._should_try_again:
@@ -271,10 +333,12 @@ class UnicornEmulator(object):
                 )
             logger.debug(">" * 10)
 
-        # Bring back Unicorn registers to Manticore
+        # Bring back the Unicorn registers that changed to Manticore
         for reg in registers:
             val = self._emu.reg_read(self._to_unicorn_id(reg))
-            self._cpu.write_register(reg, val)
+            if self._registers[reg] != val:
+                self._cpu.write_register(reg, val)
+                self._registers[reg] = val
 
         # Unicorn hack. On single step, unicorn wont advance the PC register
         mu_pc = self.get_unicorn_pc()
@@ -286,3 +350,340 @@ class UnicornEmulator(object):
             raise self._to_raise
 
         return
+
+
+class ConcreteUnicornEmulator(UnicornEmulator):
+    '''
+    Helper class to run concrete code via Unicorn, a basic block at a time.
+
+    Memory is brought in lazily, a page at a time, the first time Unicorn
+    touches it. Execution stops before the first block that must be left to
+    the Manticore models (system calls, interrupts and instructions whose
+    model differs from the hardware, see `unsupported`), before the blocks
+    holding a hooked instruction (see `Cpu.hooked_pcs`) and at the first read
+    of a symbolic byte. The registers and the memory written by Unicorn are
+    then brought back to Manticore.
+
+    Only x86 and x86-64 are supported. Instruction events are not published
+    for the instructions run in Unicorn.
+
+    The same emulator is used for all the runs of its cpu. The Unicorn
+    instance and its pages are kept between them, the pages being brought up
+    to date with the memory at the start of each run (see `memory_written`).
+    They are dropped when the mappings of the memory change. The blocks
+    decoded are dropped when their code is written (see `invalidate_cache`).
+    '''
+
+    PAGE_SIZE = 0x1000
+
+    #: Instructions always left to the Manticore models
+    unsupported = frozenset(['SYSCALL', 'SYSENTER', 'INT', 'INT1', 'INT3', 'INTO', 'IRET', 'IRETD', 'IRETQ',
+                             'HLT', 'CPUID', 'RDTSC', 'RDTSCP', 'XGETBV', 'UD2'])
+
+    #: Maximum number of blocks run by a single call to `run`
+    max_blocks = 10000
+
+    def __init__(self, cpu):
+        super().__init__(cpu)
+        # (address, size) of a block -> addresses of its instructions or None
+        self._blocks = {}
+        # Pages mapped in Unicorn -> their content when last synchronized
+        self._pages = {}
+        # Pages written in the memory since
+        self._dirty = set()
+        self._symbolic_hooks = []
+        self.last_pc = None
+        cpu.memory.watch_code(self)
+        cpu.memory.watch_writes(self)
+
+    def memory_written(self, address, size):
+        '''
+        Notes the pages written in [address, address + size), to bring them
+        up to date in Unicorn at the start of the next run.
+        '''
+        self._dirty.update(range(address & ~(self.PAGE_SIZE - 1), address + size, self.PAGE_SIZE))
+
+    def invalidate_cache(self, address, size):
+        '''
+        Drops the blocks decoded from [address, address + size), and those
+        translated by Unicorn. The new code is written to Unicorn with the
+        pages at the start of the next run.
+        '''
+        self._blocks = {key: block for key, block in self._blocks.items()
+                        if key[0] + key[1] <= address or address + size <= key[0]}
+        if self._emu is not None:
+            if hasattr(self._emu, 'ctl_remove_cache'):
+                self._emu.ctl_remove_cache(address, address + size)
+            else:
+                self._emu = None
+
+    def _ensure_emulator(self):
+        '''
+        Creates the Unicorn instance, without any page, on first use and when
+        the memory mappings changed. Otherwise writes the pages changed in the
+        memory since the last run.
+        '''
+        memory = self._cpu.memory
+        if self._emu is not None and self._maps_version == memory._maps_version:
+            for page in self._dirty.intersection(self._pages):
+                current = self._page_content(page)
+                if current != self._pages[page]:
+                    self._emu.mem_write(page, current)
+                    self._pages[page] = current
+            self._dirty.clear()
+            return
+
+        self._maps_version = memory._maps_version
+        self._pages = {}
+        self._dirty.clear()
+        self._symbolic_hooks = []
+        self.reset()
+        self._emu.hook_add(UC_HOOK_MEM_UNMAPPED, self._hook_unmapped)
+        self._emu.hook_add(UC_HOOK_BLOCK, self._hook_block)
+        self._emu.hook_add(UC_HOOK_INTR, self._interrupt)
+
+    def _page_content(self, page):
+        '''
+        The bytes of `page`, the symbolic ones left with the concrete value
+        underneath (their reads are caught by _hook_symbolic_read).
+        '''
+        from ..native.memory import Memory  # prevent circular imports
+
+        memory = self._cpu.memory
+        content = memory.map_containing(page).concrete(slice(page, page + self.PAGE_SIZE))
+        if content is None:
+            content = b''.join(Memory.read(memory, page, self.PAGE_SIZE, force=True))
+        return bytes(content)
+
+    @staticmethod
+    def can_emulate(cpu):
+        '''
+        Whether the memory model and architecture of `cpu` are supported.
+        '''
+        from ..native.memory import LazySMemory  # prevent circular imports
+        return cpu.arch == CS_ARCH_X86 and not isinstance(cpu.memory, LazySMemory)
+
+    def _supported(self, insn):
+        return self._cpu.canonicalize_instruction_name(insn) not in self.unsupported and not self._uses_segment(insn)
+
+    def _block_instructions(self, address, size):
+        '''
+        Decodes the `size` bytes block at `address`. Returns the addresses of
+        its instructions or None if the block can not be run in Unicorn.
+        '''
+        key = (address, size)
+        if key in self._blocks:
+            return self._blocks[key]
+
+        addresses = []
+        pc = address
+        try:
+            while pc < address + size:
+                insn = self._cpu.decode_instruction(pc)
+                if not self._supported(insn):
+                    addresses = None
+                    break
+                addresses.append(pc)
+                pc += insn.size
+        except Exception:
+            # Symbolic or invalid code, let the models raise the right exception
+            addresses = None
+
+        self._blocks[key] = addresses
+        return addresses
+
+    def _uses_segment(self, insn):
+        ''' Unicorn can not set the FS/GS bases in 32 bit mode '''
+        if self._cpu.mode != CS_MODE_32:
+            return False
+        return any(op.type == 'memory' and op.mem.segment in ('FS', 'GS') for op in insn.operands)
+
+    def _hook_unmapped(self, uc, access, address, size, value, data):
+        '''
+        Bring in the page holding `address`, or stop if there is none.
+        '''
+        page = address & ~(self.PAGE_SIZE - 1)
+        memory = self._cpu.memory
+        if page in self._pages or page not in memory:
+            return False
+
+        m = memory.map_containing(page)
+        permissions = UC_PROT_NONE
+        if 'r' in m.perms:
+            permissions |= UC_PROT_READ
+        if 'w' in m.perms:
+            permissions |= UC_PROT_WRITE
+        if 'x' in m.perms:
+            permissions |= UC_PROT_EXEC
+
+        content = self._page_content(page)
+        uc.mem_map(page, self.PAGE_SIZE, permissions)
+        uc.mem_write(page, content)
+        self._pages[page] = content
+
+        # Unicorn loses track of the PC when execution resumes after more than
+        # one page is mapped from this hook. Fault instead, and restart from
+        # the faulting instruction (see run)
+        self._mapped = True
+        return False
+
+    def _hook_symbolic_read(self, uc, access, address, size, value, data):
+        '''
+        Stop before an instruction reading a symbolic byte.
+        '''
+        symbols = self._cpu.memory._symbols
+        if any(address + offset in symbols for offset in range(size)):
+            uc.emu_stop()
+
+    def _hook_symbolic_write(self, uc, access, address, size, value, data):
+        '''
+        Note the writes to pages with symbolic bytes; a concrete write over a
+        symbolic byte must be brought back even if it does not change the
+        concrete value underneath.
+        '''
+        self._written.update(range(address, address + size))
+
+    def _hook_block(self, uc, address, size, data):
+        '''
+        Stop before a block that must be run by the models.
+        '''
+        if self._block is not None:
+            self._executed += len(self._block)
+            self.last_pc = self._block[-1]
+            self._block = None
+        self._run_blocks += 1
+        block = self._block_instructions(address, size)
+        # The hooked pcs are not part of the decoded blocks, they can change
+        # between runs
+        hooked_pcs = self._cpu.hooked_pcs
+        if block is None or self._run_blocks > self.max_blocks or \
+                (hooked_pcs and any(pc in hooked_pcs for pc in block)):
+            uc.emu_stop()
+        else:
+            self._block = block
+
+    def _interrupt(self, uc, number, data):
+        '''
+        Stop on faults (the unsupported instructions never get to run).
+        Unicorn leaves the PC at the faulting instruction, which is then run
+        by the models.
+        '''
+        uc.emu_stop()
+
+    def run(self):
+        '''
+        Runs concrete code from the current PC.
+
+        :return: the number of instructions executed
+        '''
+        cpu = self._cpu
+        if not self.can_emulate(cpu):
+            return 0
+        try:
+            if not self._supported(cpu.decode_instruction(cpu.PC)):
+                return 0
+        except Exception:
+            return 0
+
+        # Unicorn would load the segment selectors from a GDT. Only their
+        # bases are set instead (see _uses_segment)
+        regfile = cpu.regfile
+        selectors = ('CS', 'DS', 'ES', 'SS', 'FS', 'GS')
+        bases = {seg: cpu.get_descriptor(regfile.read(seg))[0] for seg in selectors}
+        if any(bases[seg] for seg in ('CS', 'DS', 'ES', 'SS')):
+            return 0
+
+        registers = self._emulated_registers() - set(selectors)
+        values = {}
+        for reg in registers:
+            value = regfile.read(reg)
+            if issymbolic(value):
+                return 0
+            values[reg] = value
+
+        self._ensure_emulator()
+        self._written = set()
+        self._block = None
+        self._executed = 0
+        self._run_blocks = 0
+
+        for reg, value in values.items():
+            self._emu.reg_write(self._to_unicorn_id(reg), value)
+        if cpu.mode == CS_MODE_64:
+            self._emu.reg_write(UC_X86_REG_FS_BASE, bases['FS'])
+            self._emu.reg_write(UC_X86_REG_GS_BASE, bases['GS'])
+
+        # The symbolic bytes may have moved since the last run
+        for hook in self._symbolic_hooks:
+            self._emu.hook_del(hook)
+        self._symbolic_hooks = []
+        symbolic_pages = {address & ~(self.PAGE_SIZE - 1) for address in getattr(cpu.memory, '_symbols', ())}
+        for page in symbolic_pages:
+            end = page + self.PAGE_SIZE - 1
+            self._symbolic_hooks.append(self._emu.hook_add(UC_HOOK_MEM_READ, self._hook_symbolic_read, None, page, end))
+            self._symbolic_hooks.append(self._emu.hook_add(UC_HOOK_MEM_WRITE, self._hook_symbolic_write, None, page, end))
+
+        pc = cpu.PC
+        while True:
+            self._mapped = False
+            try:
+                self._emu.emu_start(pc, 0)
+            except UcError as e:
+                logger.debug("Unicorn stopped: %s", e)
+
+            pc = self.get_unicorn_pc()
+            block = self._block
+            if block is not None:
+                # Stopped inside the block or after it
+                executed = block.index(pc) if pc in block else len(block)
+                if executed:
+                    self._executed += executed
+                    self.last_pc = block[executed - 1]
+                self._block = None
+            if not self._mapped:
+                break
+
+        if self._executed == 0:
+            return 0
+
+        # Bring back Unicorn state to Manticore
+        for reg in registers:
+            value = self._emu.reg_read(self._to_unicorn_id(reg))
+            if value != values[reg]:
+                regfile.write(reg, value)
+
+        # Everything is read from Unicorn first, a write back to code drops it
+        # (see invalidate_cache)
+        symbols = getattr(cpu.memory, '_symbols', {})
+        written = [(address, bytes(self._emu.mem_read(address, 1)))
+                   for address in sorted(self._written) if address in symbols]
+        changed = []
+        for page, content in self._pages.items():
+            new_content = bytes(self._emu.mem_read(page, self.PAGE_SIZE))
+            if new_content != content:
+                changed.append((page, content, new_content))
+        for page, content, new_content in changed:
+            self._pages[page] = new_content
+            self._write_back(page, content, new_content)
+        for address, value in written:
+            cpu.memory.write(address, [value], force=True)
+        # Those writes are already in Unicorn
+        self._dirty.clear()
+
+        return self._executed
+
+    def _write_back(self, page, old, new):
+        ''' Writes the runs of bytes that differ between `old` and `new` '''
+        memory = self._cpu.memory
+        offset, size = 0, len(new)
+        while offset < size:
+            # Skip equal chunks at once
+            if old[offset:offset + 64] == new[offset:offset + 64]:
+                offset += 64
+                continue
+            while old[offset] == new[offset]:
+                offset += 1
+            start = offset
+            while offset < size and old[offset] != new[offset]:
+                offset += 1
+            memory.write(page + start, [bytes([b]) for b in new[start:offset]], force=True)
@@ -58,6 +58,13 @@ class Eventful(object, metaclass=EventsGatherMetaclass):
     # Event names prefixes
     prefixes = ('will_', 'did_', 'on_')
 
+    # Bumped on every subscription or forwarding change of any eventful object,
+    # to invalidate their caches of subscribed events
+    _subscriptions_version = 0
+
+    # (class, event name) pairs already checked to be declared
+    _checked_events = set()
+
     @classmethod
     def all_events(cls):
         '''
@@ -74,14 +81,23 @@ class Eventful(object, metaclass=EventsGatherMetaclass):
         self._signals = dict()
         # a set of sink eventful objects (see forward_events_from())
         self._forwards = WeakKeyDictionary()
+        # Whether each event name is subscribed, see _is_subscribed()
+        self._subscribed = dict()
+        self._subscribed_version = None
         super().__init__(*args, **kwargs)
 
     def __setstate__(self, state):
         ''' It wont get serialized by design, user is responsible to reconnect'''
         self._signals = dict()
         self._forwards = WeakKeyDictionary()
+        self._subscribed = dict()
+        self._subscribed_version = None
         return True
 
+    @staticmethod
+    def _subscriptions_changed():
+        Eventful._subscriptions_version += 1
+
     def __getstate__(self):
         return {}
 
@@ -98,6 +114,7 @@ class Eventful(object, metaclass=EventsGatherMetaclass):
                 remove.add(name)
         for name in remove:
             del self._signals[name]
+        self._subscriptions_changed()
 
     def _get_signal_bucket(self, name):
         # Each event name has a bucket of callback methods
@@ -105,12 +122,16 @@ class Eventful(object, metaclass=EventsGatherMetaclass):
         return self._signals.setdefault(name, dict())
 
     def _check_event(self, _name):
+        cls = self.__class__
+        if (cls, _name) in Eventful._checked_events:
+            return
+        Eventful._checked_events.add((cls, _name))
+
         basename = _name
         for prefix in self.prefixes:
             if _name.startswith(prefix):
                 basename = _name[len(prefix):]
 
-        cls = self.__class__
         if basename not in cls.__all_events__[cls]:
             logger.warning("Event '%s' not pre-declared. (self: %s)", _name, repr(self))
 
@@ -119,12 +140,13 @@ class Eventful(object, metaclass=EventsGatherMetaclass):
     # The underscore _name is to avoid naming collisions with callback params
     def _publish(self, _name, *args, **kwargs):
         self._check_event(_name)
-        self._publish_impl(_name, *args, **kwargs)
+        if self._is_subscribed(_name):
+            self._publish_impl(_name, *args, **kwargs)
 
     # Separate from _publish since the recursive method call to forward an event
     # shouldn't check the event.
     def _publish_impl(self, _name, *args, **kwargs):
-        bucket = self._get_signal_bucket(_name)
+        bucket = self._signals.get(_name, {})
         for robj, methods in bucket.items():
             for callback in methods:
                 callback(robj(), *args, **kwargs)
@@ -133,11 +155,31 @@ class Eventful(object, metaclass=EventsGatherMetaclass):
         # the callback signature. This is set on forward_events_from/to
         items = tuple(self._forwards.items())
         for sink, include_source in items:
+            if not sink._is_subscribed(_name):
+                continue
             if include_source:
                 sink._publish_impl(_name, self, *args, **kwargs)
             else:
                 sink._publish_impl(_name, *args, **kwargs)
 
+    def _is_subscribed(self, _name):
+        '''
+        Whether publishing the event would run any callback, here or in the
+        objects it is forwarded to. The result is cached until a subscription
+        or forwarding changes anywhere, so call sites can check it before
+        building the event arguments.
+        '''
+        if self._subscribed_version != Eventful._subscriptions_version:
+            self._subscribed = dict()
+            self._subscribed_version = Eventful._subscriptions_version
+        try:
+            return self._subscribed[_name]
+        except KeyError:
+            subscribed = bool(self._signals.get(_name)) or \
+                any(sink._is_subscribed(_name) for sink in tuple(self._forwards))
+            self._subscribed[_name] = subscribed
+            return subscribed
+
     def subscribe(self, name, method):
         if not inspect.ismethod(method):
             raise TypeError
@@ -145,6 +187,7 @@ class Eventful(object, metaclass=EventsGatherMetaclass):
         bucket = self._get_signal_bucket(name)
         robj = ref(obj, self._unref)  # see unref() for explanation
         bucket.setdefault(robj, set()).add(callback)
+        self._subscriptions_changed()
 
     def forward_events_from(self, source, include_source=False):
         if not isinstance(source, Eventful):
@@ -156,7 +199,9 @@ class Eventful(object, metaclass=EventsGatherMetaclass):
         if not isinstance(sink, Eventful):
             raise TypeError
         self._forwards[sink] = include_source
+        self._subscriptions_changed()
 
     def copy_eventful_state(self, new_object: 'Eventful'):
         new_object._forwards = copy.copy(self._forwards)
         new_object._signals = copy.copy(self._signals)
+        self._subscriptions_changed()
@@ -1,6 +1,7 @@
 import logging
 import pickle
 import sys
+from bisect import bisect_left, bisect_right
 from collections import OrderedDict
 
 import copy
@@ -72,8 +73,7 @@ def taint_with(arg, taint, value_bits=256, index_bits=256):
 
     if not issymbolic(arg):
         if isinstance(arg, int):
-            arg = BitVecConstant(value_bits, arg)
-            arg._taint = tainted_fset
+            arg = BitVecConstant(value_bits, arg, taint=tainted_fset)
         else:
             raise ValueError("type not supported")
 
@@ -95,6 +95,81 @@ def interval_intersection(min1, max1, min2, max2):
     return None
 
 
+class IntervalSet(object):
+    """
+    A set of integers kept as sorted, disjoint [start, end) intervals.
+    """
+
+    def __init__(self, intervals=()):
+        self._starts = []
+        self._ends = []
+        for start, end in intervals:
+            self.add(start, end)
+
+    def __reduce__(self):
+        return (self.__class__, (list(self),))
+
+    def __iter__(self):
+        return zip(self._starts, self._ends)
+
+    def __len__(self):
+        return sum(end - start for start, end in self)
+
+    def __bool__(self):
+        return bool(self._starts)
+
+    def __contains__(self, value):
+        i = bisect_right(self._starts, value) - 1
+        return i >= 0 and value < self._ends[i]
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}([{', '.join(f'({start:#x}, {end:#x})' for start, end in self)}])"
+
+    def add(self, start, end):
+        """ Adds the interval [start, end), merging it with the ones it touches """
+        if start >= end:
+            return
+        i = bisect_left(self._ends, start)
+        j = bisect_right(self._starts, end)
+        if i < j:
+            start, end = min(start, self._starts[i]), max(end, self._ends[j - 1])
+        self._starts[i:j] = [start]
+        self._ends[i:j] = [end]
+
+    def remove(self, start, end):
+        """ Removes the interval [start, end), trimming the ones it overlaps """
+        i = bisect_right(self._ends, start)
+        j = bisect_left(self._starts, end)
+        if i >= j:
+            return
+        starts, ends = [], []
+        if self._starts[i] < start:
+            starts.append(self._starts[i])
+            ends.append(start)
+        if self._ends[j - 1] > end:
+            starts.append(end)
+            ends.append(self._ends[j - 1])
+        self._starts[i:j] = starts
+        self._ends[i:j] = ends
+
+    def overlaps(self, start, end):
+        """ Whether any value in [start, end) is in the set """
+        i = bisect_right(self._ends, start)
+        return i < len(self._starts) and self._starts[i] < end
+
+    def gaps(self, start, end):
+        """ Yields the intervals of [start, end) that are not in the set """
+        i = bisect_right(self._ends, start)
+        for interval_start, interval_end in zip(self._starts[i:], self._ends[i:]):
+            if interval_start >= end:
+                break
+            if start < interval_start:
+                yield start, interval_start
+            start = max(start, interval_end)
+        if start < end:
+            yield start, end
+
+
 class CacheDict(OrderedDict):
     def __init__(self, *args, max_size=30000, flush_perc=30, **kwargs):
         self._max_size = max_size
@@ -0,0 +1,64 @@
+"""
+Benchmark of the concrete EVM tier.
+
+Runs the concrete instruction tests of tests/EVM with evm.concrete_tier
+enabled, keeping code, calldata and memory as bytes, and then disabled,
+keeping them in symbolic arrays. Reports the tests run and the time taken
+by each. Then creates VMs running the same 24KB of code, like the calls of
+a multi-transaction run, decoding every instruction of the code once per
+VM, with the code analysis cached and with the cache cleared for each VM.
+
+usage: python scripts/benchmark_evm.py [test name pattern] [VMs]
+"""
+import logging
+import os
+import sys
+import time
+import unittest
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, ROOT)
+
+from manticore.core.smtlib import ConstraintSet
+from manticore.platforms import evm
+
+# PUSH2, JUMPDEST, DUP1, ADD, POP repeated up to the maximum contract size
+BYTECODE = b'\x61\x00\x01\x5b\x80\x01\x50' * (0x6000 // 7)
+
+
+def run(pattern, concrete_tier):
+    evm.consts.concrete_tier = concrete_tier
+    suite = unittest.defaultTestLoader.discover(os.path.join(ROOT, 'tests', 'EVM'), pattern=pattern, top_level_dir=ROOT)
+    start = time.time()
+    result = unittest.TextTestRunner(stream=open(os.devnull, 'w')).run(suite)
+    return result, time.time() - start
+
+
+def create_vms(count, cached):
+    evm.consts.concrete_tier = True
+    constraints = ConstraintSet()
+    world = evm.EVMWorld(constraints)
+    start = time.time()
+    for _ in range(count):
+        if not cached:
+            evm.CodeAnalysis._cache.clear()
+        vm = evm.EVM(constraints, 0x1, b'', 0x2, 0, BYTECODE, gas=1000000, world=world)
+        while vm.pc < len(BYTECODE):
+            vm.pc += vm.instruction.size
+    return time.time() - start
+
+
+if __name__ == "__main__":
+    pattern = sys.argv[1] if len(sys.argv) > 1 else 'eth_*.py'
+    vms = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    logging.getLogger('manticore').setLevel(logging.ERROR)
+    os.chdir(ROOT)
+    for concrete_tier in (True, False):
+        result, elapsed = run(pattern, concrete_tier)
+        failed = len(result.failures) + len(result.errors)
+        label = 'concrete tier' if concrete_tier else 'symbolic arrays'
+        print(f"  {label:16} {result.testsRun:5} tests, {failed} failed, {elapsed:6.2f}s")
+    for cached in (True, False):
+        elapsed = create_vms(vms, cached)
+        label = 'analysis cached' if cached else 'analysis per VM'
+        print(f"  {label:16} {vms:5} VMs, {vms / elapsed:8.1f} VMs/s")
@@ -0,0 +1,73 @@
+"""
+Benchmark of the cost of pc hooks on native execution.
+
+Runs the Linux test binaries like benchmark_native.py with no hooks, then
+with 1000 hooks on addresses never executed plus one on the entry point.
+The hooks are dispatched as Manticore.add_hook does, through the cpu table
+of hooked addresses, and then through a will_execute_instruction
+subscriber looking every address up, as it did before the table. Reports
+the hooks hit and the instructions per second.
+
+usage: python scripts/benchmark_hooks.py [max instructions] [hooks]
+"""
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from manticore.core.state import TerminateState
+from manticore.native.manticore import _make_linux
+
+from benchmark_native import PROGRAMS
+
+BINARIES = os.path.join(os.path.dirname(__file__), '..', 'tests', 'binaries')
+
+
+class Hooks:
+    def __init__(self, pcs):
+        self.pcs = pcs
+        self.hits = 0
+
+    def on_pc(self, pc, insn):
+        if pc in self.pcs:
+            self.hits += 1
+
+
+def run(program, argv, stdin, limit, hooks, dispatch):
+    state = _make_linux(os.path.join(BINARIES, program), argv, concrete_start=stdin, stdin_size=0)
+    cpu = state.cpu
+    pcs = {0x7f000000 + i * 4 for i in range(hooks)}
+    if hooks:
+        pcs.add(cpu.PC)
+    subscriber = Hooks(pcs)
+    if dispatch == 'table':
+        cpu.hooked_pcs = pcs
+        state.subscribe('will_execute_hooked_instruction', subscriber.on_pc)
+    elif dispatch == 'all':
+        state.subscribe('will_execute_instruction', subscriber.on_pc)
+    start = time.time()
+    try:
+        while cpu.icount < limit:
+            state.execute()
+    except TerminateState:
+        pass
+    return cpu.icount, subscriber.hits, time.time() - start
+
+
+if __name__ == "__main__":
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    hooks = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    logging.getLogger('manticore').setLevel(logging.ERROR)
+    # Warm up the instructions decoded once per process
+    for program, argv, stdin in PROGRAMS:
+        run(program, argv, stdin, limit, 0, None)
+
+    for count, dispatch in ((0, None), (hooks, 'table'), (hooks, 'all')):
+        total, elapsed, hits = 0, 0, 0
+        for program, argv, stdin in PROGRAMS:
+            instructions, hit, seconds = run(program, argv, stdin, limit, count, dispatch)
+            total, elapsed, hits = total + instructions, elapsed + seconds, hits + hit
+        label = f"{count} hooks" + (f", {dispatch} dispatch" if dispatch else '')
+        print(f"  {label:28} {hits:3} hits, {total / elapsed:8.0f} instructions/s")
@@ -0,0 +1,62 @@
+"""
+Benchmark of the native instructions per second on concrete inputs.
+
+Runs the Linux test binaries with concrete arguments and stdin, stepping a
+single state without an executor, and reports the instructions executed
+per second. With a reload period, the state is reloaded from a pickle every
+that many instructions, the way workers load forked states, so the code is
+decoded again for each loaded state.
+
+usage: python scripts/benchmark_native.py [max instructions] [instructions per load]
+"""
+import logging
+import os
+import pickle
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from manticore.core.state import TerminateState
+from manticore.native.manticore import _make_linux
+
+BINARIES = os.path.join(os.path.dirname(__file__), '..', 'tests', 'binaries')
+
+PROGRAMS = [
+    ('basic_linux_amd64', [], 'AAAA'),
+    ('basic_linux_armv7', [], 'AAAA'),
+    ('arguments_linux_amd64', ['--dostuff'], ''),
+    ('arguments_linux_armv7', ['--dostuff'], ''),
+    ('brk_static_amd64', [], ''),
+]
+
+
+def run(program, argv, stdin, limit, period=0):
+    state = _make_linux(os.path.join(BINARIES, program), argv, concrete_start=stdin, stdin_size=0)
+    start = time.time()
+    try:
+        while state.cpu.icount < limit:
+            if period:
+                state = pickle.loads(pickle.dumps(state))
+            cpu = state.cpu
+            stop = cpu.icount + period if period else limit
+            while cpu.icount < stop:
+                state.execute()
+    except TerminateState:
+        pass
+    return state.cpu.icount, time.time() - start
+
+
+if __name__ == "__main__":
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    period = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    logging.getLogger('manticore').setLevel(logging.ERROR)
+
+    if period:
+        print(f"[*] Loading the state every {period} instructions")
+    total, elapsed = 0, 0
+    for program, argv, stdin in PROGRAMS:
+        count, seconds = run(program, argv, stdin, limit, period)
+        total, elapsed = total + count, elapsed + seconds
+        print(f"  {program:24} {count:8} instructions, {count / seconds:8.0f} instructions/s")
+    print(f"  {'total':24} {total:8} instructions, {total / elapsed:8.0f} instructions/s")
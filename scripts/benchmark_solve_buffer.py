@@ -0,0 +1,51 @@
+"""
+Benchmark of solving symbolic buffers.
+
+Makes 4KB of symbolic input, like a symbolic stdin, starting with a header
+of printable bytes where every other byte follows the previous one, and
+times solving it with Z3Solver.get_value, which gets all the bytes in a
+single get-value, then with one get_value per byte, as buffers were solved
+before.
+
+usage: python scripts/benchmark_solve_buffer.py [size]
+"""
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from manticore.core.smtlib import ConstraintSet, Z3Solver
+
+
+def make_input(size, header=64):
+    constraints = ConstraintSet()
+    data = constraints.new_array(index_max=size, name='stdin')
+    for i in range(header):
+        constraints.add(data[i] >= 0x20)
+        constraints.add(data[i] < 0x7f)
+        if i % 2:
+            constraints.add(data[i] == data[i - 1] + 1)
+    return constraints, data
+
+
+def solve(constraints, data, bulk):
+    solver = Z3Solver()
+    start = time.time()
+    if bulk:
+        value = solver.get_value(constraints, data)
+    else:
+        value = bytes(solver.get_value(constraints, data[i]) for i in range(len(data)))
+    return value, time.time() - start
+
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 4096
+    logging.getLogger('manticore').setLevel(logging.ERROR)
+    constraints, data = make_input(size)
+    for bulk in (True, False):
+        value, elapsed = solve(constraints, data, bulk)
+        assert all(value[i] == value[i - 1] + 1 for i in range(1, 64, 2))
+        label = 'one get-value' if bulk else 'per byte'
+        print(f"  {label:14} {size:5} bytes, {elapsed:7.2f}s")
@@ -1,4 +1,5 @@
 import binascii
+import json
 import unittest
 from contextlib import contextmanager
 from pathlib import Path
@@ -407,6 +408,42 @@ class EthInstructionTests(unittest.TestCase):
         result = vm.SDIV(xx, yy)
         self.assertListEqual(list(map(evm.to_signed, solver.get_all_values(constraints, result))), [vm.SDIV(x, y)])
 
+    def test_concrete_memory(self):
+        constraints, world, vm = self._make()
+        self.assertIsInstance(vm.data, bytes)
+        vm.MSTORE(0x20, 0x4142)
+        vm.MSTORE8(0x3f, 0x43)
+        self.assertIsInstance(vm.memory, bytearray)
+        self.assertEqual(vm.MLOAD(0x20), 0x4143)
+        self.assertEqual(vm.read_buffer(0x3e, 4), b'AC\x00\x00')
+
+        # The first symbolic value moves the memory to an array
+        xx = constraints.new_bitvec(256, name="x")
+        constraints.add(xx == 0x44)
+        vm.MSTORE(0x40, xx)
+        self.assertNotIsInstance(vm.memory, bytearray)
+        self.assertEqual(solver.get_all_values(constraints, vm.MLOAD(0x20)), [0x4143])
+        self.assertEqual(solver.get_all_values(constraints, vm.MLOAD(0x40)), [0x44])
+
+    def test_code_analysis(self):
+        constraints, world, vm = self._make()
+        # PUSH2 0x5b5b JUMPDEST PUSH1, with its operand past the end
+        bytecode = b'\x61\x5b\x5b\x5b\x60'
+        vm = evm.EVM(constraints, 0x1, b'', 0x2, 0, bytecode, gas=1000000, world=world)
+        other = evm.EVM(constraints, 0x3, b'', 0x2, 0, bytes(bytecode), gas=1000000, world=world)
+        self.assertEqual(vm._valid_jumpdests, {3})
+        self.assertIs(vm._code_analysis, other._code_analysis)
+
+        vm.pc = other.pc = 4
+        self.assertIs(vm.instruction, other.instruction)
+        self.assertEqual((vm.instruction.name, vm.instruction.operand), ('PUSH1', 0))
+
+        # The jumpdests of concrete code are not pickled, they come from its analysis
+        import pickle
+        self.assertNotIn('_valid_jumpdests', vm.__getstate__())
+        vm = pickle.loads(pickle.dumps(vm))
+        self.assertIs(vm._valid_jumpdests, other._code_analysis.jumpdests)
+
 
 class EthTests(unittest.TestCase):
     def setUp(self):
@@ -535,6 +572,24 @@ class EthTests(unittest.TestCase):
         with open(summary_path) as summary:
             self.assertNotIn('return can be 0 again?', summary.read())
 
+    def test_gen_testcase_one_model(self):
+        user_account = self.mevm.create_account(balance=1000)
+        # Its runtime code is a single STOP
+        init = EVMAsm.assemble('PUSH1 0x0\nPUSH1 0x0\nMSTORE8\nPUSH1 0x1\nPUSH1 0x0\nRETURN')
+        contract_account = self.mevm.create_contract(owner=user_account, init=init, gas=90000)
+        value = self.mevm.make_symbolic_value()
+        self.mevm.constrain(value > 10)
+        self.mevm.transaction(caller=user_account, address=contract_account, value=value, data=b'')
+        state = next(self.mevm.running_states)
+        self.mevm.generate_testcase(state, 'one model')
+
+        # The balances of the summary are those left by the transactions
+        with open(os.path.join(self.mevm.workspace, 'user_00000000.tx.json')) as txjson:
+            tx_value = json.load(txjson)[-1]['value']
+        with open(os.path.join(self.mevm.workspace, 'user_00000000.summary')) as summary:
+            balances = re.findall(r'Balance: (\d+)', summary.read())
+        self.assertEqual(sorted(map(int, balances)), sorted([1000 - tx_value, tx_value]))
+
     def test_function_name_with_signature(self):
         source_code = '''
         contract Test {
@@ -960,6 +1015,21 @@ class EthHelpersTest(unittest.TestCase):
         # wasn't requested.
         inner_func(None, self.bv, 123)
 
+    def test_evm_trace(self):
+        from manticore.ethereum.manticore import EVMTrace
+        import pickle
+
+        entries = [(0x10, 0, True), (0x10, 2, True), (0x10, 0, False), (0x20, 0, False), (0x20, 5, False), (0x10, 3, False)]
+        trace = EVMTrace()
+        for entry in entries:
+            trace.append(*entry)
+
+        trace = pickle.loads(pickle.dumps(trace))
+        self.assertEqual(list(trace), entries)
+        self.assertEqual(len(trace), len(entries))
+        self.assertEqual(trace[-1], (0x10, 3, False))
+        self.assertEqual(trace[3], (0x20, 0, False))
+
 
 class EthSolidityCompilerTest(unittest.TestCase):
     def test_run_solc(self):
@@ -1146,6 +1146,114 @@ Using the SAR instruction to perform a division operation does not produce the s
 
         self.assertEqual(cpu.EIP, code+1)
 
+    def test_execute_block(self):
+        cs = ConstraintSet()
+        mem = SMemory64(cs)
+        cpu = AMD64Cpu(mem)
+        code = mem.mmap(0x1000, 0x1000, 'rwx')
+
+        # inc rax; inc rax; jmp 0x1000
+        mem.write(code, b'\x48\xff\xc0\x48\xff\xc0\xeb\xf8')
+        cpu.RIP = code
+        cpu.RAX = 0
+        cpu.execute_block()
+        self.assertEqual((cpu.RAX, cpu.RIP, cpu.icount), (2, code, 3))
+
+        # The written code replaces the decoded block: inc rbx
+        cpu.RBX = 0
+        mem.write(code + 3, b'\x48\xff\xc3')
+        cpu.execute_block()
+        self.assertEqual((cpu.RAX, cpu.RBX, cpu.RIP), (3, 1, code))
+
+        # A single instruction at a time while instruction events are subscribed
+        class Receiver(object):
+            def __init__(self):
+                self.pcs = []
+
+            def will_exec(self, pc, insn):
+                self.pcs.append(pc)
+
+        receiver = Receiver()
+        cpu.subscribe('will_execute_instruction', receiver.will_exec)
+        cpu.execute_block()
+        self.assertEqual((cpu.RAX, cpu.RIP, receiver.pcs), (4, code + 3, [code]))
+
+        mem.mprotect(code, 0x1000, 'rw')
+        with self.assertRaises(InvalidMemoryAccess):
+            cpu.execute_block()
+
+    def test_decode_shared(self):
+        cpus = []
+        for code in (b'\x48\xff\xc0', b'\x48\xff\xc0', b'\x48\xff\xc3'):
+            mem = SMemory64(ConstraintSet())
+            mem.mmap(0x1000, 0x1000, 'rwx')
+            mem.write(0x1000, code)
+            cpus.append(AMD64Cpu(mem))
+        insns = [cpu.decode_instruction(0x1000) for cpu in cpus]
+
+        # The same code is decoded once, and its operands wrapped for each cpu
+        self.assertIs(insns[0]._raw, insns[1]._raw)
+        self.assertIsNot(insns[0], insns[1])
+        self.assertIs(insns[1].operands[0].cpu, cpus[1])
+        self.assertEqual([insn.op_str for insn in insns], ['rax', 'rax', 'rbx'])
+
+        cpus[1].memory.write(0x1002, b'\xc3')
+        self.assertEqual(cpus[1].decode_instruction(0x1000).op_str, 'rbx')
+        self.assertEqual(cpus[0].decode_instruction(0x1000).op_str, 'rax')
+
+    def test_execute_block_self_modifying(self):
+        cs = ConstraintSet()
+        mem = SMemory64(cs)
+        cpu = AMD64Cpu(mem)
+        code = mem.mmap(0x1000, 0x1000, 'rwx')
+
+        # mov byte ptr [rip + 2], 0xc3; inc rax; jmp 0x1000
+        mem.write(code, b'\xc6\x05\x02\x00\x00\x00\xc3\x48\xff\xc0\xeb\xf4')
+        cpu.RIP = code
+        cpu.RAX = cpu.RBX = 0
+
+        # The block stops after writing to its own code, which now reads inc rbx
+        cpu.execute_block()
+        self.assertEqual(cpu.RIP, code + 7)
+        cpu.execute_block()
+        self.assertEqual((cpu.RAX, cpu.RBX, cpu.RIP), (0, 1, code))
+
+    def test_execute_block_hooked_pcs(self):
+        cs = ConstraintSet()
+        mem = SMemory64(cs)
+        cpu = AMD64Cpu(mem)
+        code = mem.mmap(0x1000, 0x1000, 'rwx')
+
+        # inc rax; inc rax; inc rax; jmp 0x1000
+        mem.write(code, b'\x48\xff\xc0\x48\xff\xc0\x48\xff\xc0\xeb\xf5')
+
+        class Receiver(object):
+            def __init__(self):
+                self.pcs = []
+
+            def will_exec_hooked(self, pc, insn):
+                self.pcs.append(pc)
+                # Skip the last inc
+                if pc == code + 6:
+                    cpu.RIP = code + 9
+
+        receiver = Receiver()
+        cpu.subscribe('will_execute_hooked_instruction', receiver.will_exec_hooked)
+        cpu.hooked_pcs = {code + 3, code + 6}
+        cpu.RIP = code
+        cpu.RAX = 0
+
+        # The event is only published at the hooked addresses, and the block
+        # stops where a hook moves the pc
+        cpu.execute_block()
+        self.assertEqual((cpu.RAX, cpu.RIP, receiver.pcs), (2, code + 9, [code + 3, code + 6]))
+        cpu.execute_block()
+        self.assertEqual((cpu.RAX, cpu.RIP), (2, code))
+
+        cpu.hooked_pcs.add(code)
+        cpu.execute_block()
+        self.assertEqual(receiver.pcs[2:], [code, code + 3, code + 6])
+
 
 if __name__ == '__main__':
     unittest.main()
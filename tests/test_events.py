@@ -73,3 +73,31 @@ class ManticoreDriver(unittest.TestCase):
         self.assertSequenceEqual(c.received, [(1, 'a'), (2, 'b')])
 
 
+
+    def test_subscribed(self):
+        a = A()
+        b = B(a)
+        c = C()
+        self.assertFalse(a._is_subscribed('eventA'))
+
+        # Nothing is delivered nor forwarded until something subscribes
+        a.do_stuff()
+        self.assertEqual(len(b._signals), 0)
+
+        b.subscribe('eventA', c.callback)
+        self.assertTrue(a._is_subscribed('eventA'))
+        self.assertFalse(a._is_subscribed('eventB'))
+        a.do_stuff()
+        self.assertSequenceEqual(c.received, [(1, 'a')])
+
+        # Forwarding to a new sink with subscribers
+        other = A()
+        self.assertFalse(other._is_subscribed('eventA'))
+        b.forward_events_from(other)
+        self.assertTrue(other._is_subscribed('eventA'))
+        other.do_stuff()
+        self.assertSequenceEqual(c.received, [(1, 'a'), (1, 'a')])
+
+        del c
+        self.assertFalse(a._is_subscribed('eventA'))
+        self.assertFalse(other._is_subscribed('eventA'))
@@ -0,0 +1,105 @@
+import random
+import unittest
+
+from manticore.core.executor import Executor, StateQueue
+from manticore.exceptions import ExecutorError
+
+
+class StateQueueTest(unittest.TestCase):
+    def test_priority_order(self):
+        queue = StateQueue(100)
+        priorities = list(range(50))
+        random.shuffle(priorities)
+        for state_id, priority in enumerate(priorities):
+            queue.push(state_id, priority)
+        self.assertEqual(len(queue), 50)
+        self.assertEqual(sorted(queue.ids()), list(range(50)))
+
+        popped = [priorities[queue.pop()] for _ in range(50)]
+        self.assertEqual(popped, list(range(50)))
+        self.assertEqual(len(queue), 0)
+
+    def test_remove(self):
+        queue = StateQueue(100)
+        for state_id in range(20):
+            queue.push(state_id, 20 - state_id)
+        for state_id in (5, 19, 0, 11):
+            queue.remove(state_id)
+        self.assertEqual([queue.pop() for _ in range(len(queue))],
+                         [i for i in reversed(range(20)) if i not in (5, 19, 0, 11)])
+
+    def test_full(self):
+        queue = StateQueue(2)
+        queue.push(1)
+        queue.push(2)
+        with self.assertRaises(ExecutorError):
+            queue.push(3)
+
+
+class ExecutorQueueTest(unittest.TestCase):
+    def test_random(self):
+        executor = Executor(store='mem:', policy='random')
+        for state_id in range(10):
+            executor.put(state_id)
+        self.assertEqual(sorted(executor.list()), list(range(10)))
+        self.assertEqual(sorted(executor.get() for _ in range(10)), list(range(10)))
+        self.assertEqual(executor.list(), [])
+        # No state left and no worker running
+        self.assertIsNone(executor.get())
+
+    def test_choice(self):
+        executor = Executor(store='mem:', policy='branchlimited')
+        executor._policy.choice = lambda state_ids: max(state_ids)
+        for state_id in (3, 7, 1):
+            executor.put(state_id)
+        self.assertEqual([executor.get() for _ in range(3)], [7, 3, 1])
+
+
+class ContextBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.executor = Executor(store='mem:')
+        self.buffer = self.executor.buffered_context
+        self.buffer._interval = float('inf')
+
+    def test_flush(self):
+        with self.executor.locked_context() as context:
+            context['visited'] = {1}
+            context['count'] = 3
+        self.buffer.add('visited', 2)
+        self.buffer.add('visited', 1)
+        self.buffer.increment('count')
+        self.buffer.increment('count', amount=2)
+        self.buffer.increment('hits', 0x10)
+        self.buffer.increment('hits', 0x10)
+        self.buffer.increment('hits', 0x20)
+        self.buffer.update('summaries', {1: 'a'})
+        self.buffer.mark('coverage', 0x10, 3)
+        self.buffer.mark('coverage', 0x10, 17)
+        self.buffer.mark('coverage', 0x20, 0)
+
+        # Nothing is shared before the flush
+        with self.executor.locked_context() as context:
+            self.assertEqual(context['visited'], {1})
+            self.assertNotIn('hits', context)
+
+        self.buffer.flush()
+        self.assertFalse(self.buffer)
+        with self.executor.locked_context() as context:
+            self.assertEqual(context['visited'], {1, 2})
+            self.assertEqual(context['count'], 6)
+            self.assertEqual(context['hits'], {0x10: 2, 0x20: 1})
+            self.assertEqual(context['summaries'], {1: 'a'})
+            self.assertEqual(context['coverage'], {0x10: 1 << 3 | 1 << 17, 0x20: 1})
+
+        self.buffer.increment('hits', 0x20)
+        self.buffer.mark('coverage', 0x20, 3)
+        self.buffer.flush()
+        with self.executor.locked_context() as context:
+            self.assertEqual(context['hits'], {0x10: 2, 0x20: 2})
+            self.assertEqual(context['coverage'], {0x10: 1 << 3 | 1 << 17, 0x20: 1 | 1 << 3})
+
+    def test_interval(self):
+        self.buffer._interval = 0
+        self.buffer.add('visited', 1)
+        with self.executor.locked_context() as context:
+            self.assertEqual(context['visited'], {1})
@@ -10,7 +10,7 @@ from itertools import *
 import sys
 
 from manticore.native.memory import *
-from manticore.utils.helpers import issymbolic
+from manticore.utils.helpers import issymbolic, IntervalSet
 from manticore.core.smtlib import Solver, Operators
 from manticore.core.smtlib.expression import *
 from manticore.core.smtlib.visitors import *
@@ -265,6 +265,74 @@ class LazyMemoryTest(unittest.TestCase):
         # There are 16 spans with 0x48 in [0x1000, 0x2000]
         self.assertEqual(len(possible_addrs), Size // PatternSize)
 
+    def test_interval_set(self):
+        s = IntervalSet([(0x10, 0x20), (0x30, 0x40)])
+        self.assertEqual(list(s), [(0x10, 0x20), (0x30, 0x40)])
+        self.assertIn(0x10, s)
+        self.assertNotIn(0x20, s)
+        self.assertEqual(list(s.gaps(0, 0x50)), [(0, 0x10), (0x20, 0x30), (0x40, 0x50)])
+        self.assertEqual(list(s.gaps(0x18, 0x38)), [(0x20, 0x30)])
+        self.assertTrue(s.overlaps(0x1f, 0x21))
+        self.assertFalse(s.overlaps(0x20, 0x30))
+
+        s.add(0x20, 0x30)
+        self.assertEqual(list(s), [(0x10, 0x40)])
+        s.remove(0x18, 0x28)
+        self.assertEqual(list(s), [(0x10, 0x18), (0x28, 0x40)])
+        s.remove(0, 0x30)
+        self.assertEqual(list(s), [(0x30, 0x40)])
+        self.assertEqual(len(s), 0x10)
+        self.assertEqual(list(pickle.loads(pickle.dumps(s))), [(0x30, 0x40)])
+
+    def test_lazysymbolic_import(self):
+        cs = ConstraintSet()
+        mem = LazySMemory32(cs)
+        mem.mmap(0x1000, 0x1000, 'rw')
+        mem.mmap(0x3000, 0x1000, 'rw')
+        mem.write(0x1000, bytes(range(256)) * 16)
+
+        addr = cs.new_bitvec(32)
+        cs.add(addr.uge(0x1ff0))
+        cs.add(addr.ule(0x3010))
+        val = mem.read(addr, 1)[0]
+
+        # Only the mapped bytes are imported, in bulk
+        self.assertEqual(list(mem._imported), [(0x1ff0, 0x2000), (0x3000, 0x3011)])
+        with cs as temp_cs:
+            temp_cs.add(addr == 0x1ff5)
+            self.assertEqual(solver.get_all_values(temp_cs, val), [0xf5])
+
+        # Reads through concrete addresses stay concrete until a symbolic write
+        self.assertEqual(mem.read(0x1ff5, 1), [b'\xf5'])
+        mem.write(addr, [b'\x00'])
+        self.assertEqual(list(mem.backed_by_symbolic_store), [(0x1ff0, 0x2000), (0x3000, 0x3011)])
+        self.assertTrue(issymbolic(mem.read(0x1ff5, 1)[0]))
+        self.assertEqual(sorted(solver.get_all_values(cs, mem.read(0x1ff5, 1)[0])), [0, 0xf5])
+
+        # A concrete write takes the address back
+        mem.write(0x1ff5, b'\x42')
+        self.assertEqual(mem.read(0x1ff5, 1), [b'\x42'])
+        mem.read(addr, 1)
+        mem = pickle.loads(pickle.dumps(mem))
+        self.assertEqual(list(mem._imported), [(0x1ff0, 0x2000), (0x3000, 0x3011)])
+        self.assertEqual(solver.get_all_values(cs, mem.read(0x1ff5, 1)[0]), [b'\x42'])
+
+    def test_lazysymbolic_write_int(self):
+        cs = ConstraintSet()
+        mem = LazySMemory32(cs)
+        mem.mmap(0x1000, 0x1000, 'rw')
+        addr = cs.new_bitvec(32)
+        cs.add(addr.uge(0x1000))
+        cs.add(addr.ule(0x1010))
+        mem.read(addr, 1)
+
+        # Imported bytes written through the concrete fast path are imported again
+        mem.write_int(0x1005, 0x41, 8)
+        val = mem.read(addr, 1)[0]
+        with cs as temp_cs:
+            temp_cs.add(addr == 0x1005)
+            self.assertEqual(solver.get_all_values(temp_cs, val), [0x41])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,6 @@
 import unittest
 import os
+import tempfile
 
 from manticore.native import Manticore
 
@@ -24,6 +25,63 @@ class ManticoreTest(unittest.TestCase):
         self.m.add_hook(entry, tmp)
         self.assertTrue(tmp in self.m._hooks[entry])
 
+    def test_apply_model_hooks(self):
+        from manticore.native.models import strlen, memcpy
+
+        class FakeState:
+            invoked = []
+
+            def invoke_model(self, model):
+                self.invoked.append(model)
+
+        with tempfile.NamedTemporaryFile('w') as models:
+            models.write('0x400e40 cdecl native.models.strlen\n0x400e70 cdecl native.models.memcpy\n')
+            models.flush()
+            self.m.apply_model_hooks(models.name)
+
+        for address in (0x400e40, 0x400e70):
+            self.m._model_hook_callback(FakeState(), address, None)
+        self.assertEqual(FakeState.invoked, [strlen, memcpy])
+
+    def test_hook_pc(self):
+        self.m.context['hits'] = 0
+
+        @self.m.hook(0x00400e40)
+        def tmp(state):
+            with self.m.locked_context() as context:
+                context['hits'] += 1
+        self.m.run()
+
+        # Only the hooked address publishes an event, instructions run in blocks
+        self.assertEqual(self.m.context['hits'], 1)
+        self.assertFalse(self.m._executor._is_subscribed('will_execute_instruction'))
+
+    def test_load_assertions(self):
+        self.m.context['terminated'] = []
+
+        def terminated(m, state, state_id, exception):
+            with m.locked_context() as context:
+                context['terminated'] += [str(exception)]
+        self.m.subscribe('will_terminate_state', terminated)
+
+        with tempfile.NamedTemporaryFile('w') as assertions:
+            assertions.write('400e40 (RSP == 0) || (QWORD PTR [RSP] == 0)\n')
+            assertions.flush()
+            self.m.load_assertions(assertions.name)
+        self.m.run()
+
+        # argc is 1 on entry, the only state is terminated at the assertion
+        self.assertEqual(self.m.context['terminated'], ['Assertion does not hold'])
+
+    def test_parse_assertions(self):
+        from manticore.core.parser.parser import parse
+        registers = {'EAX': 1, 'EBX': 2}.get
+        self.assertTrue(parse('EAX == 1 && EBX == 2', read_register=registers))
+        self.assertFalse(parse('EAX == 1 && EBX == 3', read_register=registers))
+        self.assertTrue(parse('EAX == 2 || EBX << 1 == 4', read_register=registers))
+        self.assertTrue(parse('EAX && EBX', read_register=registers))
+        self.assertFalse(parse('!EAX', read_register=registers))
+
     def test_hook_dec(self):
         entry = 0x00400e40
         @self.m.hook(entry)
@@ -12,6 +12,7 @@ from io import BytesIO
 
 from manticore.core.smtlib import Expression
 from manticore.native.memory import *
+from manticore.core.state import ForkState
 from manticore import issymbolic
 
 
@@ -1195,6 +1196,76 @@ class MemoryTest(unittest.TestCase):
         self.assertIn(Operators.ORD('B'), values)
         self.assertIn(Operators.ORD('C'), values)
 
+    def test_symbolic_read_strategies(self):
+        cs = ConstraintSet()
+        mem = SMemory32(cs)
+        addr = mem.mmap(None, 0x2000, 'rw')
+        mem.write(addr, bytes(range(256)) * 0x20)
+        symbol = cs.new_bitvec(8)
+        mem[addr + 0x150] = symbol
+
+        def read(address):
+            reads = dict(symbolic_reads)
+            result = mem.read(address, 2)
+            used = [strategy for strategy in reads if symbolic_reads[strategy] != reads[strategy]]
+            return used, result
+
+        # Few solutions, if-then-else
+        x = cs.new_bitvec(32)
+        cs.add(Operators.OR(x == addr + 0x10, x == addr + 0x20))
+        used, result = read(x)
+        self.assertEqual(used, ['ite'])
+        self.assertEqual(sorted(solver.get_all_values(cs, Operators.ORD(result[1]))), [0x11, 0x21])
+
+        # Many solutions in a small range, array
+        y = cs.new_bitvec(32)
+        cs.add(y >= addr + 0x100)
+        cs.add(y < addr + 0x180)
+        used, result = read(y)
+        self.assertEqual(used, ['array'])
+        with cs as temp_cs:
+            temp_cs.add(y == addr + 0x14f)
+            temp_cs.add(symbol == 0x42)
+            self.assertEqual(solver.get_all_values(temp_cs, Operators.ORD(result[0])), [0x4f])
+            self.assertEqual(solver.get_all_values(temp_cs, Operators.ORD(result[1])), [0x42])
+
+        # Reads in the same range reuse the array without constraining it again
+        constraints = len(cs)
+        used, result = read(y)
+        self.assertEqual(used, ['array'])
+        self.assertEqual(len(cs), constraints)
+
+        # Written bytes are imported again
+        mem[addr + 0x151] = b'\x99'
+        used, result = read(y)
+        self.assertEqual(len(cs), constraints)
+        with cs as temp_cs:
+            temp_cs.add(y == addr + 0x150)
+            self.assertEqual(solver.get_all_values(temp_cs, Operators.ORD(result[1])), [0x99])
+        mem.write_int(addr + 0x152, 0x41, 8)
+        used, result = read(y)
+        with cs as temp_cs:
+            temp_cs.add(y == addr + 0x151)
+            self.assertEqual(solver.get_all_values(temp_cs, Operators.ORD(result[1])), [0x41])
+
+        # Ranges reaching unmapped memory are invalid
+        z = cs.new_bitvec(32)
+        cs.add(z >= addr + 0x1f00)
+        cs.add(z < addr + 0x2000)
+        with self.assertRaises(InvalidSymbolicMemoryAccess):
+            read(z)
+
+        # Wide ranges fork
+        w = cs.new_bitvec(32)
+        cs.add(w >= addr)
+        cs.add(w < addr + 0x1ff0)
+        consts.symbolic_array_max = 0x100
+        try:
+            with self.assertRaises(ForkState):
+                read(w)
+        finally:
+            consts.symbolic_array_max = 0x1000
+
     def testBasicSymbolic(self):
         cs = ConstraintSet()
         mem = SMemory32(cs)
@@ -1636,6 +1707,102 @@ class MemoryTest(unittest.TestCase):
         self.assertItemsEqual(m[0x10000000:0x10000003], b'YZ\x00')
 
 
+    def test_mmap_anon_symbolic(self):
+        cs = ConstraintSet()
+        value = cs.new_bitvec(8)
+        m = AnonMap(0x10000000, 0x3000, 'rwx', 'X' * 0x3000)
+        m[0x10001001] = value
+
+        # The symbolic byte goes to the overlay, the contents stay concrete
+        self.assertIsInstance(m._data, bytearray)
+        self.assertEqual(list(m._symbols), [1])
+        self.assertIs(m[0x10001001], value)
+        self.assertEqual(m[0x10001000:0x10001003], [b'X', value, b'X'])
+        self.assertIsNone(m.concrete(slice(0x10001000, 0x10001003)))
+        self.assertEqual(bytes(m.concrete(slice(0x10001002, 0x10001004))), b'XX')
+
+        head, tail = m.split(0x10001001)
+        self.assertEqual(head._symbols, {})
+        self.assertIs(tail[0x10001001], value)
+
+        m = pickle.loads(pickle.dumps(m))
+        self.assertEqual(m[0x10001001].name, value.name)
+
+        # A concrete write clears the symbolic bytes
+        m[0x10001000:0x10001004] = 'abcd'
+        self.assertEqual(m._symbols, {})
+        self.assertEqual(m[0x10001000:0x10001004], [b'a', b'b', b'c', b'd'])
+
+    def test_mem_write_mixed(self):
+        cs = ConstraintSet()
+        mem = SMemory32(cs)
+        addr = mem.mmap(None, 0x2000, 'rw')
+        value = cs.new_bitvec(8)
+        mem.write(addr + 0xffe, [b'a', value, b'b', b'c'])
+
+        self.assertEqual(list(mem._symbols), [addr + 0xfff])
+        self.assertEqual(mem.read(addr + 0xffe, 4), [b'a', value, b'b', b'c'])
+
+        mem.write(addr + 0xfff, 'z')
+        self.assertEqual(mem._symbols, {})
+        self.assertEqual(mem.read(addr + 0xffe, 4), [b'a', b'z', b'b', b'c'])
+
+    def test_mem_int(self):
+        cs = ConstraintSet()
+        mem = SMemory32(cs)
+        addr = mem.mmap(None, 0x2000, 'rw')
+        mem.write_int(addr + 0xffc, 0x1122334455667788, 64)
+
+        # Concrete, and across maps
+        self.assertEqual(mem.read(addr + 0xffc, 2), [b'\x88', b'\x77'])
+        self.assertEqual(mem.read_int(addr + 0xffc, 64), 0x1122334455667788)
+        mem.mprotect(addr + 0x1000, 0x1000, 'rw')
+        self.assertEqual(mem.read_int(addr + 0xffe, 32), 0x33445566)
+        self.assertEqual(mem.read_int(addr + 0xffe, 16), 0x5566)
+
+        # Symbolic bytes
+        value = cs.new_bitvec(8)
+        mem.write(addr + 0x1001, [value])
+        result = mem.read_int(addr + 0xffe, 32)
+        self.assertTrue(issymbolic(result))
+        self.assertTrue(solver.must_be_true(cs, Operators.EXTRACT(result, 0, 24) == 0x445566))
+        mem.write_int(addr + 0x1000, cs.new_bitvec(16), 16)
+        self.assertTrue(issymbolic(mem.read_int(addr + 0x1001, 8)))
+        mem.write_int(addr + 0x1000, 0xffff, 16)
+        self.assertEqual(mem._symbols, {})
+        self.assertEqual(mem.read_int(addr + 0xffe, 32), 0xffff5566)
+
+        mem.mprotect(addr, 0x1000, 'r')
+        with self.assertRaises(InvalidMemoryAccess):
+            mem.write_int(addr, 1, 32)
+        mem.write_int(addr, 1, 32, force=True)
+        self.assertEqual(mem.read_int(addr, 32), 1)
+
+    def test_mem_large_maps(self):
+        cs = ConstraintSet()
+        mem = SMemory64(cs)
+        addr = mem.mmap(None, 0x10000000, 'rw')
+        top = mem.mmap(None, 0x1000, 'r')
+        self.assertEqual(top, addr - 0x1000)
+
+        mem.mprotect(addr + 0x4000000, 0x1000, 'r')
+        mem.munmap(addr + 0x8000000, 0x2000)
+        self.assertEqual(len(mem.mappings()), 5)
+        self.assertEqual(mem.map_containing(addr + 0x4000fff).perms, 'r')
+        self.assertEqual(mem.map_containing(addr + 0x4001000).start, addr + 0x4001000)
+        self.assertNotIn(addr + 0x8001000, mem)
+        with self.assertRaises(MemoryException):
+            mem.map_containing(addr + 0x8000000)
+
+        # The unmapped gap is found again
+        self.assertEqual(mem._search(0x2000, addr + 0x8000000), addr + 0x8000000)
+        self.assertEqual(mem.mmap(addr + 0x8000000, 0x1000, 'rw'), addr + 0x8000000)
+        self.assertEqual(mem._search(0x2000, addr + 0x8000000), top - 0x2000)
+
+        mem = pickle.loads(pickle.dumps(mem))
+        self.assertEqual(len(mem.mappings()), 6)
+        self.assertEqual(mem.map_containing(addr + 0x8000000).end, addr + 0x8001000)
+
     def test_mmap_file_extra(self):
         #file mapping
         rwx_file = tempfile.NamedTemporaryFile('w+b', delete=False)
@@ -2,10 +2,13 @@ import unittest
 import os
 
 from manticore.core.smtlib import ConstraintSet, solver
+from manticore.core.state import TerminateState
 from manticore.native.state import State
 from manticore.platforms import linux
 
-from manticore.native.models import variadic, isvariadic, strcmp, strlen
+from manticore.native import models
+from manticore.native.models import variadic, isvariadic, strcmp, strlen, memcmp, memcpy, memset, strncpy, strchr, \
+    malloc, free
 
 
 class ModelMiscTest(unittest.TestCase):
@@ -192,3 +195,151 @@ class StrlenTest(ModelTest):
         self.state.constrain(sy[3] != 0)
         ret = strlen(self.state, s)
         self.assertTrue(self.state.must_be_true(ret == 4))
+
+
+    def test_batched_queries(self):
+        sy = self.state.symbolicate_buffer('+' * 100 + '\0')
+        s = self._push_string(sy)
+        self.state.constrain(sy[50] == 0)
+
+        queries = []
+        can_be_true = solver.can_be_true
+
+        def counted_can_be_true(*args, **kwargs):
+            queries.append(args)
+            return can_be_true(*args, **kwargs)
+
+        solver.can_be_true = counted_can_be_true
+        try:
+            ret = strlen(self.state, s)
+        finally:
+            solver.can_be_true = can_be_true
+        # A query per chunk of the string, plus the bisection for the NULL
+        self.assertLess(len(queries), 12)
+        self.assertItemsEqual(range(51), solver.get_all_values(self.state.constraints, ret))
+
+
+class MemTest(ModelTest):
+    def test_memcmp(self):
+        s1 = self._push_string('abc\0d')
+        s2 = self._push_string('abc\0e')
+        self.assertEqual(memcmp(self.state, s1, s2, 4), 0)
+        self.assertTrue(memcmp(self.state, s1, s2, 5) < 0)
+        self.assertEqual(memcmp(self.state, s1, s2, 0), 0)
+
+        sy = self.state.symbolicate_buffer('a+c')
+        s3 = self._push_string(sy)
+        ret = memcmp(self.state, s1, s3, 3)
+        self.assertTrue(solver.can_be_true(self.state.constraints, ret == 0))
+        self.state.constrain(sy[1] == ord('a'))
+        self.assertTrue(self.state.must_be_true(ret > 0))
+
+    def test_memcpy(self):
+        sy = self.state.symbolicate_buffer('a+c\0')
+        src = self._push_string(sy)
+        dest = self._push_string('\xff' * 4)
+        self.assertEqual(memcpy(self.state, dest, src, 4), dest)
+        copied = self.state.cpu.read_bytes(dest, 4)
+        self.assertEqual(copied[0], b'a')
+        self.assertIs(copied[1], sy[1])
+        self.assertEqual(copied[2:], [b'c', b'\0'])
+
+    def test_memset(self):
+        dest = self._push_string('abcd')
+        self.assertEqual(memset(self.state, dest, 0x141, 3), dest)
+        self.assertEqual(self.state.cpu.read_bytes(dest, 4), [b'A', b'A', b'A', b'd'])
+
+        c = self.state.new_symbolic_value(32)
+        memset(self.state, dest, c, 2)
+        self.state.constrain(c == 0x42)
+        byte = self.state.cpu.read_int(dest + 1, 8)
+        self.assertEqual(solver.get_all_values(self.state.constraints, byte), [0x42])
+
+
+class StrncpyTest(ModelTest):
+    def test_concrete(self):
+        src = self._push_string('ab\0c')
+        dest = self._push_string('\xff' * 5)
+        self.assertEqual(strncpy(self.state, dest, src, 4), dest)
+        self.assertEqual(self.state.cpu.read_bytes(dest, 5), [b'a', b'b', b'\0', b'\0', b'\xff'])
+
+        # Not NULL terminated if src is too long
+        dest = self._push_string('\xff' * 3)
+        strncpy(self.state, dest, src, 1)
+        self.assertEqual(self.state.cpu.read_bytes(dest, 3), [b'a', b'\xff', b'\xff'])
+
+    def test_symbolic(self):
+        sy = self.state.symbolicate_buffer('a++\0')
+        src = self._push_string(sy)
+        dest = self._push_string('\xff' * 4)
+        strncpy(self.state, dest, src, 4)
+        copied = [self.state.cpu.read_int(dest + i, 8) for i in range(4)]
+        self.state.constrain(sy[1] == 0)
+        self.state.constrain(sy[2] == ord('x'))
+        self.assertEqual(copied[0], ord('a'))
+        for byte in copied[1:]:
+            self.assertTrue(self.state.must_be_true(byte == 0))
+
+
+class StrchrTest(ModelTest):
+    def test_concrete(self):
+        s = self._push_string('abca\0')
+        self.assertEqual(strchr(self.state, s, ord('c')), s + 2)
+        self.assertEqual(strchr(self.state, s, 0x100 + ord('a')), s)
+        self.assertEqual(strchr(self.state, s, ord('z')), 0)
+        self.assertEqual(strchr(self.state, s, 0), s + 4)
+
+    def test_symbolic(self):
+        sy = self.state.symbolicate_buffer('a+c\0')
+        s = self._push_string(sy)
+        ret = strchr(self.state, s, ord('c'))
+        self.assertItemsEqual([s + 1, s + 2, 0], solver.get_all_values(self.state.constraints, ret))
+        self.state.constrain(sy[1] != ord('c'))
+        self.state.constrain(sy[1] != 0)
+        self.assertTrue(self.state.must_be_true(ret == s + 2))
+
+
+class MallocTest(ModelTest):
+    def test_malloc_free(self):
+        a = malloc(self.state, 10)
+        b = malloc(self.state, 0)
+        self.assertEqual(a % models.HEAP_ALIGNMENT, 0)
+        self.assertGreaterEqual(b, a + 10)
+        self.state.cpu.write_bytes(a, 'x' * 10)
+
+        # Large blocks are mapped on their own, and unmapped when freed
+        c = malloc(self.state, models.HEAP_ARENA_SIZE + 1)
+        self.state.cpu.write_bytes(c + models.HEAP_ARENA_SIZE, 'x')
+        self.assertEqual(malloc(self.state, 1 << 63), 0)
+        free(self.state, c)
+        self.assertNotIn(c, self.state.cpu.memory)
+
+        free(self.state, a)
+        free(self.state, 0)
+        with self.assertRaises(TerminateState):
+            free(self.state, a)
+        with self.assertRaises(TerminateState):
+            free(self.state, b + 1)
+
+    def test_symbolic_size(self):
+        size = self.state.new_symbolic_value(32)
+        self.state.constrain(size.ult(0x3000))
+        a = malloc(self.state, size)
+        b = malloc(self.state, 1)
+        self.assertGreaterEqual(b, a + 0x2fff)
+        self.state.cpu.write_bytes(a + 0x2ffe, 'x')
+
+    def test_unbounded_symbolic_size(self):
+        # Only the sizes up to MALLOC_SYMBOLIC_MAX are explored
+        size = self.state.new_symbolic_value(64)
+        a = malloc(self.state, size)
+        self.assertNotEqual(a, 0)
+        self.assertEqual(self.state.solve_max(size), models.MALLOC_SYMBOLIC_MAX)
+        self.state.cpu.write_bytes(a + models.MALLOC_SYMBOLIC_MAX - 1, 'x')
+
+        # Or the smallest one, if they are all larger
+        size = self.state.new_symbolic_value(64)
+        self.state.constrain(size.ugt(models.MALLOC_SYMBOLIC_MAX))
+        a = malloc(self.state, size)
+        self.assertNotEqual(a, 0)
+        self.assertEqual(self.state.solve_n(size, 2), [models.MALLOC_SYMBOLIC_MAX + 1])
@@ -1,6 +1,11 @@
+import os
+import shutil
+import tempfile
 import unittest
 
 from manticore.core.smtlib import *
+from manticore.exceptions import SolverException, TooManySolutions
+from manticore.utils import config
 
 
 #logging.basicConfig(filename = "test.log",
@@ -307,6 +312,44 @@ class ExpressionTest(unittest.TestCase):
         cs = pickle.loads(pickle.dumps(cs))
         self.assertTrue(self.solver.check(cs))
 
+    def testRelated(self):
+        import pickle
+        cs = ConstraintSet()
+        a, b, c, d = (cs.new_bitvec(32, name=name) for name in 'abcd')
+        cs.add(a > 1)
+        cs.add(c > 3)
+        cs.add(b < 10)
+        variables, related = cs._get_related(a)
+        self.assertEqual({v.name for v in variables}, {'a'})
+        self.assertEqual(len(related), 1)
+
+        with cs as temp_cs:
+            # b joins the partition of a only in the child
+            temp_cs.add(a == b)
+            variables, related = temp_cs._get_related(a)
+            self.assertEqual({v.name for v in variables}, {'a', 'b'})
+            self.assertEqual(len(related), 3)
+            self.assertEqual(temp_cs.to_string(related_to=d).strip(), d.declaration)
+            self.assertNotIn('#x00000003', temp_cs.to_string(related_to=b))
+            self.assertIn('#x00000003', temp_cs.to_string())
+            self.assertTrue(self.solver.check(temp_cs))
+            # The child index only holds what changed over the parent's
+            self.assertEqual(set(temp_cs._index._parents.maps[0]), {'b'})
+        self.assertIsNone(temp_cs._index)
+        self.assertEqual(len(cs._get_related(a)[1]), 1)
+
+        cs.add(c == a + d)
+        self.assertEqual(len(cs._get_related(d)[1]), 3)
+        self.assertEqual(len(cs._get_related()[1]), 4)
+
+        cs = pickle.loads(pickle.dumps(cs))
+        self.assertIsNone(cs._index)
+        self.assertEqual(len(cs._get_related(cs.get_variable('d'))[1]), 3)
+
+        cs.add(False)
+        self.assertEqual(cs.to_string(related_to=cs.get_variable('b')), '(assert false)\n')
+        self.assertFalse(self.solver.check(cs))
+
     def testBitvector_add(self):
         cs =  ConstraintSet()
         a = cs.new_bitvec(32)
@@ -856,6 +899,208 @@ class ExpressionTest(unittest.TestCase):
         self.assertTrue(solver.check(cs))
         self.assertEqual(solver.get_value(cs, a), -7&0xFF)
 
+    def test_incremental_session(self):
+        consts = config.get_group('smt')
+        consts.incremental = True
+        try:
+            cs = ConstraintSet()
+            x = cs.new_bitvec(8)
+            y = cs.new_bitvec(8)
+            cs.add(x.ult(0x10))
+            self.assertTrue(self.solver.can_be_true(cs, x == 3))
+            proc = self.solver._proc
+
+            cs.add(y == x + 1)
+            self.assertFalse(self.solver.can_be_true(cs, y == 0x20))
+            self.assertItemsEqual(self.solver.get_all_values(cs, y), range(1, 0x11))
+            self.assertEqual(self.solver.minmax(cs, y), (1, 0x10))
+            with cs as temp_cs:
+                temp_cs.add(x == 7)
+                self.assertEqual(self.solver.get_value(temp_cs, y), 8)
+            self.assertTrue(self.solver.check(cs))
+
+            # Unrelated sets just pop the frames of the previous one
+            other = ConstraintSet()
+            z = other.new_bitvec(8)
+            other.add(z == 1)
+            self.assertEqual(self.solver.get_value(other, z), 1)
+            self.assertFalse(self.solver.can_be_true(other, z == 3))
+            self.assertTrue(self.solver.can_be_true(cs, x == 3))
+
+            # The process is never restarted
+            self.assertIs(self.solver._proc, proc)
+        finally:
+            consts.incremental = False
+
+    def test_query_cache(self):
+        from manticore.core.smtlib.cache import QueryCache, query_cache, query_key
+        workspace = tempfile.mkdtemp()
+        path = os.path.join(workspace, 'solver_cache.db')
+        query_cache.open(path)
+        try:
+            cs = ConstraintSet()
+            x = cs.new_bitvec(8, name='x')
+            y = cs.new_bitvec(8, name='y')
+            cs.add(x.ult(0x10))
+            cs.add(y == x + 1)
+
+            hits, misses = query_cache.hits, query_cache.misses
+            self.assertFalse(self.solver.can_be_true(cs, y == 0x20))
+            self.assertItemsEqual(self.solver.get_all_values(cs, y), range(1, 0x11))
+            self.assertEqual(self.solver.minmax(cs, y), (1, 0x10))
+            self.assertEqual(query_cache.misses - misses, 4)
+
+            # Same queries over an equivalent set are answered by the cache
+            cs2 = ConstraintSet()
+            x2 = cs2.new_bitvec(8, name='x')
+            y2 = cs2.new_bitvec(8, name='y')
+            cs2.add(y2 == x2 + 1)
+            cs2.add(x2.ult(0x10))
+            self.solver._stop_proc()
+            self.assertFalse(self.solver.can_be_true(cs2, y2 == 0x20))
+            self.assertItemsEqual(self.solver.get_all_values(cs2, y2), range(1, 0x11))
+            self.assertEqual(self.solver.minmax(cs2, y2), (1, 0x10))
+            self.assertEqual(query_cache.hits - hits, 4)
+            self.assertIsNone(self.solver._proc)
+
+            # Parameters are part of the key
+            self.assertEqual(len(self.solver.get_all_values(cs2, y2, maxcnt=2, silent=True)), 2)
+            self.assertRaises(TooManySolutions, self.solver.get_all_values, cs2, y2, maxcnt=2)
+            self.assertNotEqual(query_key('get_all_values', cs, y, 2), query_key('get_all_values', cs, y, None))
+
+            # Unrelated constraints are not part of the key
+            z = cs.new_bitvec(8, name='z')
+            cs.add(z == 3)
+            self.assertTrue(self.solver.can_be_true(cs, y == 0x10))
+            self.assertEqual(query_key('can_be_true', cs, y == 0x10), query_key('can_be_true', cs2, y2 == 0x10))
+
+            # The cache is persistent
+            self.assertEqual(QueryCache(path).get(query_key('can_be_true', cs2, y2 == 0x20)), (True, False))
+
+            # Least recently used queries are evicted
+            small = QueryCache(path, max_size=2)
+            small.flush()
+            self.assertLessEqual(len(small), 2)
+        finally:
+            query_cache.close()
+            shutil.rmtree(workspace)
+
+    def test_evaluator(self):
+        from manticore.core.smtlib.visitors import evaluate
+        cs = ConstraintSet()
+        x = cs.new_bitvec(8, name='x')
+        y = cs.new_bitvec(8, name='y')
+        array = cs.new_array(32, name='array', index_max=4)
+        cs.add(x == 0xf9)
+        cs.add(y == 0x02)
+        cs.add(array[1] == 0x41)
+        model = {'x': 0xf9, 'y': 0x02, 'array': {1: 0x41}}
+        for expression in (x / y, x.udiv(y), x % y, x.srem(y), x.urem(y), x.sar(y), x >> y, x << y, -x, ~x,
+                           x / 0, x % 0, x.srem(0), Operators.SEXTEND(x, 8, 16), Operators.EXTRACT(Operators.SEXTEND(x, 8, 16), 4, 8),
+                           Operators.CONCAT(16, x, y), Operators.ITEBV(8, x < y, x, y),
+                           array.store(2, y)[2] + array[1]):
+            self.assertEqual(evaluate(expression, model), self.solver.get_value(cs, expression))
+        self.assertTrue(evaluate(x < y, model))
+        self.assertFalse(evaluate(x.ult(y), model))
+        self.assertRaises(Evaluator.NotEvaluable, evaluate, array[3] == 0, model)
+
+    def test_model_cache(self):
+        from manticore.core.smtlib.cache import model_cache
+        consts = config.get_group('smt')
+        consts.model_cache = 2
+        try:
+            cs = ConstraintSet()
+            x = cs.new_bitvec(8, name='x')
+            array = cs.new_array(32, name='array', index_max=4)
+            cs.add(x.ult(100))
+            cs.add(array[1] == x)
+
+            hits, misses = model_cache.hits, model_cache.misses
+            self.assertTrue(self.solver.can_be_true(cs, array[3] == x))
+            model = cs._models[0]
+            self.assertEqual(model['array'][3], model['x'])
+            self.assertTrue(self.solver.can_be_true(cs, x == model['x']))
+            self.assertEqual(self.solver.get_value(cs, x + 1), model['x'] + 1)
+            self.assertEqual(model_cache.hits - hits, 2)
+
+            # Models not satisfying the query fall back to the solver
+            self.assertFalse(self.solver.can_be_true(cs, x == 100))
+            self.assertTrue(self.solver.can_be_true(cs, x == model['x'] + 1))
+            self.assertEqual(model_cache.misses - misses, 3)
+            self.assertEqual(len(cs._models), 2)
+
+            # Forks share the models found so far
+            with cs as temp_cs:
+                temp_cs.add(x != 0)
+                self.assertTrue(self.solver.check(temp_cs))
+            self.assertEqual(model_cache.hits - hits, 3)
+        finally:
+            consts.model_cache = 0
+
+    def test_get_values(self):
+        cs = ConstraintSet()
+        buf = cs.new_array(32, name='buf', index_max=300)
+        free = cs.new_array(32, name='free', index_max=4)
+        stored = cs.new_array(32, name='stored', index_max=4)
+        x = cs.new_bitvec(8, name='x')
+        b = cs.new_bool(name='b')
+        for i in range(0, 300, 2):
+            cs.add(buf[i] == i % 256)
+        cs.add(buf[1] == x)
+        cs.add(x == 0x41)
+        cs.add(b == (x > 0x40))
+        stored[0] = x + 1
+
+        sends = []
+        send = self.solver._send
+        self.solver._send = lambda cmd: sends.append(cmd) or send(cmd)
+        values = self.solver.get_values(cs, [buf, free, stored, x, b, buf[1], 7])
+        self.assertEqual(values[0][::2], bytes(i % 256 for i in range(0, 300, 2)))
+        self.assertEqual(values[0][1], 0x41)
+        self.assertEqual(values[1:], [bytes(4), values[2], 0x41, True, 0x41, 7])
+        self.assertEqual(values[2][0], 0x42)
+
+        # Whole buffers come from a single get-value
+        self.assertEqual(self.solver.get_value(cs, buf)[:2], b'\x00\x41')
+        self.assertEqual(len([cmd for cmd in sends if cmd.startswith('(get-value')]), 2)
+
+        # A term missing from the reply is an error, only undeclared variables default
+        getvalues = self.solver._getvalues
+        self.solver._getvalues = lambda terms: {term: value for term, value in getvalues(terms).items() if term != 'x'}
+        self.assertEqual(self.solver.get_values(cs, [free]), [bytes(4)])
+        with self.assertRaises(SolverException):
+            self.solver.get_values(cs, [x])
+
+    def test_slots(self):
+        cs = ConstraintSet()
+        x = cs.new_bitvec(32)
+        array = cs.new_array(32, index_max=4)
+        for expression in (x, x + 1, BitVecConstant(32, 1), x == 1, array.store(1, 1), array[x],
+                           Operators.EXTRACT(x, 0, 8), Operators.ZEXTEND(x, 64)):
+            self.assertFalse(hasattr(expression, '__dict__'))
+        self.assertEqual(Expression.__slots__, ())
+        self.assertEqual(BitVecVariable.__xslots__, ('__weakref__', '_name', '_taint', 'size'))
+
+    def test_intern_expressions(self):
+        consts = config.get_group('smt')
+        consts.intern_expressions = True
+        try:
+            cs = ConstraintSet()
+            x = cs.new_bitvec(32, name='x')
+            other = ConstraintSet().new_bitvec(32, name='x')
+            self.assertIs(x + 1, x + 1)
+            self.assertIs(BitVecConstant(32, 1), BitVecConstant(32, 1))
+            self.assertIsNot(BitVecConstant(32, 1), BitVecConstant(64, 1))
+            self.assertIsNot(BitVecConstant(32, 1), BitVecConstant(32, 1, taint=('T',)))
+            self.assertIsNot(Operators.EXTRACT(x, 0, 8), Operators.EXTRACT(x, 8, 8))
+            self.assertIsNot(x + 1, other + 1)
+            self.assertIs(simplify((x + 1) + 0), x + 1)
+            array = cs.new_array(32, index_max=4)
+            self.assertIsNot(array[1:3], array[1:3])
+        finally:
+            consts.intern_expressions = False
+        self.assertIsNot(x + 1, x + 1)
+
     def test_check_solver_min(self):
         self.solver._received_version = '(:version "4.4.1")'
         self.assertTrue(self.solver._solver_version() == Version(major=4, minor=4, patch=1))
@@ -81,6 +81,23 @@ class StateTest(unittest.TestCase):
         solved = self.state.solve_one(expr)
         self.assertEqual(solved, val)
 
+    def test_solve_one_n(self):
+        x = self.state.new_symbolic_value(8)
+        y = self.state.new_symbolic_value(8)
+        buf = self.state.new_symbolic_buffer(3)
+        self.state.constrain(x + y == 10)
+        self.state.constrain(x.ult(y))
+        self.state.constrain(y.ult(7))
+        self.state.constrain(buf[1] == x)
+
+        # Values of the same model, concrete values are passed through
+        solved = self.state.solve_one_n(x, 7, buf, y, constrain=True)
+        self.assertEqual(solved[:2], [4, 7])
+        self.assertEqual(solved[3], 6)
+        self.assertIsInstance(solved[2], bytes)
+        self.assertEqual(solved[2][1], 4)
+        self.assertEqual(self.state.solve_n(buf[0], 2), [solved[2][0]])
+
     def test_solve_n(self):
         expr = BitVecVariable(32, 'tmp')
         self.state.constrain(expr > 4)
@@ -4,19 +4,21 @@ import os
 import struct
 from capstone import CS_MODE_THUMB, CS_MODE_ARM
 from functools import wraps
-from keystone import Ks, KS_ARCH_ARM, KS_MODE_ARM, KS_MODE_THUMB
+from keystone import Ks, KS_ARCH_ARM, KS_ARCH_X86, KS_MODE_ARM, KS_MODE_THUMB, KS_MODE_64
 from unicorn import UC_QUERY_MODE, UC_MODE_THUMB
 
-from manticore.native.cpu.abstractcpu import ConcretizeRegister
+from manticore.native.cpu.abstractcpu import ConcretizeRegister, InstructionEmulationError
 from manticore.native.cpu.arm import Armv7Cpu as Cpu, Mask, Interruption
-from manticore.core.smtlib import ConstraintSet
+from manticore.core.smtlib import BitVec, ConstraintSet
 from manticore.native.state import State
-from manticore.native.memory import ConcretizeMemory, Memory32
+from manticore.native.cpu.x86 import AMD64Cpu
+from manticore.native.memory import ConcretizeMemory, Memory32, SMemory64
 from manticore.platforms import linux
-from manticore.utils.emulate import UnicornEmulator
+from manticore.utils.emulate import ConcreteUnicornEmulator, UnicornEmulator
 
 ks = Ks(KS_ARCH_ARM, KS_MODE_ARM)
 ks_thumb = Ks(KS_ARCH_ARM, KS_MODE_THUMB)
+ks_amd64 = Ks(KS_ARCH_X86, KS_MODE_64)
 
 import logging
 
@@ -1429,3 +1431,138 @@ class UnicornConcretization(unittest.TestCase):
         with self.assertRaises(ConcretizeRegister):
             self.cpu.emulate(self.cpu.decode_instruction(self.cpu.PC))
 
+
+class ConcreteUnicornTest(unittest.TestCase):
+    '''
+    Test running concrete x86-64 code in Unicorn a basic block at a time
+    '''
+    def setUp(self):
+        self.cs = ConstraintSet()
+        self.mem = SMemory64(self.cs)
+        self.cpu = AMD64Cpu(self.mem)
+        self.code = self.mem.mmap(0x1000, 0x1000, 'rwx')
+        self.stack = self.mem.mmap(0xf000, 0x1000, 'rw')
+        self.cpu.RSP = self.stack + 0x800
+
+    def _setupCpu(self, asm):
+        code = bytes(ks_amd64.asm(asm, self.code)[0])
+        self.mem.write(self.code, code)
+        self.cpu.RIP = self.code
+        return self.code + len(code)
+
+    def test_stops_at_syscall(self):
+        end = self._setupCpu('''
+            mov rcx, 10
+            xor rax, rax
+        loop:
+            add rax, rcx
+            push rax
+            pop rbx
+            dec rcx
+            jnz loop
+            syscall
+        ''')
+        executed = ConcreteUnicornEmulator(self.cpu).run()
+        self.assertEqual(executed, 2 + 5 * 10)
+        self.assertEqual(self.cpu.RAX, 55)
+        self.assertEqual(self.cpu.RBX, 55)
+        self.assertEqual(self.cpu.RIP, end - 2)
+        self.assertEqual(self.cpu.read_int(self.stack + 0x7f8), 55)
+
+    def test_stops_at_symbolic_read(self):
+        self._setupCpu('''
+            mov qword ptr [rsp - 8], 3
+            inc rax
+            mov rbx, qword ptr [rsp]
+        ''')
+        self.mem.write(self.stack + 0x800, [self.cs.new_bitvec(8)] + [b'\0'] * 7)
+        executed = ConcreteUnicornEmulator(self.cpu).run()
+        self.assertEqual(executed, 2)
+        self.assertEqual(self.cpu.RAX, 1)
+        self.assertEqual(self.cpu.read_int(self.stack + 0x7f8), 3)
+        # The symbolic read is left to the models
+        self.assertTrue(isinstance(self.mem.read(self.stack + 0x800, 1)[0], BitVec))
+
+    def test_unsupported_entry(self):
+        self._setupCpu('syscall')
+        self.assertEqual(ConcreteUnicornEmulator(self.cpu).run(), 0)
+        self.assertEqual(self.cpu.RIP, self.code)
+
+    def test_reuse(self):
+        self._setupCpu('''
+            mov rax, qword ptr [rsp]
+            inc rax
+            jmp done
+        done:
+            syscall
+        ''')
+        self.cpu.write_int(self.cpu.RSP, 1, 64)
+        self.assertTrue(self.cpu._run_concrete())
+        self.assertEqual(self.cpu.RAX, 2)
+        emulator = self.cpu._concrete_emulator
+        uc = emulator._emu
+
+        # Memory changed outside of Unicorn is brought in
+        self.cpu.write_int(self.cpu.RSP, 5, 64)
+        self.cpu.RIP = self.code
+        self.assertTrue(self.cpu._run_concrete())
+        self.assertEqual(self.cpu.RAX, 6)
+        self.assertIs(self.cpu._concrete_emulator, emulator)
+        self.assertIs(emulator._emu, uc)
+
+        # So is new code
+        self._setupCpu('''
+            mov rax, qword ptr [rsp]
+            dec rax
+            jmp done
+        done:
+            syscall
+        ''')
+        self.assertTrue(self.cpu._run_concrete())
+        self.assertEqual(self.cpu.RAX, 4)
+
+
+class PersistentEmulatorTest(unittest.TestCase):
+    '''
+    Test the Unicorn emulator kept by the cpu between instructions
+    '''
+    def setUp(self):
+        self.mem = SMemory64(ConstraintSet())
+        self.cpu = AMD64Cpu(self.mem)
+        self.code = self.mem.mmap(0x1000, 0x1000, 'rwx')
+        self.data = self.mem.mmap(0xd000, 0x1000, 'rw')
+
+    def _emulate(self, asm, offset=0):
+        self.mem.write(self.code + offset, bytes(ks_amd64.asm(asm, self.code + offset)[0]))
+        self.cpu.RIP = self.code + offset
+        insn = self.cpu.decode_instruction(self.cpu.PC)
+        self.cpu.emulate(insn)
+        return insn
+
+    def test_reuse(self):
+        self.cpu.write_int(self.data, 0x0102030405060708, 64)
+        insn = self._emulate(f'movq xmm0, qword ptr [{self.data:#x}]')
+        emulator = self.cpu._emulator
+        self.assertEqual(self.cpu.XMM0, 0x0102030405060708)
+        self.assertEqual(self.cpu.RIP, self.code + insn.size)
+
+        # Memory and registers changed outside of Unicorn are brought in
+        self.cpu.write_int(self.data, 0x1111, 64)
+        self.cpu.XMM1 = 0x2222
+        self._emulate(f'paddq xmm1, xmmword ptr [{self.data:#x}]', 0x10)
+        self.assertIs(self.cpu._emulator, emulator)
+        self.assertEqual(self.cpu.XMM1, 0x3333)
+
+    def test_remap(self):
+        self.cpu.write_int(self.data, 1, 64)
+        self._emulate(f'movq xmm0, qword ptr [{self.data:#x}]')
+        self.assertEqual(self.cpu.XMM0, 1)
+
+        self.mem.munmap(self.data, 0x1000)
+        self.mem.mmap(self.data, 0x1000, 'r', b'\x02' * 8)
+        self._emulate(f'movq xmm0, qword ptr [{self.data:#x}]', 0x10)
+        self.assertEqual(self.cpu.XMM0, 0x0202020202020202)
+
+        # The new mapping is read only
+        with self.assertRaises(InstructionEmulationError):
+            self._emulate(f'movq qword ptr [{self.data:#x}], xmm0', 0x20)
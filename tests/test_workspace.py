@@ -107,3 +107,101 @@ class StateTest(unittest.TestCase):
         self.assertIn('messages', keys)
         self.assertIn('input', keys)
         self.assertIn('pkl', keys)
+
+    def _fork(self, workspace, state_id, count):
+        state = workspace.load_state(state_id, delete=False)
+        symbol = state.input_symbols[0]
+        children = []
+        for value in range(count):
+            with state as child:
+                child.constrain(symbol != value)
+                children.append(workspace.save_state(child))
+        return children
+
+    def test_workspace_delta(self):
+        store = MemoryStore()
+        workspace = Workspace(self.lock, store)
+        self.state.constrain(self.state.new_symbolic_value(32) > 3)
+        parent = workspace.save_state(self.state)
+        blobs = len(store.ls('blob_*'))
+
+        # The children only save their own constraint set
+        children = self._fork(workspace, parent, 2)
+        self.assertEqual(len(store.ls('blob_*')), blobs + 2)
+
+        for value, child in enumerate(children):
+            state = workspace.load_state(child)
+            symbol = state.input_symbols[0]
+            self.assertTrue(state.constraints.is_declared(symbol))
+            self.assertEqual(len(state.constraints), 2)
+            self.assertFalse(state.can_be_true(symbol == value))
+            self.assertTrue(state.can_be_true(symbol == value + 4))
+            self.assertEqual(sorted(m.start for m in state.mem._maps),
+                             sorted(m.start for m in self.state.mem._maps))
+
+        # The blobs go with the last state referencing them
+        self.assertEqual(len(store.ls('blob_*')), blobs)
+        workspace.rm_state(parent)
+        self.assertEqual(store.ls('*'), [])
+
+    def test_workspace_compact(self):
+        store = MemoryStore()
+        workspace = Workspace(self.lock, store)
+        self.state.new_symbolic_value(32)
+        parent = workspace.save_state(self.state)
+        self._fork(workspace, parent, 2)
+        blobs = sorted(store.ls('blob_*'))
+        store.save_value('blob_orphan', b'')
+
+        # Resuming a workspace rebuilds the reference counts
+        workspace = Workspace(self.lock, store)
+        self.assertEqual(len(workspace.try_loading_workspace()), 3)
+        self.assertEqual(sorted(store.ls('blob_*')), blobs)
+        for state_id in range(3):
+            workspace.rm_state(state_id)
+        self.assertEqual(store.ls('*'), [])
+
+    def test_workspace_pending_blobs(self):
+        store = MemoryStore()
+        workspace = Workspace(self.lock, store)
+        self.state.new_symbolic_value(32)
+        state_id = workspace.save_state(self.state)
+        key = store.ls('blob_*')[0][len('blob_'):]
+        workspace.rm_state(state_id)
+        self.assertEqual(store.ls('*'), [])
+
+        # A blob referenced by another process still saving it is saved too
+        workspace._refs.add([(None, [key])])
+        state_id = workspace.save_state(self.state)
+        self.assertIn(f'blob_{key}', store.ls('blob_*'))
+        workspace.rm_state(state_id)
+        workspace._release([key])
+        self.assertEqual(store.ls('*'), [])
+
+    def test_workspace_deep_expressions(self):
+        symbol = self.state.new_symbolic_value(32)
+        expression = symbol
+        for _ in range(2000):
+            expression = expression + 1
+        self.state.constrain(expression != 0)
+        workspace = Workspace(self.lock, MemoryStore())
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(1000)
+        try:
+            state_id = workspace.save_state(self.state)
+            self.assertGreater(sys.getrecursionlimit(), 1000)
+        finally:
+            sys.setrecursionlimit(limit)
+        state = workspace.load_state(state_id)
+        self.assertEqual(len(state.constraints), 1)
+
+    def test_workspace_full_snapshots(self):
+        consts.delta_snapshots = False
+        try:
+            workspace = Workspace(self.lock, 'mem:')
+            id_ = workspace.save_state(self.state)
+            self.assertEqual(workspace._store.ls('blob_*'), [])
+        finally:
+            consts.delta_snapshots = True
+        state = workspace.load_state(id_)
+        self.assertEqual(len(state.mem._maps), len(self.state.mem._maps))